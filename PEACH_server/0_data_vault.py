@@ -39,7 +39,7 @@ from twisted.internet.reactor import callLater
 from twisted.internet.defer import inlineCallbacks
 
 from ConfigParser import SafeConfigParser
-import os, re
+import os, re, struct
 from datetime import datetime
 
 try:
@@ -67,8 +67,18 @@ PRECISION = 12 # digits of precision to use when saving data
 DATA_FORMAT = '%%.%dG' % PRECISION
 FILE_TIMEOUT = 60 # how long to keep datafiles open if not accessed
 DATA_TIMEOUT = 300 # how long to keep data in memory if not accessed
+MIN_BUFFER_ROWS = 1024 # rows to allocate when data is first added in memory
 TIME_FORMAT = '%Y-%m-%d, %H:%M:%S'
 
+# storage formats for datafiles: 'csv' is text, one row per line, and
+# 'binary' is a BINARY_HEADER followed by rows of little-endian float64s.
+# The format of new datasets is loaded from the registry along with the
+# repository location and can be changed per context with 'storage'.
+STORAGE = 'csv'
+STORAGE_EXTENSIONS = {'csv': '.csv', 'binary': '.bin'}
+BINARY_MAGIC = 'LRDVBIN1'
+BINARY_HEADER = struct.Struct('<8sII') # magic, header length, columns
+
 
 ## error messages
 
@@ -114,6 +124,16 @@ class ParameterInUseError(T.Error):
     def __init__(self, name):
         self.msg = "Already a parameter called '%s'." % name
 
+class BadStorageError(T.Error):
+    code = 11
+    def __init__(self, storage):
+        self.msg = "Unknown storage format '%s'; use one of %s." % (storage, sorted(STORAGE_EXTENSIONS))
+
+class BadDatafileError(T.Error):
+    code = 12
+    def __init__(self, filename):
+        self.msg = "Datafile '%s' is not a binary data vault file." % filename
+
 
 ## filename translation
         
@@ -296,7 +316,7 @@ class Session(object):
         """Get a list of directory names in this directory."""
         files = os.listdir(self.dir)
         dirs = [dsDecode(s[:-4]) for s in files if s.endswith('.dir')]
-        datasets = [dsDecode(s[:-4]) for s in files if s.endswith('.csv')]
+        datasets = self.listDatasets(files)
         # apply tag filters
         def include(entries, tag, tags):
             """Include only entries that have the specified tag."""
@@ -319,18 +339,28 @@ class Session(object):
             #print 'after:', dirs, datasets
         return dirs, datasets
             
-    def listDatasets(self):
+    def listDatasets(self, files=None):
         """Get a list of dataset names in this directory."""
-        files = os.listdir(self.dir)
-        return [dsDecode(s[:-4]) for s in files if s.endswith('.csv')]
+        if files is None:
+            files = os.listdir(self.dir)
+        extensions = STORAGE_EXTENSIONS.values()
+        return [dsDecode(s[:-4]) for s in files if s[-4:] in extensions]
+    
+    def datasetStorage(self, name):
+        """Get the storage format of a dataset from its datafile, or None."""
+        base = os.path.join(self.dir, dsEncode(name))
+        for storage, ext in STORAGE_EXTENSIONS.items():
+            if os.path.exists(base + ext):
+                return storage
+        return None
     
-    def newDataset(self, title, independents, dependents):
+    def newDataset(self, title, independents, dependents, storage=None):
         num = self.counter
         self.counter += 1
         self.modified = datetime.now()
 
         name = '%05d - %s' % (num, title)
-        dataset = Dataset(self, name, title, create=True)
+        dataset = datasetClass(storage or STORAGE)(self, name, title, create=True)
         for i in independents:
             dataset.addIndependent(i)
         for d in dependents:
@@ -354,8 +384,8 @@ class Session(object):
         if isinstance(name, (int, long)):
             raise DatasetNotFoundError(name)
 
-        filename = dsEncode(name)
-        if not os.path.exists(os.path.join(self.dir, filename + '.csv')):
+        storage = self.datasetStorage(name)
+        if storage is None:
             raise DatasetNotFoundError(name)
 
         if name in self.datasets:
@@ -363,7 +393,7 @@ class Session(object):
             dataset.access()
         else:
             # need to create a new wrapper for this dataset
-            dataset = Dataset(self, name)
+            dataset = datasetClass(storage)(self, name)
             self.datasets[name] = dataset
         self.access()
         
@@ -416,11 +446,14 @@ class Session(object):
         return sessTags, dataTags
 
 class Dataset:
+    storage = 'csv'
+    fileMode = 'a+'
+
     def __init__(self, session, name, title=None, num=None, create=False):
         self.parent = session.parent
         self.name = name
         file_base = os.path.join(session.dir, dsEncode(name))
-        self.datafile = file_base + '.csv'
+        self.datafile = file_base + STORAGE_EXTENSIONS[self.storage]
         self.infofile = file_base + '.ini'
         self.file # create the datafile, but don't do anything with it
         self.listeners = set() # contexts that want to hear about added data
@@ -542,7 +575,7 @@ class Dataset:
         if it has not accessed for a while.
         """
         if not hasattr(self, '_file'):
-            self._file = open(self.datafile, 'a+') # append data
+            self._file = open(self.datafile, self.fileMode) # append data
             self._fileTimeoutCall = callLater(FILE_TIMEOUT, self._fileTimeout)
         else:
             self._fileTimeoutCall.reset(FILE_TIMEOUT)
@@ -698,42 +731,58 @@ class Dataset:
         
 
 class NumpyDataset(Dataset):
+    """Dataset which keeps its data in memory as a numpy array.
+
+    The rows are kept at the start of a larger buffer, self._data, whose
+    capacity is doubled when it fills up, so that adding rows one at a time
+    takes constant time on average.  The data property is a view of the
+    first self._rows rows of the buffer.
+    """
 
     def _get_data(self):
         """Read data from file on demand.
         
         The data is scheduled to be cleared from memory unless accessed."""
         if not hasattr(self, '_data'):
-            try:
-                # if the file is empty, this line can barf in certain versions
-                # of numpy.  Clearly, if the file does not exist on disk, this
-                # will be the case.  Even if the file exists on disk, we must
-                # check its size
-                if self._fileSize() > 0:
-                    self._data = numpy.loadtxt(self.file, delimiter=',')
-                else:
-                    self._data = numpy.array([[]])
-                if len(self._data.shape) == 1:
-                    self._data.shape = (1, len(self._data))
-            except ValueError:
-                # no data saved yet
-                # this error is raised by numpy <=1.2
-                self._data = numpy.array([[]])
-            except IOError:
-                # no data saved yet
-                # this error is raised by numpy 1.3
-                self.file.seek(0)
-                self._data = numpy.array([[]])
+            self._data = self._loadData()
+            self._rows = len(self._data) if self._data.size > 0 else 0
             self._dataTimeoutCall = callLater(DATA_TIMEOUT, self._dataTimeout)
         else:
             self._dataTimeoutCall.reset(DATA_TIMEOUT)
-        return self._data
+        if not self._rows:
+            return numpy.array([[]])
+        return self._data[:self._rows]
 
     def _set_data(self, data):
         self._data = data
+        self._rows = len(data) if data.size > 0 else 0
         
     data = property(_get_data, _set_data)
     
+    def _loadData(self):
+        """Read all data from the datafile."""
+        try:
+            # if the file is empty, this line can barf in certain versions
+            # of numpy.  Clearly, if the file does not exist on disk, this
+            # will be the case.  Even if the file exists on disk, we must
+            # check its size
+            if self._fileSize() > 0:
+                data = numpy.loadtxt(self.file, delimiter=',')
+            else:
+                data = numpy.array([[]])
+            if len(data.shape) == 1:
+                data.shape = (1, len(data))
+        except ValueError:
+            # no data saved yet
+            # this error is raised by numpy <=1.2
+            data = numpy.array([[]])
+        except IOError:
+            # no data saved yet
+            # this error is raised by numpy 1.3
+            self.file.seek(0)
+            data = numpy.array([[]])
+        return data
+    
     def _saveData(self, data):
         f = self.file
         numpy.savetxt(f, data, fmt=DATA_FORMAT, delimiter=',')
@@ -741,7 +790,21 @@ class NumpyDataset(Dataset):
     
     def _dataTimeout(self):
         del self._data
+        del self._rows
         del self._dataTimeoutCall
+    
+    def _appendData(self, data):
+        """Append rows to the in-memory data, growing the buffer if needed."""
+        self.data # load existing data, if necessary
+        rows = self._rows + len(data)
+        if rows > len(self._data) or self._data.shape[1:] != data.shape[1:]:
+            capacity = max(rows, 2 * self._rows, MIN_BUFFER_ROWS)
+            buf = numpy.empty((capacity,) + data.shape[1:], dtype=float)
+            if self._rows:
+                buf[:self._rows] = self._data[:self._rows]
+            self._data = buf
+        self._data[self._rows:rows] = data
+        self._rows = rows
         
     def addData(self, data):
         varcount = len(self.independents) + len(self.dependents)
@@ -756,10 +819,7 @@ class NumpyDataset(Dataset):
             raise BadDataError(varcount, data.shape[-1])
         
         # append data to in-memory data
-        if self.data.size > 0:
-            self.data = numpy.vstack((self.data, data))
-        else:
-            self.data = data
+        self._appendData(data)
             
         # append data to file
         self._saveData(data)
@@ -792,9 +852,65 @@ class NumpyDataset(Dataset):
         else:
             self.listeners.add(context)
         
+
+class BinaryDataset(NumpyDataset):
+    """Dataset stored as fixed-width binary rows.
+
+    The datafile starts with a BINARY_HEADER, written along with the first
+    rows of data, followed by the rows as little-endian float64s.  Rows are
+    only ever appended, so the data is read back with a single read, and a
+    partial row at the end, left by a crash in the middle of a write, is
+    ignored.
+    """
+    storage = 'binary'
+    fileMode = 'a+b'
+
+    def _readHeader(self):
+        f = self.file
+        f.seek(0)
+        header = f.read(BINARY_HEADER.size)
+        if len(header) < BINARY_HEADER.size:
+            raise BadDatafileError(self.datafile)
+        magic, headerLen, cols = BINARY_HEADER.unpack(header)
+        if magic != BINARY_MAGIC or headerLen < BINARY_HEADER.size or not cols:
+            raise BadDatafileError(self.datafile)
+        return headerLen, cols
+
+    def _loadData(self):
+        """Read all data from the datafile."""
+        size = self._fileSize()
+        if size == 0:
+            return numpy.array([[]])
+        headerLen, cols = self._readHeader()
+        if cols != len(self.independents) + len(self.dependents):
+            raise BadDatafileError(self.datafile)
+        rows = (size - headerLen) // (8 * cols)
+        f = self.file
+        f.seek(headerLen)
+        data = numpy.fromfile(f, dtype='<f8', count=rows * cols)
+        return data.reshape((len(data) // cols, cols))
+
+    def _saveData(self, data):
+        f = self.file
+        if self._fileSize() == 0:
+            f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_HEADER.size, data.shape[1]))
+        f.write(numpy.asarray(data, dtype='<f8').tostring())
+        f.flush()
+
+
 if useNumpy:
     Dataset = NumpyDataset
 
+def datasetClass(storage):
+    """Get the dataset class for a storage format."""
+    if storage not in STORAGE_EXTENSIONS:
+        raise BadStorageError(storage)
+    if storage == 'binary':
+        if not useNumpy:
+            raise Exception('Binary datasets need numpy.')
+        return BinaryDataset
+    return Dataset
+
 
 class DataVault(LabradServer):
     name = 'Data Vault'
@@ -802,7 +918,7 @@ class DataVault(LabradServer):
     @inlineCallbacks
     def initServer(self):
         # load configuration info from registry
-        global DATADIR
+        global DATADIR, STORAGE
         try:
             path = ['', 'Servers', self.name, 'Repository']
             nodename = util.getNodeName()
@@ -848,6 +964,20 @@ class DataVault(LabradServer):
                 print "Press [Enter] to continue..."
                 raw_input()
                 sys.exit()
+        # load the storage format for new datasets, if set
+        try:
+            p = reg.packet()
+            p.cd(path)
+            p.get('Storage', False, STORAGE)
+            ans = yield p.send()
+            storage = ans.get.lower()
+            datasetClass(storage) # check that the format is known
+            STORAGE = storage
+        except BadStorageError, E:
+            print E.msg, "Check the 'Storage' key at", path
+        except Exception, E:
+            print "Could not read the 'Storage' key at", path, E
+        print 'Storing new datasets as', STORAGE
         # create root session
         root = Session([''], self)
 
@@ -979,7 +1109,7 @@ class DataVault(LabradServer):
         Returns the path and name for this dataset.
         """
         session = self.getSession(c)
-        dataset = session.newDataset(name or 'untitled', independents, dependents)
+        dataset = session.newDataset(name or 'untitled', independents, dependents, c.get('storage'))
         c['dataset'] = dataset.name # not the same as name; has number prefixed
         c['filepos'] = 0 # start at the beginning
         c['commentpos'] = 0
@@ -1003,6 +1133,22 @@ class DataVault(LabradServer):
         dataset.keepStreamingComments(c.ID, 0)
         return c['path'], c['dataset']
     
+    @setting(11, storage='s', returns='s')
+    def storage(self, c, storage=None):
+        """Get or set the storage format for datasets created in this context.
+
+        The format is 'csv' for text, which is what older datasets use, or
+        'binary' for float64 rows, which are smaller, keep full precision and
+        are much faster to read.  The default is set for the repository by
+        the 'Storage' key next to the repository location in the registry.
+        Datasets which are opened are read in whatever format they have.
+        """
+        if storage is not None:
+            storage = storage.lower()
+            datasetClass(storage) # check that the format is usable
+            c['storage'] = storage
+        return c.get('storage', STORAGE)
+
     @setting(20, data=['*v: add one row of data',
                        '*2v: add multiple rows of data'],
                  returns='')
@@ -132,17 +132,50 @@ def getChoice(keys):
     return r
 
 
-def allBringups(fpga,boards):
+def bringupOkay(resp):
+    """Check the results of bringing up a DAC board (from dac_bringup or bringup_all)."""
+    okay = []
+    for dacdata in resp:
+        dacdict = dict(dacdata)
+        okay.append(dacdict['fifoSuccess'])
+        okay.append(dacdict['bistSuccess'])
+    return all(okay)
+
+
+def allBringups(fpga, boards, group=None):
+    """Bring up all boards.
+    
+    If a board group is given, all its boards are first brought up at once
+    by the server, starting from the parameters found in their last
+    bringup, and only boards that fail are retried one at a time.
+    """
     dacFails = []
     dacIssues = {}
-    for boardSelection in boards:
-        board = boardSelection[1]
-        print 'Bringing up %s...' % board
+    groupResults = {}
+    if group is not None:
+        print 'Bringing up all boards in %s...' % group
         try:
-            results = bringupBoard(fpga, board, fullOutput=True, printOutput=False)
+            for board, success, error, resp in fpga.bringup_all(group):
+                if success:
+                    groupResults[board] = resp
+                else:
+                    print '%s: %s' % (board, error)
         except Exception, e:
-            dacFails.append(board)
             print e
+    for boardSelection in boards:
+        board = boardSelection[1]
+        if board in groupResults:
+            if bringupOkay(groupResults[board]):
+                continue
+            results = ['DAC', groupResults[board], False]
+        else:
+            print 'Bringing up %s...' % board
+            try:
+                results = bringupBoard(fpga, board, fullOutput=True, printOutput=False)
+            except Exception, e:
+                dacFails.append(board)
+                print e
+                continue
         if results[0] == 'DAC':
             tries = 1
             while (tries < NUM_TRIES) and (not results[2]):
@@ -150,7 +183,7 @@ def allBringups(fpga,boards):
                 tries += 1
                 dacIssues[board] = tries
             if not results[2]:
-                dacIssues.pop(board)
+                dacIssues.pop(board, None)
                 dacFails.append(board)
     print
     print
@@ -271,7 +304,10 @@ def doBringup():
             if boardSelect is None:
                 break
             elif boardSelect == 'All':
-                allBringups(fpga,boards)
+                if group in fpga.list_board_groups():
+                    allBringups(fpga, boards, group)
+                else:
+                    allBringups(fpga, boards)
             else:
                 board = boardSelect[1]
                 interactiveBringup(fpga, board)
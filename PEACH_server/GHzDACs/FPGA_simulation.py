@@ -17,7 +17,7 @@
 ### BEGIN NODE INFO
 [info]
 name = FPGA Simulation
-version = 1.0.0
+version = 1.1.0
 description = Simulate ethernet communication with FPGA boards
 
 [startup]
@@ -30,160 +30,705 @@ timeout = 5
 ### END NODE INFO
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-
-from labrad.types import Error
-from labrad.server import LabradServer, setting
+# +DOCUMENTATION
+#
+# The simulation server is a direct ethernet proxy (see direct_ethernet_proxy)
+# with emulated GHz DAC and ADC boards attached to its adapters. The boards
+# are taken from the board groups for the 'FPGA Simulation' server in the
+# GHz FPGAs registry directory, for example
+#   ('Sim', 'FPGA Simulation', 0, [('DAC 1', 0), ('DAC 2', 0), ('ADC 1', 0)])
+# so that the FPGA server finds them like real hardware. The port of each
+# group is the adapter id. The board hardware parameters are read from the
+# dacBuildN and adcBuildN keys, defaulting to DAC_BUILD_PARAMS and
+# ADC_BUILD_PARAMS below (the FPGA server needs these keys to exist).
+#
+# The boards decode the same packets as the hardware:
+#   DAC register packets - start mode, readback, reps, page, daisychain role
+#       and serial/I2C commands. Run commands stream timing data packets.
+#   DAC SRAM and memory packets - stored and used when running.
+#   ADC register packets - ping, serial, recalibrate and the average and
+#       demodulation run modes.
+#   ADC SRAM packets - filter function and trig lookup tables.
+#
+# Runs are paced by the daisychain. When the master DAC gets its run command
+# every armed board on the same adapter starts. The length of one rep is the
+# duration of the master's memory sequence, and data is sent back to the
+# server in chunks of TIMING_PACKET_LEN reps at the rate the hardware would,
+# scaled by the timeScale of the chain (0 sends everything immediately).
+#
+# Each DAC serial channel has a small model of the DAC chip so that the LVDS,
+# FIFO and BIST calibrations work: the LVDS check bit is set while MSD and MHD
+# are within the setup and hold margins of the board, the FIFO counter
+# depends on the PHOF and clock polarity, and BIST checksums are computed
+# from the SRAM data when the SRAM is run.
+#
+# The boards can also be emulated in a separate process, linked to the
+# server over a local datagram socket (see ethernet_transport):
+#   python FPGA_simulation.py --emulate udp:127.0.0.1:7101,udp:127.0.0.1:7100
+#       --boards "DAC 1,DAC 2,ADC 1"
+#   python FPGA_simulation.py --link udp:127.0.0.1:7100,udp:127.0.0.1:7101
+# The first command runs the boards without a LabRAD connection; the second
+# runs the server with adapter sim0 linked to them. The time scale of remote
+# boards is set with --time-scale when they are started.
 
 import numpy as np
 
-DAC_SRAM_LEN = 10240 #words
-DAC_SRAM_PAGE_LEN = 256 #words
-DAC_SRAM_PAGES = DAC_SRAM_LEN/DAC_SRAM_PAGE_LEN
-DAC_SRAM_DTYPE = np.uint8
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+from labrad.server import setting
+
+import dac
+import adc
+from direct_ethernet_proxy import DirectEthernetProxy, EthernetAdapter
+from ethernet_transport import DatagramTransport, TransportAdapter
+
+DAC_BUILD = 13
+ADC_BUILD = 1
+
+DAC_BUILD_PARAMS = {
+    'SRAM_LEN': 10240,
+    'SRAM_PAGE_LEN': 5120,
+    'SRAM_DELAY_LEN': 1024,
+    'SRAM_BLOCK0_LEN': 8192,
+    'SRAM_BLOCK1_LEN': 2048,
+    'SRAM_WRITE_PKT_LEN': 256,
+}
+
+ADC_BUILD_PARAMS = {
+    'DEMOD_CHANNELS': 4,
+    'DEMOD_CHANNELS_PER_PACKET': 11,
+    'DEMOD_PACKET_LEN': 46,
+    'DEMOD_TIME_STEP': 2,
+    'AVERAGE_PACKETS': 32,
+    'AVERAGE_PACKET_LEN': 1024,
+    'TRIG_AMP': 255,
+    'LOOKUP_TABLE_LEN': 256,
+    'FILTER_LEN': 4096,
+    'SRAM_WRITE_DERPS': 9,
+    'SRAM_WRITE_PKT_LEN': 1024,
+}
+
+SRAM_PACKET_LEN = 1026
+MEM_PACKET_LEN = 769
+DEMOD_PACKET_BYTES = 48
+
+CYCLE_TIME = 40e-9 # seconds per memory clock cycle (25 MHz)
+SRAM_WORDS_PER_CYCLE = 40 # SRAM runs at 1 GHz
+DEMOD_SHIFT = 16 # bits dropped from the demodulator accumulators
+
+DEFAULT_BOARDS = [[('DAC', 1), ('DAC', 2), ('ADC', 1)]]
+
+
+def sequenceTiming(cmds, blockDelay=0, delayLen=1024):
+    """Emulate one rep of a memory sequence.
+
+    Returns the timer values (in memory cycles) for each start/stop
+    pair, the number of cycles in one rep and a list of the
+    (start, end) SRAM addresses called.
+    """
+    cycles = 0
+    timerStart = 0
+    timers = []
+    calls = []
+    sramStart = sramEnd = 0
+    for cmd in cmds:
+        opcode, address = dac.getOpcode(cmd), dac.getAddress(cmd)
+        if opcode == 0x3:
+            cycles += address + 1
+        elif opcode == 0x4:
+            if address == 0:
+                timerStart = cycles
+            elif address == 1:
+                timers.append(cycles - timerStart)
+            cycles += 1
+        elif opcode == 0x8:
+            sramStart = address
+            cycles += 1
+        elif opcode == 0xA:
+            sramEnd = address
+            cycles += 1
+        elif opcode == 0xC:
+            words = sramEnd - sramStart + 1 + blockDelay * delayLen
+            cycles += max(words // SRAM_WORDS_PER_CYCLE, 1)
+            calls.append((sramStart, sramEnd))
+        elif opcode == 0xF:
+            cycles += 2
+            break
+        else:
+            cycles += 1
+    return np.array(timers, dtype='<u2'), cycles, calls
+
+
+class DaisyChain(object):
+    """Start signal shared by the boards on one simulated adapter.
+
+    Boards that get a daisychain run command are armed. When the master
+    starts, it and every armed board run together, emitting their data
+    one chunk of reps at a time.
+    """
+    def __init__(self, timeScale=1.0):
+        self.timeScale = timeScale
+        self.boards = []
+        self.runId = 0
+
+    def start(self, master, reps, repCycles):
+        self.runId += 1
+        runId = self.runId
+        boards = [master] + [b for b in self.boards if b.armed and b is not master]
+        for b in boards:
+            b.armed = False
+            b.begin()
+        chunk = dac.TIMING_PACKET_LEN
+        chunkTime = chunk * max(repCycles, 1) * CYCLE_TIME * self.timeScale
+        nChunks = (reps + chunk - 1) // chunk
+        for i in range(nChunks):
+            n = min(chunk, reps - i * chunk)
+            last = (i == nChunks - 1)
+            reactor.callLater((i + 1) * chunkTime, self._emit, runId, boards, n, last)
+        if not nChunks:
+            reactor.callLater(0, self._emit, runId, boards, 0, True)
+
+    def _emit(self, runId, boards, n, last):
+        if runId != self.runId:
+            return # superseded by a later run
+        for b in boards:
+            b.emitReps(n)
+            if last:
+                b.finish()
+
 
 class FPGAWrapper(object):
-    def __init__(self):
-        pass
+    """An emulated FPGA board attached to a simulated ethernet adapter.
+
+    The board listens for packets sent to its MAC address (its
+    dispatchKey on the adapter) and replies to whichever MAC sent the
+    last packet.
+    """
+    macFor = None
+
+    def __init__(self, board, adapter, chain, build, buildParams):
+        self.board = board
+        self.mac = self.macFor(board)
+        self.dispatchKey = (None, self.mac, None)
+        self.adapter = adapter
+        self.chain = chain
+        self.build = build
+        self.buildParams = dict(buildParams)
+        self.host = adapter.mac
+        self.armed = False
+        self.pllLocked = True
+        self.packetCount = 0
+        adapter.addListener(self)
+        chain.boards.append(self)
+
+    def __call__(self, pkt):
+        src, dest, typ, data = pkt
+        if dest != self.mac:
+            return
+        self.host = src
+        try:
+            self.handle_packet(np.asarray(data, dtype='uint8'))
+        except Exception, e:
+            # the hardware silently ignores bad packets
+            print '%s: ignoring packet: %s' % (self.mac, e)
+
+    def send(self, data):
+        """Send a packet from this board back to the host."""
+        self.packetCount += 1
+        self.adapter.send((self.mac, self.host, -1, np.asarray(data, dtype='uint8')))
+
+    def handle_packet(self, packet):
+        raise NotImplementedError
+
+    def begin(self):
+        """Start a run triggered by the daisychain."""
+
+    def emitReps(self, n):
+        """Send the data for the next n reps of the current run."""
+
+    def finish(self):
+        """Send any data left at the end of the current run."""
+
 
 class DACWrapper(FPGAWrapper):
     """ Represents a GHzDAC board.
     ATTRIBUTES
     sram - numpy array representing the board's SRAM.
         each element is of type <u4, meaning little endian, four bytes.
+    memory - list of numpy arrays of memory commands, one per page.
+    registers - dict of DAC chip registers for each serial channel.
     """
-    def __init__(self):
-        self.sram = np.zeros(DAC_SRAM_LEN, dtype=DAC_SRAM_DTYPE)
-        self.register = np.zeros(DAC_REG_BYTES)
+    macFor = staticmethod(dac.macFor)
+
+    def __init__(self, board, adapter, chain, build=DAC_BUILD, buildParams=DAC_BUILD_PARAMS,
+                 setupMargin=3, holdMargin=9, fifoOffset=1):
+        FPGAWrapper.__init__(self, board, adapter, chain, build, buildParams)
+        self.sram = np.zeros(self.buildParams['SRAM_LEN'], dtype='<u4')
+        self.memory = [np.zeros(dac.MEM_PAGE_LEN, dtype='<u4') for _ in range(dac.MEM_LEN / dac.MEM_PAGE_LEN)]
+        self.registers = {2: {}, 3: {}}
+        self.clockInvert = {2: False, 3: False}
+        self.bist = {2: [0, 0], 3: [0, 0]}
+        self.serDAC = 0
+        self.i2cBytes = np.zeros(8, dtype='uint8')
+        self.setupMargin = setupMargin
+        self.holdMargin = holdMargin
+        self.fifoOffset = fifoOffset
+        self.run = None
+        self.pending = np.zeros(0, dtype='<u2')
 
     def handle_packet(self, packet):
         """Handle an incoming ethernet packet to this board"""
-        if len(packet) == DAC_SRAM_PACKET_LENGTH:
+        if len(packet) == SRAM_PACKET_LEN:
             self.handle_sram_packet(packet)
-        elif len(packet) == REG_PACKET_LENGTH:
+        elif len(packet) == MEM_PACKET_LEN:
+            self.handle_memory_packet(packet)
+        elif len(packet) == dac.REG_PACKET_LEN:
             self.handle_register_packet(packet)
         else:
-            raise Exception('GHzDAC packet length not appropriate for register or SRAM')
+            raise Exception('GHzDAC packet length not appropriate for register, memory or SRAM')
 
     def handle_sram_packet(self, packet):
         """Stores SRAM data from a packet in the device's SRAM.
 
-        PARAMETERS
-        packet - numpy array of 
-
         SRAM packets have 256 words, each word is 32 bits long (4 bytes)
         One word represents 1 ns of sequence data.
         Each word has 14 bits for each DAC channel, plus four bits for the four ECL triggers (=32 bits).
         Each byte has the following form:
             bits[13..0] = DACA[13..0] D/A converter A
-            bits[13..0] = DACB[13..0] D/A converter B
+            bits[27..14] = DACB[13..0] D/A converter B
             bits[31..28]= SERIAL[3..0] ECL serial output
+        The first two bytes of the packet give the derp being written.
         """
-        
-        
+        derp = int(packet[0]) + (int(packet[1]) << 8)
+        n = self.buildParams['SRAM_WRITE_PKT_LEN']
+        if (derp + 1) * n > len(self.sram):
+            raise Exception('SRAM derp out of range: %d' % derp)
+        self.sram[derp*n:(derp+1)*n] = np.fromstring(packet[2:].tostring(), dtype='<u4')
+
+    def handle_memory_packet(self, packet):
+        """Stores memory commands from a packet in the given memory page.
+
+        The first byte is the page, followed by 256 24-bit commands.
+        """
+        page = int(packet[0])
+        b = packet[1:].astype('<u4')
+        self.memory[page] = b[0::3] | (b[1::3] << 8) | (b[2::3] << 16)
+
+    def handle_register_packet(self, regs):
+        start, readback = int(regs[0]), int(regs[1])
+        if regs[46] & 0x80:
+            self.pllLocked = True # PLL reset
+        for chan, op, bit in [(4, 2, 0), (5, 3, 1)]:
+            if regs[46] & (1 << chan):
+                self.clockInvert[op] = bool(regs[46] & (1 << bit))
+        if regs[47]:
+            data = int(regs[48]) + (int(regs[49]) << 8) + (int(regs[50]) << 16)
+            self.serial(int(regs[47]), data)
+        if readback == 2:
+            self.i2c(regs)
+
+        mode = start & 0x7F
+        if mode == 1:
+            page = start >> 7
+            reps = int(regs[13]) + (int(regs[14]) << 8)
+            self.run = (page, reps, int(regs[19]))
+            role = int(regs[43])
+            if role == 0:
+                timers, repCycles, calls = self.sequence()
+                self.chain.start(self, reps, repCycles)
+            elif role == 1:
+                self.armed = True
+        elif mode in [3, 4]:
+            startAddr = int(regs[13]) + (int(regs[14]) << 8) + (int(regs[15]) << 16)
+            endAddr = int(regs[16]) + (int(regs[17]) << 8) + (int(regs[18]) << 16)
+            self.runSram(startAddr, endAddr)
+        if int(regs[43]) == 3:
+            self.armed = False # idle
+
+        if readback in [1, 2]:
+            self.send(self.readback())
+
+    def readback(self):
+        a = np.zeros(dac.READBACK_LEN, dtype='uint8')
+        a[51] = self.build
+        a[56] = self.serDAC & 0xFF
+        a[58] = 0 if self.pllLocked else 0x80
+        a[62:70] = self.i2cBytes[::-1]
+        return a
+
+    def i2c(self, regs):
+        """I2C transactions read back zeros, except for written bytes."""
+        n = 8
+        while n > 0 and not (regs[2] & (1 << (8 - n))):
+            n -= 1
+        data = regs[12:12-n:-1] if n else []
+        read = int(regs[3])
+        self.i2cBytes[:] = 0
+        for i, d in enumerate(data):
+            if not read & (1 << (7 - i)):
+                self.i2cBytes[8-n+i] = d
+
+    def serial(self, op, data):
+        """Run a serial command, setting serDAC to the result."""
+        self.serDAC = 0
+        if op not in self.registers:
+            if op == 1:
+                self.pllLocked = True
+            return
+        regs = self.registers[op]
+        addr = (data >> 8) & 0x1F
+        if not data & 0x8000:
+            regs[addr] = data & 0xFF
+            return
+        if addr == 0x05:
+            self.serDAC = self.lvdsCheck(regs)
+        elif addr == 0x07:
+            self.serDAC = self.fifoCounter(op, regs) << 4
+        elif 0x12 <= addr <= 0x15:
+            which = (regs.get(0x11, 0) >> 6) & 3
+            word = self.bist[op][which % 2]
+            self.serDAC = (word >> (8 * (0x15 - addr))) & 0xFF
+        else:
+            self.serDAC = regs.get(addr, 0)
+
+    def lvdsCheck(self, regs):
+        """LVDS check bit for the current MSD, MHD and SD."""
+        msd, mhd = (regs.get(0x04, 0) >> 4) & 0xF, regs.get(0x04, 0) & 0xF
+        sd = (regs.get(0x05, 0) >> 4) & 0xF
+        setup = min(max(self.setupMargin + sd, 0), 14)
+        hold = min(max(self.holdMargin - sd, 0), 14)
+        return int(msd <= setup and mhd <= hold)
+
+    def fifoCounter(self, op, regs):
+        """FIFO counter for the current PHOF and clock polarity."""
+        phof = regs.get(0x07, 0) & 0x3
+        return (phof + self.fifoOffset + 2 * self.clockInvert[op]) % 4 + 2
+
+    def runSram(self, startAddr, endAddr):
+        """Run SRAM once, computing the BIST checksums for both DACs."""
+        data = self.sram[startAddr:endAddr+1]
+        if len(data) % 2:
+            data = np.hstack((data, [0]))
+        # the BIST skips the four zero words at the start of the sequence
+        data = data[4:]
+        for op, shift in [(2, 0), (3, 14)]:
+            words = [int(w) for w in (data >> shift) & 0x3FFF]
+            self.bist[op] = dac.bistChecksum(words)
+
+    def sequence(self):
+        page, reps, blockDelay = self.run
+        return sequenceTiming(self.memory[page], blockDelay, self.buildParams['SRAM_DELAY_LEN'])
+
+    def begin(self):
+        self.timers = self.sequence()[0]
+        self.remaining = self.run[1]
+        self.pending = np.zeros(0, dtype='<u2')
+
+    def emitReps(self, n):
+        """Send timing packets, once TIMING_PACKET_LEN results are ready."""
+        n = min(n, self.remaining)
+        self.remaining -= n
+        if not len(self.timers) or not n:
+            return
+        self.pending = np.hstack((self.pending, np.tile(self.timers, n)))
+        while len(self.pending) >= dac.TIMING_PACKET_LEN:
+            values = self.pending[:dac.TIMING_PACKET_LEN]
+            self.pending = self.pending[dac.TIMING_PACKET_LEN:]
+            pkt = np.zeros(dac.READBACK_LEN, dtype='uint8')
+            pkt[0:3] = [(self.packetCount >> s) & 0xFF for s in (0, 8, 16)]
+            pkt[3:63] = np.fromstring(values.astype('<u2').tostring(), dtype='uint8')
+            self.send(pkt)
+
+
 class ADCWrapper(FPGAWrapper):
-    pass
-        
-class FPGASimulationServer(LabradServer):
-
-    @setting(10, 'adapters', returns='*(ws)')
-    def adapters(self, c):
-        """Retrieves a list of network adapters"""
-        adapterList = [(0, 'nothing'),(1, 'here')]
-        return adapterList
-
-    @setting(11, 'clear', returns='')
-    def clear(self, c):
-        #Clear all pending packets out of the buffer.
-        #Are the packets to write or packets to read?
-        pass
-
-    @setting(12, 'collect', num = '*i', returns = '')
-    def collect(self, c, num):
-        if num is None:
-            #User did not specify number to collect. Wait for one packet
-            num = 1
-        return num
-
-    @setting(13, 'connect', key=['s: Select device by name',
-                                 'w: Select device by ID'],
-             returns = 's: Adapter name')
-    def connect(self, c, key):
-        raise Exception
-
-    @setting(14, 'Destination MAC', mac=['s: Destination MAC as 01:23:45:67:89:AB',
-                                         '(wwwwww): MAC as individual numbers'],
-             returns = 's')
-    def destination_mac(self, c, mac):
-        raise Exception
-
-    @setting(15, 'Discard', num=[': Discard one packet',
-                                 'w: Discard this many packets'],
-             returns = '')
-    def discard(self, c, num):
-        raise Exception
-
-    @setting(16, "Ether Type", returns='')
-    def ether_type(self, c):
-        raise Exception
-
-    @setting(17, 'Listen', returns='')
-    def listen(self,c):
-        """Starts listening for SRAM packets"""
-        raise Exception
-
-    @setting(18, 'Read', num=[': Read one packet (returns (ssis))',
-                              'w: Read this many packets (returns *(ssis))'],
-             returns=['(ssis): Source MAC, Destination MAC, Ether Type (-1 for IEEE 802.3, and Data of received packet',
-                      '*(ssis): List of above'])
-    def read(self, c, num):
-        raise Exception
-
-    @setting(19, 'Read as Words', num=[': Read one packet (returns (ssi*w))',
-                              'w: Read this many packets (returns *(ssi*w))'],
-             returns=['(ssi*w): Source MAC, Destination MAC, Ether Type (-1 for IEEE 802.3, and Data of received packet',
-                      '*(ssi*w): List of above'])
-    def read_as_words(self, c, num):
-        raise Exception
-
-
-    @setting(20, 'Reject Content', pattern=['(ws): Offset,data',
-                                            '(w*w): Offset, data'],
-             returns='')
-    def reject_content(self, c):
-        """If the packet content matches, the packet will be rejected."""
-        raise Exception
-    
-    @setting(21, 'Reject Destination MAC', mac=['s: MAC in string form: 01:23:45:67:89:AB',
-                                                '(wwwwww): MAC as individual numbers'],
-             returns='s')
-    def reject_destination_mac(self, c, mac):
-        raise Exception
-
-    @setting(22, 'Require Source MAC', mac=['s: MAC in string form: 01:23:45:67:89:AB',
-                                            '(wwwwww): MAC as individual numbers'],
-             returns='s')
-    def require_source_mac(self, c, mac):
-        raise Exception
-
-    @setting(23, 'Send Trigger', context='(w,w): Target context', returns='')
-    def send_trigger(self, c, context):
-        raise Exception
-
-    @setting(24, 'Source MAC', mac=[': Use adapter MAC as default',
-                                    's: Source MAC as 01:23:45:67:89:AB',
-                                    'w: Source MAC as individual numbers'],
-             returns='s')
-    def source_mac(self, c, mac):
-        raise Exception
-
-    @setting(25, 'Wait For Trigger', num=[': Wait for one trigger', 'w: Wait for this number of triggers'],
-             returns = 'v[s]: Elapsed wait time')
-    def wait_for_trigger(self, c, num):
-        raise Exception
-
-    @setting(26, 'Write', data=['s: Send data as one packet', '*w: Same, except data is specified as an array of words'],
-             returns='')
-    def write(self, c, data):
-        raise Exception
+    """Represents a GHz ADC board.
+
+    The input signal is a tone at signalFreq (MHz) with the given amplitude
+    in ADC counts on both I and Q, plus gaussian noise. Noise comes from a
+    random generator seeded by the board number so runs are repeatable.
+    """
+    macFor = staticmethod(adc.macFor)
+
+    def __init__(self, board, adapter, chain, build=ADC_BUILD, buildParams=ADC_BUILD_PARAMS,
+                 signalFreq=50.0, amplitude=64.0, noise=4.0):
+        FPGAWrapper.__init__(self, board, adapter, chain, build, buildParams)
+        p = self.buildParams
+        self.filter = np.zeros(p['FILTER_LEN'], dtype='uint8')
+        self.lookups = np.zeros((p['DEMOD_CHANNELS'], 2, p['LOOKUP_TABLE_LEN']), dtype='uint8')
+        self.signalFreq = signalFreq
+        self.amplitude = amplitude
+        self.noise = noise
+        self.random = np.random.RandomState(board)
+        self.mode = None
+
+    def handle_packet(self, packet):
+        if len(packet) == SRAM_PACKET_LEN:
+            self.handle_sram_packet(packet)
+        elif len(packet) == adc.REG_PACKET_LEN:
+            self.handle_register_packet(packet)
+        else:
+            raise Exception('GHzADC packet length not appropriate for register or SRAM')
+
+    def handle_sram_packet(self, packet):
+        """Store the filter function (derps 0-3) or trig lookup tables.
+
+        Each lookup derp holds cosine and sine tables for two channels.
+        """
+        derp = int(packet[0]) + (int(packet[1]) << 8)
+        n = self.buildParams['SRAM_WRITE_PKT_LEN']
+        data = packet[2:2+n]
+        filterDerps = len(self.filter) // n
+        if derp < filterDerps:
+            self.filter[derp*n:(derp+1)*n] = data
+        else:
+            tables = data.reshape(2, 2, -1)
+            ch = 2 * (derp - filterDerps)
+            for ofs in [0, 1]:
+                if ch + ofs < len(self.lookups):
+                    self.lookups[ch+ofs] = tables[ofs]
+
+    def handle_register_packet(self, regs):
+        mode = int(regs[0])
+        if mode == 1:
+            a = np.zeros(adc.READBACK_LEN, dtype='uint8')
+            a[0] = self.build
+            a[1] = 0 if self.pllLocked else 1
+            self.send(a)
+        elif mode in [adc.RUN_MODE_AVERAGE_AUTO, adc.RUN_MODE_AVERAGE_DAISY,
+                      adc.RUN_MODE_DEMOD_AUTO, adc.RUN_MODE_DEMOD_DAISY]:
+            self.mode = mode
+            self.reps = int(regs[7]) + (int(regs[8]) << 8)
+            self.filterEnd = int(regs[9]) + (int(regs[10]) << 8)
+            self.stretchAt = int(regs[11]) + (int(regs[12]) << 8)
+            self.stretchLen = int(regs[13]) + (int(regs[14]) << 8)
+            self.demods = []
+            for i in range(self.buildParams['DEMOD_CHANNELS']):
+                addr = 15 + 4*i
+                dPhi = int(regs[addr]) + (int(regs[addr+1]) << 8)
+                phi0 = int(regs[addr+2]) + (int(regs[addr+3]) << 8)
+                self.demods.append((dPhi, phi0))
+            if mode in [adc.RUN_MODE_AVERAGE_AUTO, adc.RUN_MODE_DEMOD_AUTO]:
+                self.begin()
+                self.emitReps(self.reps)
+                self.finish()
+            else:
+                self.armed = True
+        # serial (6) and recalibrate/calibrate (7) have no response
+
+    def signal(self, n):
+        """I and Q input samples for the first n demodulation time steps."""
+        t = np.arange(n) * self.buildParams['DEMOD_TIME_STEP'] * 1e-9
+        phase = 2 * np.pi * self.signalFreq * 1e6 * t
+        return self.amplitude * np.cos(phase), self.amplitude * np.sin(phase)
+
+    def filterWeights(self):
+        """Filter weight for each demodulation time step, after stretching.
+
+        Each filter byte covers 4ns, that is two demodulation steps.
+        """
+        f = self.filter[:self.filterEnd+1].astype(float)
+        at = min(self.stretchAt, len(f) - 1)
+        f = np.hstack((f[:at+1], np.repeat(f[at:at+1], self.stretchLen), f[at+1:]))
+        return np.repeat(f, 2)
+
+    def begin(self):
+        self.armed = False
+        self.remaining = self.reps
+        self.sent = 0
+        if self.mode in [adc.RUN_MODE_AVERAGE_AUTO, adc.RUN_MODE_AVERAGE_DAISY]:
+            return
+        w = self.filterWeights()
+        I, Q = self.signal(len(w))
+        steps = np.arange(len(w))
+        self.ideal = []
+        self.sigma = []
+        for ch, (dPhi, phi0) in enumerate(self.demods):
+            cosAmp = float(self.lookups[ch, 0].max())
+            sinAmp = float(self.lookups[ch, 1].max())
+            phi = 2 * np.pi * ((phi0 + dPhi * steps) % 0x10000) / 0x10000
+            c, s = cosAmp * np.cos(phi), sinAmp * np.sin(phi)
+            Iout = np.sum(w * (I * c + Q * s)) / 2**DEMOD_SHIFT
+            Qout = np.sum(w * (Q * c - I * s)) / 2**DEMOD_SHIFT
+            self.ideal.append((Iout, Qout))
+            amp = max(cosAmp, sinAmp)
+            self.sigma.append(self.noise * amp * np.sqrt(np.sum(w**2)) / 2**DEMOD_SHIFT)
+        peak = self.amplitude + 3 * self.noise
+        rng = lambda x: int(np.clip(np.floor(x / 16.0), -8, 7)) & 0xF
+        self.ranges = [(rng(peak) << 4) | rng(-peak)] * 2
+
+    def emitReps(self, n):
+        """Send one demodulation packet per rep."""
+        n = min(n, self.remaining)
+        self.remaining -= n
+        if self.mode not in [adc.RUN_MODE_DEMOD_AUTO, adc.RUN_MODE_DEMOD_DAISY] or not n:
+            return
+        perPacket = self.buildParams['DEMOD_CHANNELS_PER_PACKET']
+        vals = np.zeros((n, perPacket, 2))
+        for ch, (Iout, Qout) in enumerate(self.ideal[:perPacket]):
+            noise = self.random.normal(0, self.sigma[ch] + 1e-12, (n, 2))
+            vals[:, ch, 0] = Iout + noise[:, 0]
+            vals[:, ch, 1] = Qout + noise[:, 1]
+        vals = np.clip(np.round(vals), -0x8000, 0x7FFF).astype('<i2')
+        pkts = np.zeros((n, DEMOD_PACKET_BYTES), dtype='uint8')
+        pkts[:, :4*perPacket] = np.fromstring(vals.tostring(), dtype='uint8').reshape(n, -1)
+        pkts[:, 46:48] = self.ranges
+        for pkt in pkts:
+            self.send(pkt)
+
+    def finish(self):
+        """Send the average buffer, summed over all reps."""
+        if self.mode not in [adc.RUN_MODE_AVERAGE_AUTO, adc.RUN_MODE_AVERAGE_DAISY]:
+            return
+        p = self.buildParams
+        n = p['AVERAGE_PACKETS'] * p['AVERAGE_PACKET_LEN'] / 4
+        I, Q = self.signal(n)
+        reps = max(self.reps, 1)
+        scale = self.noise * np.sqrt(reps)
+        trace = np.vstack((I * reps + self.random.normal(0, scale + 1e-12, n),
+                           Q * reps + self.random.normal(0, scale + 1e-12, n))).T
+        trace = np.clip(np.round(trace), -0x8000, 0x7FFF).astype('<i2')
+        data = np.fromstring(trace.tostring(), dtype='uint8')
+        for pkt in data.reshape(p['AVERAGE_PACKETS'], p['AVERAGE_PACKET_LEN']):
+            self.send(pkt)
+
+
+def makeBoard(kind, num, adapter, chain, dacParams=DAC_BUILD_PARAMS, adcParams=ADC_BUILD_PARAMS):
+    """Create an emulated 'DAC' or 'ADC' board on an adapter."""
+    if kind == 'DAC':
+        return DACWrapper(int(num), adapter, chain, buildParams=dacParams)
+    return ADCWrapper(int(num), adapter, chain, buildParams=adcParams)
+
+def emulate(link, boardList, timeScale=1.0):
+    """Emulate boards without a LabRAD connection.
     
+    The boards are attached to a TransportAdapter on the given link (see
+    ethernet_transport), whose peer is an adapter of a proxy server in
+    another process.  boardList is a list of (type, board number).
+    Returns the adapter and the boards.
+    """
+    adapter = TransportAdapter('emulator', '01:23:45:67:89:FF', DatagramTransport.fromLink(link))
+    chain = DaisyChain(timeScale)
+    boards = [makeBoard(kind, num, adapter, chain) for kind, num in boardList]
+    return adapter, boards
+
+
+class FPGASimulationServer(DirectEthernetProxy):
+    """Direct ethernet server with emulated GHz DAC and ADC boards.
+
+    boards is a dict mapping adapter id to a list of (type, board number)
+    with type 'DAC' or 'ADC'. If boards is None, the board groups for
+    this server are loaded from the registry when the server starts,
+    falling back to DEFAULT_BOARDS if there are none.
+
+    links is a dict mapping adapter id to a link (see ethernet_transport)
+    to boards emulated in another process, see emulate.
+    """
+    name = 'FPGA Simulation'
+
+    def __init__(self, boards=None, timeScale=1.0, links=None):
+        DirectEthernetProxy.__init__(self, [])
+        self.boardConfig = boards
+        self.timeScale = timeScale
+        self.links = links or {}
+        self.chains = []
+        self.boards = []
+
+    @inlineCallbacks
+    def initServer(self):
+        dacParams, adcParams = DAC_BUILD_PARAMS, ADC_BUILD_PARAMS
+        boards = self.boardConfig
+        if boards is None:
+            p = self.client.registry.packet()
+            p.cd(['', 'Servers', 'GHz FPGAs'], True)
+            p.get('boardGroups', False, [], key='boardGroups')
+            p.get('dacBuild%d' % DAC_BUILD, False, DAC_BUILD_PARAMS.items(), key='dacBuild')
+            p.get('adcBuild%d' % ADC_BUILD, False, ADC_BUILD_PARAMS.items(), key='adcBuild')
+            ans = yield p.send()
+            dacParams, adcParams = dict(ans['dacBuild']), dict(ans['adcBuild'])
+            boards = {}
+            for name, server, port, boardList in ans['boardGroups']:
+                if server != self.name:
+                    continue
+                boards[port] = [tuple(board.split(' ')) for board, delay in boardList]
+            if not boards:
+                boards = dict(enumerate(DEFAULT_BOARDS))
+        boards = dict(boards)
+        for port in self.links:
+            boards.setdefault(port, [])
+        self.addBoards(boards, dacParams, adcParams)
+
+    def addBoards(self, boards, dacParams=DAC_BUILD_PARAMS, adcParams=ADC_BUILD_PARAMS):
+        """Create an adapter with emulated boards for each entry in boards.
+        
+        Ports that are linked to another process get a TransportAdapter
+        and no boards, since the boards are emulated at the other end.
+        """
+        for port, boardList in sorted(boards.items()):
+            name, mac = 'sim%d' % port, '01:23:45:67:89:%02X' % port
+            if port in self.links:
+                adapter = TransportAdapter(name, mac, DatagramTransport.fromLink(self.links[port]))
+                boardList = []
+            else:
+                adapter = EthernetAdapter(name, mac)
+            chain = DaisyChain(self.timeScale)
+            for kind, num in boardList:
+                board = makeBoard(kind, num, adapter, chain, dacParams, adcParams)
+                self.boards.append((adapter.name, kind, board))
+            self.adapters[port] = self.adapters[adapter.name] = adapter
+            self.chains.append(chain)
+
+    @setting(1000, 'Boards', returns='*(sss)')
+    def list_boards(self, c):
+        """List the emulated boards as (adapter, type, MAC)."""
+        return [(name, kind, b.mac) for name, kind, b in self.boards]
+
+    @setting(1001, 'Time Scale', scale='v', returns='v')
+    def time_scale(self, c, scale=None):
+        """Get or set the factor applied to emulated run times.
+
+        1 runs in real time, 0 sends all data as soon as a run starts.
+        """
+        if scale is not None:
+            self.timeScale = float(scale)
+            for chain in self.chains:
+                chain.timeScale = self.timeScale
+        return self.timeScale
+
+    @setting(1002, 'ADC Signal', board='w', freq='v[MHz]', amplitude='v', noise='v', returns='')
+    def adc_signal(self, c, board, freq, amplitude, noise):
+        """Set the input tone and noise (in ADC counts) of an emulated ADC."""
+        mac = adc.macFor(board)
+        matches = [b for name, kind, b in self.boards if b.mac == mac]
+        if not matches:
+            raise Exception('No emulated ADC board %d' % board)
+        for b in matches:
+            b.signalFreq = float(freq)
+            b.amplitude = float(amplitude)
+            b.noise = float(noise)
+
+
+__server__ = FPGASimulationServer()
+
+if __name__ == '__main__':
+    import optparse
+    import sys
+    from labrad import util
+    parser = optparse.OptionParser(usage='usage: %prog [options]')
+    parser.add_option('--link', action='append', default=[], metavar='LOCAL,PEER',
+                      help='link the next adapter (sim0, sim1, ...) to boards emulated in another process')
+    parser.add_option('--emulate', metavar='LOCAL,PEER',
+                      help='only emulate boards, linked to a server at PEER, without connecting to LabRAD')
+    parser.add_option('--boards', default='DAC 1,DAC 2,ADC 1',
+                      help='comma separated boards to emulate with --emulate')
+    parser.add_option('--time-scale', type='float', default=1.0,
+                      help='emulated hardware time scale (0 = no hardware time)')
+    options, args = parser.parse_args()
+    if options.emulate:
+        boardList = [tuple(b.split()) for b in options.boards.split(',')]
+        emulate(options.emulate, boardList, options.time_scale)
+        reactor.run()
+    else:
+        sys.argv[1:] = args # leave the remaining options to labrad
+        links = dict(enumerate(options.link))
+        util.runServer(FPGASimulationServer(timeScale=options.time_scale, links=links))
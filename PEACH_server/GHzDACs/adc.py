@@ -1,3 +1,5 @@
+import hashlib
+
 import numpy as np
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -49,6 +51,10 @@ RUN_MODE_DEMOD_AUTO = 4
 RUN_MODE_DEMOD_DAISY = 5
 RUN_MODE_CALIBRATE = 7
 
+LOOKUP_CACHE_SIZE = 256 # trig lookup SRAM packets cached per board
+FILTER_CACHE_SIZE = 16 # filter functions whose SRAM packets are cached per board
+TONE_BANK_CACHE_SIZE = 32 # software demodulation banks, see toneBank
+
 def macFor(board):
     """Get the MAC address of an ADC board as a string."""
     return '00:01:CA:AA:01:' + ('0'+hex(int(board))[2:])[-2:].upper()
@@ -143,6 +149,9 @@ class AdcDevice(DeviceWrapper):
         self.devName = name
         self.serverName = de._labrad_name
         self.timeout = T.Value(1, 's')
+        self.sramPages = {} # page -> digest of the SRAM data last written there
+        self.lookupCache = {} # (page, trig keys) -> (digest, trig lookup SRAM packet)
+        self.filterCache = {} # filter hash -> [(page, digest, filter SRAM packet)]
 
         # set up our context with the ethernet server
         p = self.makePacket()
@@ -185,19 +194,65 @@ class AdcDevice(DeviceWrapper):
         """Create a new packet to be sent to the ethernet server for this device."""
         return self.server.packet(context=self.ctx)
     
-    def makeFilter(self, data, p):
-        """Update a packet for the ethernet server with SRAM commands to upload the filter function."""
+    def filterPackets(self, data):
+        """Create SRAM write packets (byte strings) to upload the filter function."""
+        pkts = []
         for page in range(4):
             start = self.buildParams['SRAM_WRITE_PKT_LEN'] * page
             end = start + self.buildParams['SRAM_WRITE_PKT_LEN']
             pkt = pktWriteSram(self, page, data[start:end])
-            p.write(pkt.tostring())
+            pkts.append(pkt.tostring())
+        return pkts
     
-    def makeTrigLookups(self, demods, p):
-        """Update a packet for the ethernet server with SRAM commands to upload Trig lookup tables."""
+    def filterPages(self, data, filterHash=None):
+        """Get the SRAM pages of a filter function as a list of (page, digest, packet).
+        
+        The pages are cached by the filter hash (see filterKey), so they
+        are only built and hashed again when the filter changes.
+        """
+        key = filterHash or filterKey(data)
+        cache = self.filterCache
+        # packets are prepared in worker threads, so another thread may clear
+        # the cache at any time; only look up each entry once
+        pages = cache.get(key)
+        if pages is None:
+            if len(cache) >= FILTER_CACHE_SIZE:
+                cache.clear()
+            pages = cache[key] = [(page, hashlib.sha1(pkt).digest(), pkt)
+                                  for page, pkt in enumerate(self.filterPackets(data))]
+        return pages
+    
+    def trigLookupPackets(self, demods):
+        """Create SRAM write packets (byte strings) to upload Trig lookup tables."""
+        return [pkt for page, digest, pkt in self.trigLookupPages(demods)]
+    
+    def trigLookupPages(self, demods):
+        """Get the SRAM pages of the Trig lookup tables as a list of (page, digest, packet).
+        
+        Packets and their digests are cached by page and the hashes of the
+        tables of the two channels in the page (see trigKey), so changing
+        one channel only builds one new packet.
+        """
+        pages = []
         page = 4
         channel = 0
+        cache = self.lookupCache
+        if len(cache) > LOOKUP_CACHE_SIZE:
+            cache.clear()
         while channel < self.buildParams['DEMOD_CHANNELS']:
+            key = [page]
+            for ch in [channel, channel + 1]:
+                if ch in demods:
+                    key.append(demods[ch].get('hash') or trigKey(demods[ch]))
+                else:
+                    key.append(None)
+            key = tuple(key)
+            entry = cache.get(key) # see filterPages
+            if entry is not None:
+                pages.append((page,) + entry)
+                channel += 2
+                page += 1
+                continue
             data = []
             for ofs in [0, 1]:
                 ch = channel + ofs
@@ -208,10 +263,24 @@ class AdcDevice(DeviceWrapper):
                         d = np.zeros(self.buildParams['LOOKUP_TABLE_LEN'], dtype='<u1')
                     data.append(d)
             data = np.hstack(data)
-            pkt = pktWriteSram(self, page, data)
-            p.write(pkt.tostring())            
+            pkt = pktWriteSram(self, page, data).tostring()
+            entry = cache[key] = (hashlib.sha1(pkt).digest(), pkt)
+            pages.append((page,) + entry)
             channel += 2 # two channels per sram packet
             page += 1 # each sram packet writes one page
+        return pages
+    
+    def makeFilter(self, data, p):
+        """Update a packet for the ethernet server with SRAM commands to upload the filter function."""
+        self.forgetPages()
+        for pkt in self.filterPackets(data):
+            p.write(pkt)
+    
+    def makeTrigLookups(self, demods, p):
+        """Update a packet for the ethernet server with SRAM commands to upload Trig lookup tables."""
+        self.forgetPages()
+        for pkt in self.trigLookupPackets(demods):
+            p.write(pkt)
     
     def collect(self, nPackets, timeout, triggerCtx):
         """Create a packet to collect data on the FPGA."""
@@ -230,27 +299,89 @@ class AdcDevice(DeviceWrapper):
     def read(self, nPackets):
         """Create a packet to read data from the FPGA."""
         return self.makePacket().read(nPackets)
+    
+    def readBulk(self, nPackets, start=0, end=None):
+        """Create a packet to read data from the FPGA as one byte string.
+        
+        The ethernet server trims each payload to bytes [start:end], or
+        keeps whole payloads if end is None, and returns (stride, data)
+        under the key 'read'.  Only servers that have a 'Read Bulk'
+        setting (see canReadBulk) support this.
+        """
+        args = (nPackets,) if end is None else (nPackets, start, end)
+        return self.makePacket().read_bulk(*args, key='read')
+    
+    def canReadBulk(self):
+        """Check whether our ethernet server can read packets in bulk."""
+        return 'Read Bulk' in self.server.settings
 
     def discard(self, nPackets):
         """Create a packet to discard data on the FPGA."""
         return self.makePacket().discard(nPackets)
 
-    def setup(self, filter, demods):
-        filterFunc, filterStretchLen, filterStretchAt = filter
-        p = self.makePacket()
-        self.makeFilter(filterFunc, p)
-        self.makeTrigLookups(demods, p)
-        amps = ''
+    def setupState(self, filterFunc, demods, filterHash=None):
+        """Get the setup state string for a filter function and trig lookup tables.
+        
+        The state is the device name and a fingerprint of the SRAM contents,
+        so it is short however long the filter is.  The filter hash and the
+        'hash' of each demod channel are used if given (they are computed
+        when the context settings change, see filterKey and trigKey),
+        otherwise they are computed here.
+        """
+        h = hashlib.sha1(filterHash or filterKey(filterFunc))
         for ch in xrange(self.buildParams['DEMOD_CHANNELS']):
             if ch in demods:
-                cosineAmp = demods[ch]['cosineAmp']
-                sineAmp = demods[ch]['sineAmp'] 
+                h.update(demods[ch].get('hash') or trigKey(demods[ch]))
             else:
-                cosineAmp = sineAmp = 0
-            amps += '%s,%s;' % (cosineAmp, sineAmp) 
-        setupState = '%s: filter=%s, trigAmps=%s' % (self.devName, filterFunc.tostring(), amps)
+                h.update('-')
+        return '%s: %s' % (self.devName, h.hexdigest())
+
+    def setupData(self, filter, demods, filterHash=None):
+        """Create the SRAM pages and setup state string for a sequence.
+        
+        The pages are a list of (page, digest, packet), where packet is the
+        SRAM write packet (a byte string) for the page.  This does not touch
+        any LabRAD packets, so it can be called from a worker thread to
+        prepare the setup ahead of time.
+        """
+        filterFunc, filterStretchLen, filterStretchAt = filter
+        pages = self.filterPages(filterFunc, filterHash) + self.trigLookupPages(demods)
+        return pages, self.setupState(filterFunc, demods, filterHash)
+
+    def changedPages(self, pages):
+        """Get the pages whose data differs from what was last written to the board."""
+        return [(page, digest, pkt) for page, digest, pkt in pages
+                if self.sramPages.get(page) != digest]
+
+    def setup(self, filter, demods, prepared=None):
+        """Create a packet to upload filter and trig lookups, and the setup state string.
+        
+        Only the SRAM pages that differ from those last written are
+        uploaded, so the packet is None if the board already has them all.
+        Call pagesWritten once the packet has been sent.  The result of
+        setupData can be passed in as prepared if the pages have already
+        been built.
+        """
+        if prepared is None:
+            prepared = self.setupData(filter, demods)
+        pages, setupState = prepared
+        changed = self.changedPages(pages)
+        if not changed:
+            return None, setupState
+        p = self.makePacket()
+        for page, digest, pkt in changed:
+            p.write(pkt)
         return p, setupState
 
+    def pagesWritten(self, pages):
+        """Record that SRAM pages from setupData have been written to the board."""
+        for page, digest, pkt in pages:
+            self.sramPages[page] = digest
+
+    def forgetPages(self):
+        """Forget what is in the SRAM pages, so that they are all written next time."""
+        self.sramPages = {}
+
     def clear(self, triggerCtx=None):
         """Create a packet to clear the ethernet buffer for this board."""
         p = self.makePacket().clear()
@@ -296,8 +427,8 @@ class AdcDevice(DeviceWrapper):
             yield self._sendRegisters(regs, readback=False)
     
     def testMode(self, func, *a, **kw):
-        """Run a func in test mode on our board group."""
-        return self.boardGroup.testMode(func, *a, **kw)
+        """Run a func in test mode on this board, see BoardGroup.boardTestMode."""
+        return self.boardGroup.boardTestMode([self.devName], func, *a, **kw)
     
     
     # chatty functions that require locking the device
@@ -310,10 +441,11 @@ class AdcDevice(DeviceWrapper):
         return self.testMode(func)
     
     def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-        return self.testMode(func)
+        return self.testMode(self._initPLL)
+    
+    @inlineCallbacks
+    def _initPLL(self):
+        yield self._runSerial([0x1FC093, 0x1FC092, 0x100004, 0x000C11])
     
     def queryPLL(self):
         @inlineCallbacks
@@ -323,6 +455,24 @@ class AdcDevice(DeviceWrapper):
             returnValue(processReadback(r)['noPllLatch'])
         return self.testMode(func)
 
+    def checkHealth(self):
+        """Check PLL lock and build number.
+        
+        Returns a dict like DacDevice.checkHealth, with no FIFO counters.
+        """
+        @inlineCallbacks
+        def func():
+            r = yield self._sendRegisters(regAdcPllQuery())
+            info = processReadback(r)
+            problems = []
+            if info['noPllLatch']:
+                problems.append('PLL unlocked')
+            if int(info['build']) != self.build:
+                problems.append('build %d, expected %d' % (info['build'], self.build))
+            returnValue({'build': int(info['build']), 'pllLocked': not info['noPllLatch'],
+                         'fifo': [], 'problems': problems})
+        return self.testMode(func)
+
     def buildNumber(self):
         @inlineCallbacks
         def func():
@@ -367,7 +517,8 @@ class AdcDevice(DeviceWrapper):
             ans = yield p.send() #Send the packet to the direct ethernet server
             # parse the packets out and return data
             packets = [data for src, dst, eth, data in ans.read] #list of 48-byte strings
-            returnValue(extractDemod(packets, self.buildParams['DEMOD_CHANNELS_PER_PACKET']))
+            data, ranges = extractDemod(packets, self.buildParams['DEMOD_CHANNELS_PER_PACKET'])
+            returnValue(([tuple(iq) for iq in data], ranges))
             
         return self.testMode(func)
 
@@ -388,41 +539,97 @@ class AdcDevice(DeviceWrapper):
             returnValue(None)
         return self.testMode(func)
 
-def extractAverage(packets):
-    """Extract Average waveform from a list of packets (byte strings)."""
+def filterKey(filterFunc):
+    """Hash of a filter function, for the setup state."""
+    return hashlib.sha1(np.asarray(filterFunc, dtype='<u1').tostring()).digest()
+
+def trigKey(demod):
+    """Hash of the trig lookup tables of a demod channel, for the setup state."""
+    return hashlib.sha1(demod['cosine'].tostring() + demod['sine'].tostring()).digest()
+
+def packetArray(packets):
+    """Stack packets (a list of equal length byte strings) into a 2D uint8 array.
+    
+    Each row of the result is one packet.  Arrays are returned unchanged,
+    so that data read in bulk (see readBulk) can be passed in directly.
+    """
+    if isinstance(packets, np.ndarray):
+        return packets
+    return np.frombuffer(''.join(packets), dtype='uint8').reshape(len(packets), -1)
+
+def extractAverage(packets, raw=False):
+    """Extract Average waveform from a list of packets (byte strings) or a packet array.
     
-    data = ''.join(packets) #Join all byte strings together into one long string
-    Is, Qs = np.fromstring(data, dtype='<i2').reshape(-1, 2).astype(int).T
+    If raw is True, I and Q are int16 views into the packet data rather
+    than copies, e.g. to be summed into a larger accumulator.
+    """
+    data = np.ascontiguousarray(packetArray(packets))
+    IQs = data.view('<i2').reshape(-1, 2)
+    if not raw:
+        IQs = IQs.astype(int)
+    Is, Qs = IQs.T
     return (Is, Qs)
 
 def extractDemod(packets, nDemod):
-    """Extract Demodulation data from a list of packets (byte strings)."""
-    data = ''.join(data[:44] for data in packets)   #stick all data strings in packets together, chopping out last 4 bytes from each string
-    vals = np.fromstring(data, dtype='<i2')         #Convert string of bytes into numpy array of 16bit integers. <i2 means little endian 2 byte
-    Is, Qs = vals.reshape(-1, 2).astype(int).T      #Is,Qs are numpy arrays like   [I0,I1,...,I_numChannels,    I0,I1,...,I_numChannels]
-                                                    #                               1st data run                2nd data run    
-    #Parse the IQ data into [(Is ch0, Qs ch0), (Is ch1, Qs ch1),...,(Is chnDemod, Qs chnDemod)]
-    data = [(Is[i::nDemod], Qs[i::nDemod]) for i in xrange(nDemod)]
-    #data_saved = data
+    """Extract Demodulation data from a list of packets (byte strings) or a packet array.
+    
+    Each packet holds one rep of I and Q (little endian int16) for nDemod
+    channels, followed by the range bytes at 46 and 47, each with a max
+    and min nibble in two's complement.  Returns (data, ranges) where data
+    is an array of shape (nDemod, 2, reps), so that data[i] is (I, Q) for
+    channel i, and ranges is (Imax, Imin, Qmax, Qmin) over all packets.
+    """
+    pkts = packetArray(packets)
+    reps = pkts.shape[0]
+    words = np.ascontiguousarray(pkts[:, :4*nDemod]).view('<i2').reshape(reps, nDemod, 2)
+    data = np.empty((nDemod, 2, reps), dtype='int32')
+    data[:] = words.transpose(1, 2, 0)
+    
     # compute overall max and min for I and Q
-    def getRange(pkt):
-        Irng, Qrng = [ord(i) for i in pkt[46:48]]
-        twosComp = lambda i: int(i if i < 0x8 else i - 0x10)
-        Imax = twosComp((Irng >> 4) & 0xF) # << 12
-        Imin = twosComp((Irng >> 0) & 0xF) # << 12
-        Qmax = twosComp((Qrng >> 4) & 0xF) # << 12
-        Qmin = twosComp((Qrng >> 0) & 0xF) # << 12
-        return Imax, Imin, Qmax, Qmin
-    
-    ranges = np.array([getRange(pkt) for pkt in packets]).T
-    Imax = int(max(ranges[0]))
-    Imin = int(min(ranges[1]))
-    Qmax = int(max(ranges[2]))
-    Qmin = int(min(ranges[3]))
+    rng = pkts[:, 46:48].astype('int8')
+    hi = rng >> 4                    # arithmetic shift keeps the sign of the high nibble
+    lo = ((rng & 0xF) ^ 0x8) - 0x8   # sign extend the low nibble
+    Imax = int(hi[:, 0].max())
+    Imin = int(lo[:, 0].min())
+    Qmax = int(hi[:, 1].max())
+    Qmin = int(lo[:, 1].min())
     
     return (data, (Imax, Imin, Qmax, Qmin))
 
-    #(*i,{I} *i{Q})
+_toneBanks = {}
+
+def toneBank(freqs, n, timeStep):
+    """Complex exponentials for demodulating traces of n samples at the given tones.
+    
+    freqs are in MHz and timeStep, the time between samples, in ns.
+    Returns a read-only array of shape (len(freqs), n) holding
+    exp(-2 pi i f t) / n, cached by (freqs, n, timeStep) so that a
+    sequence run many times only builds its bank once.
+    """
+    key = (tuple(float(f) for f in freqs), int(n), float(timeStep))
+    bank = _toneBanks.get(key)
+    if bank is None:
+        if len(_toneBanks) >= TONE_BANK_CACHE_SIZE:
+            _toneBanks.clear()
+        t = np.arange(n) * (timeStep * 1e-3) # in us, so that f*t is in cycles
+        bank = np.exp(-2j * np.pi * np.outer(key[0], t)) / n
+        bank.flags.writeable = False
+        _toneBanks[key] = bank
+    return bank
+
+def demodulateTraces(Is, Qs, freqs, timeStep):
+    """Demodulate average mode I and Q traces at any number of tones.
+    
+    This does in software what the demodulation channels do in hardware,
+    but for as many tones as needed, in one matrix product.  Is and Qs are
+    single traces or 2D arrays with one trace per row.  Returns (I, Q), the
+    mean of (I + iQ) exp(-2 pi i f t) over the samples of each trace, with
+    one entry per tone (in the last axis).  See toneBank for units.
+    """
+    traces = np.asarray(Is) + 1j * np.asarray(Qs)
+    bank = toneBank(freqs, traces.shape[-1], timeStep)
+    z = np.dot(traces, bank.T)
+    return (z.real, z.imag)
 
 def parseBuildParameters(parametersFromRegistry, device):
     device.buildParams = dict(parametersFromRegistry)
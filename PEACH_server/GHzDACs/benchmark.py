@@ -0,0 +1,451 @@
+"""Throughput benchmarks for the GHz FPGA server, run against emulated boards.
+
+The benchmark adds a board group named 'Benchmark' for the FPGA Simulation
+server (see FPGA_simulation.py) to the GHz FPGAs registry directory, starts
+the simulation server and the FPGA server if they are not already running,
+and then runs sequences on the emulated boards for a series of
+configurations.  Registry keys it added or changed are restored when it is
+done.  For each configuration it measures:
+    seqPerSec   - sequences completed per second with `depth` sequences
+                  submitted ahead (see Submit Sequence)
+    latency     - mean and 95th percentile time from submit to results
+    stages      - mean page lock, run lock, run packet and read lock times
+                  from Performance Data, and the mean pipe wait from
+                  Queue Statistics
+    cpuPerSeq   - CPU seconds per sequence used by the FPGA server and the
+                  simulation server (only for servers started here, and only
+                  where psutil or /proc is available)
+    failures    - sequences that returned an error
+
+With --faults, the given fault profile script (see FaultRule in
+direct_ethernet_proxy.py) is set on the simulated adapter while measuring,
+so that timeout detection and recovery can be timed under controlled packet
+loss.  The fault statistics are then recorded with the results.
+
+With --transport udp or --transport unix, the boards are emulated in a
+separate process linked to the simulation server over a local datagram
+socket (see ethernet_transport.py), so that packets cross a process
+boundary as they would with real hardware.  The simulation server must not
+already be running, since it is started with the link.
+
+The configuration parameters are
+    dacs        - number of DACs in the daisy chain
+    adc         - whether an ADC in demodulation mode is also run
+    sramLen     - SRAM words per DAC
+    reps        - repetitions per sequence
+    paging      - if False, the SRAM is padded to more than one page so
+                  that the sequences cannot be paged
+    churn       - if True, the ADC filter and setup state change on every
+                  sequence, so that setup packets are sent every time
+    timingOrder - number of boards from which timing data is returned
+    timers      - timer stops per rep on each DAC
+
+By default each parameter is swept on its own around BASE_CONFIG; --full
+sweeps the whole grid.  Results are appended to the output file as one JSON
+object per line, together with the time and the git revision, so that runs
+before and after a change can be compared.
+
+usage: python benchmark.py [options] [output file]
+"""
+
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import labrad
+
+import FPGA_simulation
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+GROUP = 'Benchmark'
+SERVER = FPGA_simulation.FPGASimulationServer.name
+FPGA_SERVER = 'GHz FPGAs'
+PORT = 0
+FIRST_BOARD = 201
+MAX_DACS = 4
+REGISTRY_DIR = ['', 'Servers', 'GHz FPGAs']
+BOARD_PARAMS = [('fifoCounter', 3), ('lvdsSD', 3)]
+START_TIMEOUT = 60 # seconds to wait for a server to start
+TRANSPORTS = {
+    # (simulation server address, board emulator address)
+    'udp': ('udp:127.0.0.1:7100', 'udp:127.0.0.1:7101'),
+    'unix': ('unix:/tmp/ghz_benchmark_server.sock', 'unix:/tmp/ghz_benchmark_boards.sock'),
+}
+
+BASE_CONFIG = {
+    'dacs': 2,
+    'adc': True,
+    'sramLen': 2048,
+    'reps': 300,
+    'paging': True,
+    'churn': False,
+    'timingOrder': 3,
+    'timers': 1,
+}
+
+SWEEPS = {
+    'dacs': [1, 2, 4],
+    'adc': [False, True],
+    'sramLen': [256, 2048, 4096],
+    'reps': [30, 300, 3000],
+    'paging': [True, False],
+    'churn': [False, True],
+    'timingOrder': [1, 2, 3],
+    'timers': [1, 4],
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SIM_SCRIPT = os.path.join(HERE, 'FPGA_simulation.py')
+FPGA_SCRIPT = os.path.join(os.path.dirname(HERE), '2_ghz_fpga_server.py')
+
+
+def dacName(i):
+    return '%s DAC %d' % (GROUP, FIRST_BOARD + i)
+
+def adcName():
+    return '%s ADC %d' % (GROUP, FIRST_BOARD)
+
+def configs(full=False):
+    """Get the list of configurations to run."""
+    if full:
+        keys = sorted(SWEEPS)
+        grid = [{}]
+        for key in keys:
+            grid = [dict(cfg, **{key: v}) for cfg in grid for v in SWEEPS[key]]
+        return grid
+    seen = []
+    for key in sorted(SWEEPS):
+        for v in SWEEPS[key]:
+            cfg = dict(BASE_CONFIG, **{key: v})
+            if cfg not in seen:
+                seen.append(cfg)
+    return seen
+
+def revision():
+    """Get the git revision of the working copy, if there is one."""
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return out.strip() or None
+    except OSError:
+        return None
+
+def cpuTime(proc):
+    """Total CPU seconds used by a process we started, or None."""
+    if proc is None:
+        return None
+    if psutil is not None:
+        t = psutil.Process(proc.pid).cpu_times()
+        return t.user + t.system
+    stat = '/proc/%d/stat' % proc.pid
+    if not os.path.exists(stat):
+        return None
+    fields = open(stat).read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+class Registry(object):
+    """Sets registry keys for the benchmark and puts them back afterwards."""
+
+    def __init__(self, cxn):
+        self.reg = cxn.registry
+        self.ctx = cxn.context()
+        self.saved = {}
+        self.reg.cd(REGISTRY_DIR, True, context=self.ctx)
+
+    def keys(self):
+        dirs, keys = self.reg.dir(context=self.ctx)
+        return keys
+
+    def set(self, key, value):
+        if key not in self.saved:
+            self.saved[key] = self.reg.get(key, context=self.ctx) if key in self.keys() else None
+        self.reg.set(key, value, context=self.ctx)
+
+    def setDefault(self, key, value):
+        if key not in self.keys():
+            self.set(key, value)
+
+    def restore(self):
+        for key, value in self.saved.items():
+            if value is None:
+                self.reg.del_(key, context=self.ctx)
+            else:
+                self.reg.set(key, value, context=self.ctx)
+        self.saved = {}
+
+    def setup(self):
+        groups = self.reg.get('boardGroups', True, [], context=self.ctx)
+        groups = [g for g in groups if g[0] != GROUP and (g[1], g[2]) != (SERVER, PORT)]
+        boards = [('DAC %d' % (FIRST_BOARD + i), 0) for i in range(MAX_DACS)]
+        boards.append(('ADC %d' % FIRST_BOARD, 0))
+        groups.append((GROUP, SERVER, PORT, boards))
+        self.set('boardGroups', groups)
+        self.setDefault('dacBuild%d' % FPGA_simulation.DAC_BUILD,
+                        sorted(FPGA_simulation.DAC_BUILD_PARAMS.items()))
+        self.setDefault('adcBuild%d' % FPGA_simulation.ADC_BUILD,
+                        sorted(FPGA_simulation.ADC_BUILD_PARAMS.items()))
+        for i in range(MAX_DACS):
+            self.setDefault('dac%d' % (FIRST_BOARD + i), BOARD_PARAMS)
+
+
+class Benchmark(object):
+    """Runs benchmark configurations on the emulated board group."""
+
+    def __init__(self, cxn, count=100, warmup=5, depth=2, timeScale=0.0, faults=None,
+                 transport=None):
+        self.cxn = cxn
+        self.count = count
+        self.warmup = warmup
+        self.depth = depth
+        self.timeScale = timeScale
+        self.faults = faults
+        self.transport = transport
+        self.procs = {}
+
+    def startServer(self, name, script, ready, args=[]):
+        """Start a server unless it is already running, and wait for it to be ready."""
+        self.cxn.refresh()
+        if name not in self.cxn.servers:
+            print 'starting %s...' % name
+            self.procs[name] = subprocess.Popen([sys.executable, script] + args,
+                                                cwd=os.path.dirname(script))
+        start = time.time()
+        while True:
+            self.cxn.refresh()
+            if name in self.cxn.servers and ready(self.cxn.servers[name]):
+                return self.cxn.servers[name]
+            if time.time() - start > START_TIMEOUT:
+                raise Exception('%s did not start' % name)
+            time.sleep(0.5)
+
+    def start(self):
+        args = []
+        if self.transport is not None:
+            args = self.startEmulator()
+        self.sim = self.startServer(SERVER, SIM_SCRIPT,
+                                    lambda s: PORT in [a[0] for a in s.adapters()], args)
+        self.sim.time_scale(self.timeScale)
+        def ready(fpga):
+            if FPGA_SERVER not in self.procs:
+                fpga.refresh_devices()
+            names = [name for id, name in fpga.list_devices()]
+            return dacName(0) in names
+        self.fpga = self.startServer(FPGA_SERVER, FPGA_SCRIPT, ready)
+
+    def startEmulator(self):
+        """Start the board emulator process and get the arguments that link the server to it."""
+        self.cxn.refresh()
+        if SERVER in self.cxn.servers:
+            raise Exception('%s is already running, stop it to use --transport' % SERVER)
+        server, boards = TRANSPORTS[self.transport]
+        names = ['DAC %d' % (FIRST_BOARD + i) for i in range(MAX_DACS)] + ['ADC %d' % FIRST_BOARD]
+        print 'starting board emulator...'
+        self.procs['emulator'] = subprocess.Popen(
+            [sys.executable, SIM_SCRIPT, '--emulate', '%s,%s' % (boards, server),
+             '--boards', ','.join(names), '--time-scale', str(self.timeScale)],
+            cwd=HERE)
+        return ['--link', '%s,%s' % (server, boards)] # the first link is adapter 0 (PORT)
+
+    def stop(self):
+        for name, proc in self.procs.items():
+            print 'stopping %s...' % name
+            proc.terminate()
+            proc.wait()
+        self.procs = {}
+
+    def memory(self, cfg):
+        """Memory sequence calling the whole SRAM once per timer."""
+        sramLen = self.sramLength(cfg)
+        mem = [0x000000, 0x800000, 0xA00000 + sramLen - 1]
+        for i in range(cfg['timers']):
+            mem += [0x400000, 0xC00000, 0x300000 + 250, 0x400001]
+        return mem + [0xF00000]
+
+    def sramLength(self, cfg):
+        if cfg['paging']:
+            return cfg['sramLen']
+        return max(cfg['sramLen'], FPGA_simulation.DAC_BUILD_PARAMS['SRAM_PAGE_LEN'] + 4)
+
+    def configure(self, cfg, ctx):
+        """Set up the sequence for a configuration in the given context."""
+        fpga = self.fpga
+        dacs = [dacName(i) for i in range(cfg['dacs'])]
+        sram = (np.arange(self.sramLength(cfg)) & 0x3FFF).astype('uint32')
+        for name in dacs:
+            fpga.select_device(name, context=ctx)
+            fpga.sram(sram, context=ctx)
+            fpga.memory(self.memory(cfg), context=ctx)
+        boards = list(dacs)
+        timing = list(dacs)
+        if cfg['adc']:
+            fpga.select_device(adcName(), context=ctx)
+            fpga.adc_run_mode('demodulate', context=ctx)
+            fpga.adc_filter_func(self.filterFunc(0), 0, 0, context=ctx)
+            fpga.adc_trig_magnitude(0, 255, 255, context=ctx)
+            fpga.adc_demod_phase(0, 6554, 0, context=ctx)
+            boards.append(adcName())
+            timing.append(adcName() + '::0')
+        fpga.daisy_chain(boards, context=ctx)
+        fpga.timing_order(timing[:cfg['timingOrder']], context=ctx)
+
+    def filterFunc(self, i):
+        return chr(255) * (100 + i % 2)
+
+    def submit(self, cfg, ctx, i):
+        if cfg['churn']:
+            if cfg['adc']:
+                self.fpga.select_device(adcName(), context=ctx)
+                self.fpga.adc_filter_func(self.filterFunc(i), 0, 0, context=ctx)
+            state = ['benchmark %d' % (i % 2)]
+        else:
+            state = ['benchmark']
+        return self.fpga.submit_sequence(cfg['reps'], True, [], state, context=ctx)
+
+    def runMany(self, cfg, ctx, n):
+        """Run n sequences with up to depth submitted ahead.
+        
+        Returns the latencies of the sequences and the number that failed.
+        """
+        pending = []
+        latencies = []
+        failures = [0]
+        def wait(ticket, t):
+            try:
+                self.fpga.wait_results(ticket, context=ctx)
+            except Exception:
+                failures[0] += 1
+            latencies.append(time.time() - t)
+        for i in range(n):
+            pending.append((self.submit(cfg, ctx, i), time.time()))
+            if len(pending) >= self.depth:
+                wait(*pending.pop(0))
+        for ticket, t in pending:
+            wait(ticket, t)
+        return latencies, failures[0]
+
+    def stageTimes(self):
+        mean = lambda v: float(np.mean(v)) if len(v) else 0.0
+        stages = {}
+        for (server, port), times in self.fpga.performance_data():
+            if (server, port) == (SERVER, PORT):
+                names = ['pageLock0', 'pageLock1', 'runLock', 'runPacket', 'readLock']
+                stages = dict((name, mean([float(t) for t in v])) for name, v in zip(names, times))
+        for group, clients in self.fpga.queue_statistics():
+            if group == GROUP:
+                waits = [float(c[-1]) for c in clients if c[-2]]
+                stages['pipeWait'] = mean(waits)
+        return stages
+
+    def run(self, cfg):
+        ctx = self.cxn.context()
+        try:
+            self.configure(cfg, ctx)
+            self.runMany(cfg, ctx, self.warmup)
+            if self.faults:
+                self.sim.fault_profile(PORT, self.faults)
+            cpu0 = dict((name, cpuTime(proc)) for name, proc in self.procs.items())
+            start = time.time()
+            latencies, failures = self.runMany(cfg, ctx, self.count)
+            elapsed = time.time() - start
+            faults = []
+            if self.faults:
+                faults = [tuple(stat) for stat in self.sim.fault_statistics(PORT)]
+                self.sim.fault_profile(PORT, '')
+            cpu = {}
+            for name, proc in self.procs.items():
+                t = cpuTime(proc)
+                if t is not None and cpu0[name] is not None:
+                    cpu[name] = (t - cpu0[name]) / self.count
+            return {
+                'seqPerSec': self.count / elapsed,
+                'latency': float(np.mean(latencies)),
+                'latency95': percentile(latencies, 0.95),
+                'stages': self.stageTimes(),
+                'cpuPerSeq': cpu,
+                'failures': failures,
+                'faults': faults,
+            }
+        finally:
+            self.cxn.manager.expire_context(self.fpga.ID, context=ctx)
+
+
+def main():
+    parser = optparse.OptionParser(usage='usage: %prog [options] [output file]')
+    parser.add_option('-n', '--count', type='int', default=100,
+                      help='sequences to run for each configuration')
+    parser.add_option('-w', '--warmup', type='int', default=5,
+                      help='sequences to run before measuring')
+    parser.add_option('-d', '--depth', type='int', default=2,
+                      help='number of sequences submitted ahead')
+    parser.add_option('-t', '--time-scale', type='float', default=0.0,
+                      help='emulated hardware time scale (0 = no hardware time)')
+    parser.add_option('--full', action='store_true', default=False,
+                      help='sweep the full grid of configurations')
+    parser.add_option('-f', '--faults', default=None,
+                      help='file with a fault profile to apply while measuring')
+    parser.add_option('--transport', choices=sorted(TRANSPORTS), default=None,
+                      help='emulate the boards in a separate process linked by udp or unix sockets')
+    options, args = parser.parse_args()
+    output = args[0] if args else 'benchmark.jsonl'
+    faults = open(options.faults).read() if options.faults else None
+
+    cxn = labrad.connect()
+    registry = Registry(cxn)
+    bench = Benchmark(cxn, options.count, options.warmup, options.depth, options.time_scale, faults,
+                      options.transport)
+    rev = revision()
+    try:
+        registry.setup()
+        bench.start()
+        out = open(output, 'a')
+        try:
+            for cfg in configs(options.full):
+                print 'running %s' % cfg
+                results = bench.run(cfg)
+                print '    %.1f sequences/s' % results['seqPerSec']
+                record = {
+                    'time': time.time(),
+                    'revision': rev,
+                    'host': platform.node(),
+                    'count': options.count,
+                    'depth': options.depth,
+                    'timeScale': options.time_scale,
+                    'faults': faults,
+                    'transport': options.transport,
+                    'config': cfg,
+                    'results': results,
+                }
+                out.write(json.dumps(record, sort_keys=True) + '\n')
+                out.flush()
+        finally:
+            out.close()
+    finally:
+        attached = FPGA_SERVER not in bench.procs
+        bench.stop()
+        registry.restore()
+        if attached and FPGA_SERVER in cxn.servers:
+            # remove the benchmark board group from the running server
+            cxn.servers[FPGA_SERVER].refresh_devices()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,435 @@
+"""Packet capture and replay for traffic between the FPGA server and direct ethernet.
+
+The FPGA server talks to the boards only through the direct ethernet server,
+so wrapping the direct ethernet server object in a RecordingServer lets us
+see every packet that goes out to or comes back from the boards.  When a
+CaptureWriter is attached, each ethernet packet written or read is appended
+to a binary capture file along with a timestamp, the direct ethernet context
+and adapter port, the board MAC and the pipeline stage the packet belongs
+to.  Requests that carry no packet data (collect, discard, clear, triggers)
+are recorded as commands so that the timing of the pipeline can be
+reconstructed.
+
+Capture file format (all little endian):
+    header: 8 bytes, CAPTURE_MAGIC
+    records: RECORD_HEADER followed by `length` bytes of payload
+        time      - double, seconds since the epoch
+        ctxHigh   - uint32, high word of direct ethernet context
+        ctxLow    - uint32, low word of direct ethernet context
+        kind      - uint8, one of SENT, RECEIVED, COMMAND
+        stage     - uint8, index into STAGES
+        port      - uint16, direct ethernet adapter of the board group
+        mac       - 6 bytes, destination MAC for SENT, source MAC for
+                    RECEIVED and the source MAC the context requires, if
+                    any, for COMMAND
+        length    - uint32, payload length
+    For SENT and RECEIVED records the payload is the ethernet packet data,
+    for COMMAND records it is the setting name and argument as 'name=arg'.
+    Packets received with 'Read Bulk' are recorded with only the part of
+    each payload that was read.  Captures from before the port was added
+    (CAPTURE_MAGIC_V1) can still be read, with port 0.
+
+Run this module to inspect or replay a capture:
+    python capture.py summary <file>
+    python capture.py replay <file>
+Replay runs a Direct Ethernet Proxy server, with an adapter for each port in
+the capture, which plays back the packets the boards sent in response to the
+requests of the FPGA server (see ReplayProxy).
+"""
+
+import collections
+import re
+import struct
+import time
+
+import numpy as np
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import adc
+from direct_ethernet_proxy import DirectEthernetProxy, EthernetAdapter, EthernetListener, DeferredBuffer
+
+
+CAPTURE_MAGIC = 'GHZCAP\x02\x00'
+RECORD_HEADER = struct.Struct('<dIIBBH6sI')
+CAPTURE_MAGIC_V1 = 'GHZCAP\x01\x00'
+RECORD_HEADER_V1 = struct.Struct('<dIIBB6sI')
+
+SENT = 1
+RECEIVED = 2
+COMMAND = 3
+
+STAGES = ['other', 'load', 'setup', 'run', 'collect', 'read', 'trigger', 'register', 'clear']
+
+ZERO_MAC = '00:00:00:00:00:00' # recorded when there is no MAC
+
+SRAM_PACKET_LEN = 1026
+MEM_PACKET_LEN = 769
+
+# direct ethernet settings that are recorded as commands
+COMMANDS = ['Collect', 'Read', 'Discard', 'Read Bulk', 'Clear', 'Send Trigger', 'Wait For Trigger']
+
+
+def macToBytes(mac):
+    """Convert a MAC address string like 00:01:CA:AA:00:01 into 6 bytes."""
+    if not mac:
+        return '\x00' * 6
+    return ''.join(chr(int(b, 16)) for b in mac.split(':'))
+
+def macFromBytes(data):
+    """Convert 6 bytes into a MAC address string."""
+    return ':'.join('%02X' % ord(b) for b in data)
+
+
+def packetStage(names, writes):
+    """Guess the pipeline stage of a direct ethernet packet.
+
+    names is the list of setting names called in the packet and writes
+    is a list of (destination MAC, data) for the ethernet packets written.
+    """
+    if 'Collect' in names:
+        return 'collect'
+    if 'Read' in names or 'Read Bulk' in names or 'Discard' in names:
+        return 'read'
+    if 'Wait For Trigger' in names:
+        return 'run'
+    if writes:
+        lengths = set(len(data) for mac, data in writes)
+        if lengths & set([SRAM_PACKET_LEN, MEM_PACKET_LEN]):
+            if all(adc.isMac(mac) for mac, data in writes):
+                return 'setup'
+            return 'load'
+        if len(writes) > 1:
+            return 'run'
+        return 'register'
+    if 'Send Trigger' in names:
+        return 'trigger'
+    if 'Clear' in names:
+        return 'clear'
+    return 'other'
+
+
+class CaptureWriter(object):
+    """Appends packet records to a capture file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(CAPTURE_MAGIC)
+        self.count = 0
+
+    def write(self, t, ctx, kind, stage, port, mac, data):
+        high, low = ctx if ctx is not None else (0, 0)
+        hdr = RECORD_HEADER.pack(t, high, low, kind, STAGES.index(stage), port,
+                                 macToBytes(mac), len(data))
+        self.file.write(hdr)
+        self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader(object):
+    """Iterates over the records in a capture file.
+
+    Each record is a tuple (t, ctx, kind, stage, port, mac, data), where
+    stage is the stage name and mac is a MAC address string.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __iter__(self):
+        f = open(self.filename, 'rb')
+        try:
+            magic = f.read(len(CAPTURE_MAGIC))
+            if magic not in (CAPTURE_MAGIC, CAPTURE_MAGIC_V1):
+                raise Exception("'%s' is not a packet capture file" % self.filename)
+            header = RECORD_HEADER if magic == CAPTURE_MAGIC else RECORD_HEADER_V1
+            while True:
+                hdr = f.read(header.size)
+                if len(hdr) < header.size:
+                    break
+                if magic == CAPTURE_MAGIC:
+                    t, high, low, kind, stage, port, mac, length = header.unpack(hdr)
+                else:
+                    t, high, low, kind, stage, mac, length = header.unpack(hdr)
+                    port = 0
+                data = f.read(length)
+                yield (t, (high, low), kind, STAGES[stage], port, macFromBytes(mac), data)
+        finally:
+            f.close()
+
+
+class Capture(object):
+    """Holds the capture writer (if any) shared by all recording servers."""
+
+    def __init__(self):
+        self.writer = None
+
+    @property
+    def active(self):
+        return self.writer is not None
+
+    def start(self, filename):
+        self.stop()
+        self.writer = CaptureWriter(filename)
+
+    def stop(self):
+        """Stop capturing and return the number of records written."""
+        count = 0
+        if self.writer is not None:
+            count = self.writer.count
+            self.writer.close()
+            self.writer = None
+        return count
+
+    def recordRequest(self, records, ctx, port, source=None):
+        """Record the ethernet packets and commands in an outgoing packet.
+
+        source is the source MAC that the context requires, if any.
+        """
+        t = time.time()
+        names = [rec.name for rec in records]
+        writes = []
+        dest = None
+        for rec in records:
+            if rec.name == 'Destination MAC':
+                dest = rec.data
+                if not isinstance(dest, str):
+                    dest = '%02X:%02X:%02X:%02X:%02X:%02X' % tuple(dest)
+            elif rec.name == 'Write':
+                data = rec.data
+                if not isinstance(data, str):
+                    data = ''.join(chr(int(b) & 0xFF) for b in data)
+                writes.append((dest, data))
+        stage = packetStage(names, writes)
+        for mac, data in writes:
+            self.writer.write(t, ctx, SENT, stage, port, mac, data)
+        for rec in records:
+            if rec.name in COMMANDS:
+                arg = '' if rec.data is None else str(rec.data)
+                self.writer.write(t, ctx, COMMAND, stage, port, source, '%s=%s' % (rec.name, arg))
+        return stage
+
+    def recordResponse(self, records, resp, ctx, stage, port, source=None):
+        """Record the ethernet packets read back in a response.
+
+        Packets read in bulk do not come with their source MAC, so they are
+        recorded with source, the source MAC required by the context.
+        """
+        t = time.time()
+        for rec in records:
+            if rec.name == 'Read Bulk':
+                # payloads have been trimmed
+                stride, data = resp[rec.key if rec.key is not None else rec.name]
+                for i in xrange(0, len(data), stride or 1):
+                    self.writer.write(t, ctx, RECEIVED, stage, port, source, data[i:i+stride])
+                continue
+            if rec.name != 'Read':
+                continue
+            data = resp[rec.key if rec.key is not None else rec.name]
+            if len(data) == 4 and isinstance(data[0], str):
+                data = [data] # a single packet rather than a list
+            for src, dst, eth, payload in data:
+                self.writer.write(t, ctx, RECEIVED, stage, port, src, payload)
+
+
+class RecordingServer(object):
+    """Wraps a direct ethernet server so that packets sent through it can be captured.
+
+    Everything other than packet creation is passed straight through to
+    the wrapped server.  Packets made with packet() are instances of a
+    subclass of the server's own packet class, so chained calls keep
+    returning recording packets.  When the capture is not active, sending
+    costs one extra attribute check.
+
+    One recording server is made for each board group, so it knows the
+    adapter port of every packet.  It also remembers the source MAC that each
+    context requires, that is the board the context talks to, since packets
+    read in bulk are recorded without their own MAC.
+    """
+
+    def __init__(self, server, capture, port=0):
+        self._server = server
+        self._capture = capture
+        self._port = port
+        self._sources = sources = {}
+        base = server._packetWrapperClass
+
+        class RecordingPacket(base):
+            def require_source_mac(pkt, mac, **kw):
+                ctx = pkt._kw.get('context')
+                if ctx is not None:
+                    sources[ctx] = mac if isinstance(mac, str) else '%02X:%02X:%02X:%02X:%02X:%02X' % tuple(mac)
+                return base.require_source_mac(pkt, mac, **kw)
+
+            @inlineCallbacks
+            def send(pkt, **kw):
+                if not capture.active:
+                    resp = yield base.send(pkt, **kw)
+                    returnValue(resp)
+                ctx = kw.get('context', pkt._kw.get('context'))
+                source = sources.get(ctx)
+                records = list(pkt._packet)
+                stage = capture.recordRequest(records, ctx, port, source)
+                resp = yield base.send(pkt, **kw)
+                if capture.active:
+                    capture.recordResponse(records, resp, ctx, stage, port, source)
+                returnValue(resp)
+
+        self._packetClass = RecordingPacket
+
+    def packet(self, **kw):
+        """Create a new packet for the wrapped server."""
+        return self._packetClass(**kw)
+
+    def __getattr__(self, name):
+        return getattr(self._server, name)
+
+
+def summarize(reader):
+    """Summarize a capture as a list of (stage, kind, count, bytes) and the duration."""
+    counts = {}
+    start = end = None
+    for t, ctx, kind, stage, port, mac, data in reader:
+        if start is None:
+            start = t
+        end = t
+        n, b = counts.get((stage, kind), (0, 0))
+        counts[stage, kind] = (n + 1, b + len(data))
+    rows = [(stage, kind, count, size) for (stage, kind), (count, size) in sorted(counts.items())]
+    duration = (end - start) if start is not None else 0.0
+    return rows, duration
+
+
+def commandCount(arg):
+    """Number of packets a recorded Collect, Read, Read Bulk or Discard asked for."""
+    m = re.search(r'\d+', arg)
+    return int(m.group()) if m else 1
+
+def replayScripts(reader):
+    """Work out the packets to play back to each context of a replay.
+
+    Contexts are identified by (port, required source MAC), since the
+    context IDs differ from run to run.  For each of them we get the
+    packets, in the order they were taken from the context's buffer: those
+    recorded as read, and placeholders (None) for those discarded, which
+    were never seen by the FPGA server.  Packets read in bulk are padded in
+    front so that trimming them again gives the recorded bytes.
+    Returns a dict of deques of (src, data) or None, and the ports used.
+    """
+    keys = {} # recorded context -> (port, required source MAC)
+    order = [] # recorded contexts, in order of their first command
+    commands = collections.defaultdict(list)
+    received = collections.defaultdict(collections.deque)
+    ports = set()
+    for t, ctx, kind, stage, port, mac, data in reader:
+        ports.add(port)
+        if kind == COMMAND:
+            name, _, arg = data.partition('=')
+            if name in ('Read', 'Read Bulk', 'Discard'):
+                if ctx not in keys:
+                    keys[ctx] = (port, None if mac == ZERO_MAC else mac)
+                    order.append(ctx)
+                commands[ctx].append((name, arg))
+        elif kind == RECEIVED:
+            received[ctx].append((mac, data))
+
+    scripts = {}
+    for ctx in order:
+        pkts = received[ctx]
+        script = scripts.setdefault(keys[ctx], collections.deque())
+        for name, arg in commands[ctx]:
+            n = commandCount(arg)
+            if name == 'Discard':
+                script.extend([None] * n)
+                continue
+            pad = ''
+            if name == 'Read Bulk':
+                args = [int(a) for a in re.findall(r'\d+', arg)]
+                pad = '\x00' * (args[1] if len(args) > 1 else 0)
+            for _ in xrange(min(n, len(pkts))):
+                src, data = pkts.popleft()
+                script.append((src, pad + data))
+    return scripts, ports
+
+
+class ReplayBuffer(DeferredBuffer):
+    """Packet buffer that asks for packets from the replay before each read."""
+
+    def __init__(self, refill):
+        DeferredBuffer.__init__(self, packets=True)
+        self.refill = refill
+
+    def collect(self, n=1, timeout=None):
+        self.refill(n)
+        return DeferredBuffer.collect(self, n, timeout)
+
+    def get(self, n=1, timeout=None):
+        self.refill(n)
+        return DeferredBuffer.get(self, n, timeout)
+
+    def getBlock(self, n=1, start=0, end=None, timeout=None):
+        self.refill(n)
+        return DeferredBuffer.getBlock(self, n, start, end, timeout)
+
+    def discard(self, n=1, timeout=None):
+        self.refill(n)
+        return DeferredBuffer.discard(self, n, timeout)
+
+
+class ReplayProxy(DirectEthernetProxy):
+    """Direct ethernet proxy which plays back the packets from a capture.
+
+    There is an adapter for each port in the capture, so the FPGA server
+    finds its board groups where they were.  Packets the FPGA server writes
+    go nowhere.  When a context collects, reads or discards packets, the
+    packets recorded for that context, that is for its port and required
+    source MAC, are put into its buffer until it holds as many as asked for,
+    so each response is replayed when the FPGA server asks for it.
+    """
+
+    def __init__(self, scripts, ports):
+        adapters = [EthernetAdapter('replay%d' % i, '01:23:45:67:89:%02X' % i)
+                    for i in range(max(ports) + 1 if ports else 1)]
+        for i, adapter in enumerate(adapters):
+            adapter.port = i
+        DirectEthernetProxy.__init__(self, adapters)
+        self.scripts = scripts
+
+    def initContext(self, c):
+        DirectEthernetProxy.initContext(self, c)
+        c['buf'] = ReplayBuffer(lambda n: self.refill(c, n))
+        c['listener'] = EthernetListener(c['buf'].put)
+
+    def refill(self, c, n):
+        """Put recorded packets into the buffer of a context until it holds n."""
+        if 'adapter' not in c:
+            return
+        adapter = c['adapter']
+        script = self.scripts.get((adapter.port, c['listener'].required.get('src')))
+        buf = c['buf']
+        while script and len(buf) < n:
+            item = script.popleft()
+            src, data = item if item is not None else (None, '')
+            buf.put((src, adapter.mac, -1, np.fromstring(data, dtype='uint8')))
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3 or sys.argv[1] not in ['summary', 'replay']:
+        print 'usage: python capture.py summary|replay <file>'
+        sys.exit(1)
+    reader = CaptureReader(sys.argv[2])
+    if sys.argv[1] == 'summary':
+        rows, duration = summarize(reader)
+        kinds = {SENT: 'sent', RECEIVED: 'received', COMMAND: 'command'}
+        print 'capture duration: %.3f s' % duration
+        for stage, kind, n, b in rows:
+            print '%-10s %-9s %8d packets %12d bytes' % (stage, kinds[kind], n, b)
+    else:
+        from labrad import util
+        scripts, ports = replayScripts(reader)
+        print 'replaying %d packets for %d contexts' % (sum(len(s) for s in scripts.values()), len(scripts))
+        util.runServer(ReplayProxy(scripts, ports))
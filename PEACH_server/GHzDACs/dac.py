@@ -1,5 +1,8 @@
+import random
+
 import numpy as np
 
+from twisted.internet import reactor, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad.devices import DeviceWrapper
@@ -64,6 +67,7 @@ I2C_ACK = 0x200
 I2C_RB_ACK = I2C_RB | I2C_ACK
 I2C_END = 0x400
 MAX_FIFO_TRIES = 5
+SRAM_PAYLOAD_LEN = 1024 # bytes of SRAM data in one SRAM write packet, after the two derp bytes
 
 
 def macFor(board):
@@ -187,6 +191,20 @@ def pktWriteSram(device, derp, data):
     #pkt[5:5+len(data)*4:4] = d
     return pkt
 
+def pktSramHeader(device, derp):
+    """Get the derp address bytes that start an SRAM write packet."""
+    assert 0 <= derp < device.buildParams['SRAM_WRITE_DERPS'], "SRAM derp out of range: %d" % derp
+    return chr((derp >> 0) & 0xFF) + chr((derp >> 8) & 0xFF)
+
+def pktSramPayload(data):
+    """Pad a byte string of SRAM data to fill one SRAM write packet.
+    
+    Together with pktSramHeader this gives the same bytes as pktWriteSram,
+    but works directly on the byte string so the payload can be built once
+    and reused for any derp.
+    """
+    return data + '\x00' * (SRAM_PAYLOAD_LEN - len(data))
+
 def pktWriteMem(page, data):
     data = np.asarray(data)
     pkt = np.zeros(769, dtype='<u1')
@@ -201,6 +219,52 @@ def pktWriteMem(page, data):
     return pkt
 
 
+class RegisterTransaction(object):
+    """A batch of register packets sent to one board in a single request.
+    
+    Each register packet sent on its own costs a round trip through the
+    direct ethernet server, and the board handles register packets in the
+    order they arrive, so a sequence of writes whose readbacks can all be
+    checked at the end (e.g. a serial or I2C command stream) is much faster
+    sent as one packet to the ethernet server.  Queue register packets with
+    add, then send writes them all and reads back all readbacks at once.
+    """
+    def __init__(self, dev):
+        self.dev = dev
+        self.regs = []
+        self.nReadbacks = 0
+    
+    def __len__(self):
+        return len(self.regs)
+    
+    def add(self, regs, readback=True):
+        """Queue a register packet, returning the index of its readback (or None)."""
+        if not isinstance(regs, np.ndarray):
+            regs = np.asarray(regs, dtype='<u1')
+        self.regs.append(regs.tostring())
+        if not readback:
+            return None
+        self.nReadbacks += 1
+        return self.nReadbacks - 1
+    
+    def addSerial(self, op, data):
+        """Queue serial commands, returning the indices of their readbacks."""
+        return [self.add(regSerial(op, d)) for d in data]
+    
+    @inlineCallbacks
+    def send(self, timeout=T.Value(10, 's')):
+        """Send all queued register packets and return the list of readbacks (byte strings)."""
+        p = self.dev.makePacket()
+        for regs in self.regs:
+            p.write(regs)
+        if self.nReadbacks:
+            p.timeout(timeout)
+            p.read(self.nReadbacks)
+        ans = yield p.send()
+        if self.nReadbacks:
+            returnValue([data for src, dst, eth, data in ans.read])
+        returnValue([])
+
 
 class DacDevice(DeviceWrapper):
     """Manages communication with a single GHz DAC board.
@@ -227,6 +291,7 @@ class DacDevice(DeviceWrapper):
         self.devName = name
         self.serverName = de._labrad_name
         self.timeout = T.Value(1, 's')
+        self.bringupCache = {} # converged bringup parameters for each DAC, see bringup
 
         # set up our context with the ethernet server
         # This context is expired when the device shuts down
@@ -247,15 +312,30 @@ class DacDevice(DeviceWrapper):
         p.cd(['','Servers','GHz FPGAs'])
         p.get('dacBuild'+str(self.build),key='buildParams')
         p.get('dac'+self.devName.split(' ')[-1],key='boardParams')
+        p.get(self.bringupKey(), False, [], key='bringupCache')
         try:
             resp = yield p.send()
             buildParams = resp['buildParams']
             boardParams = resp['boardParams']
             parseBuildParameters(buildParams, self)
             parseBoardParameters(boardParams, self)
+            parseBringupCache(resp['bringupCache'], self)
         finally:
             yield self.cxn.manager.expire_context(reg.ID, context=ctxt)
 
+    def bringupKey(self):
+        """Registry key for the bringup cache, next to the board parameters."""
+        return 'dac'+self.devName.split(' ')[-1]+'Bringup'
+
+    @inlineCallbacks
+    def saveBringupCache(self):
+        """Store bringupCache in the registry, so it survives a restart."""
+        reg = self.cxn.registry
+        p = reg.packet()
+        p.cd(['','Servers','GHz FPGAs'])
+        p.set(self.bringupKey(), bringupCacheForRegistry(self.bringupCache))
+        yield p.send()
+
     @inlineCallbacks
     def shutdown(self):
         """Called when this device is to be shutdown."""
@@ -268,34 +348,53 @@ class DacDevice(DeviceWrapper):
         """Create a new packet to be sent to the ethernet server for this device."""
         return self.server.packet(context=self.ctx)
 
-    def makeSRAM(self, data, p, page=0):
+    def sramPayloads(self, data):
+        """Split SRAM data (a byte string) into SRAM write packet payloads.
+        
+        The payloads do not depend on the page being written, so they can
+        be prepared ahead of time (e.g. in a worker thread) and passed to
+        makeSRAM, which adds the derp addresses.
+        """
+        n = self.buildParams['SRAM_WRITE_PKT_LEN']*4
+        return [pktSramPayload(data[i:i+n]) for i in xrange(0, len(data), n)]
+
+    def makeSRAM(self, data, p, page=0, payloads=None):
         """Update a packet for the ethernet server with SRAM commands."""
+        if payloads is None:
+            payloads = self.sramPayloads(data)
         #Set starting write derp to the beginning of the chosen SRAM page
         writeDerp = page * self.buildParams['SRAM_PAGE_LEN'] / self.buildParams['SRAM_WRITE_PKT_LEN']
-        #Crete SRAM write commands and add them to the packet for the direct ethernet server
-        while len(data) > 0:
-            chunk, data = data[:self.buildParams['SRAM_WRITE_PKT_LEN']*4], data[self.buildParams['SRAM_WRITE_PKT_LEN']*4:]
-            chunk = np.fromstring(chunk, dtype='<u4')
-            pkt = pktWriteSram(self, writeDerp, chunk)
-            p.write(pkt.tostring())
+        #Create SRAM write commands and add them to the packet for the direct ethernet server
+        for payload in payloads:
+            p.write(pktSramHeader(self, writeDerp) + payload)
             writeDerp += 1
 
-    def makeMemory(self, data, p, page=0):
-        """Update a packet for the ethernet server with Memory commands."""
+    def memoryPacket(self, data, page=0):
+        """Create the Memory write packet (a byte string) for the given page."""
         if len(data) > MEM_PAGE_LEN:
             msg = "Memory length %d exceeds maximum memory length %d (one page)."
             raise Exception(msg % (len(data), MEM_PAGE_LEN))
         # translate SRAM addresses for higher pages
         if page:
             data = shiftSRAM(self, data, page)
-        pkt = pktWriteMem(page, data)
-        p.write(pkt.tostring())
+        return pktWriteMem(page, data).tostring()
 
-    def load(self, mem, sram, page=0):
-        """Create a packet to write Memory and SRAM data to the FPGA."""
+    def makeMemory(self, data, p, page=0):
+        """Update a packet for the ethernet server with Memory commands."""
+        p.write(self.memoryPacket(data, page))
+
+    def load(self, mem, sram, page=0, memPkt=None, sramPayloads=None):
+        """Create a packet to write Memory and SRAM data to the FPGA.
+        
+        The memory packet and SRAM payloads can be passed in if they
+        have already been prepared with memoryPacket and sramPayloads.
+        """
         p = self.makePacket()
-        self.makeMemory(mem, p, page=page)
-        self.makeSRAM(sram, p, page=page)
+        if memPkt is None:
+            self.makeMemory(mem, p, page=page)
+        else:
+            p.write(memPkt)
+        self.makeSRAM(sram, p, page=page, payloads=sramPayloads)
         return p
     
     def collect(self, nPackets, timeout, triggerCtx):
@@ -315,6 +414,21 @@ class DacDevice(DeviceWrapper):
     def read(self, nPackets):
         """Create a packet to read data from the FPGA."""
         return self.makePacket().read(nPackets)
+    
+    def readBulk(self, nPackets, start=0, end=None):
+        """Create a packet to read data from the FPGA as one byte string.
+        
+        The ethernet server trims each payload to bytes [start:end], or
+        keeps whole payloads if end is None, and returns (stride, data)
+        under the key 'read'.  Only servers that have a 'Read Bulk'
+        setting (see canReadBulk) support this.
+        """
+        args = (nPackets,) if end is None else (nPackets, start, end)
+        return self.makePacket().read_bulk(*args, key='read')
+    
+    def canReadBulk(self):
+        """Check whether our ethernet server can read packets in bulk."""
+        return 'Read Bulk' in self.server.settings
             
     def discard(self, nPackets):
         """Create a packet to discard data on the FPGA."""
@@ -354,10 +468,18 @@ class DacDevice(DeviceWrapper):
             src, dst, eth, data = ans.read
             returnValue(data)
 
+    def transaction(self):
+        """Start a batch of register packets for this board, see RegisterTransaction."""
+        return RegisterTransaction(self)
+
     @inlineCallbacks
     def _runI2C(self, pkts):
-        """Run I2C commands on the board."""
-        answer = []
+        """Run I2C commands on the board.
+        
+        All I2C register packets are sent in one transaction.
+        """
+        txn = self.transaction()
+        chunks = []
         for pkt in pkts:
             while len(pkt):
                 data, pkt = pkt[:8], pkt[8:]
@@ -366,22 +488,25 @@ class DacDevice(DeviceWrapper):
                 read = [b & I2C_RB for b in data]
                 ack = [b & I2C_ACK for b in data]
                 
-                regs = regI2C(bytes, read, ack)
-                r = yield self._sendRegisters(regs)
-                ansBytes = processReadback(r)['I2Cbytes'][-len(data):] # readout data wrapped around to end
-                
-                answer += [b for b, r in zip(ansBytes, read) if r]
+                txn.add(regI2C(bytes, read, ack))
+                chunks.append((len(data), read))
+        readbacks = yield txn.send()
+        answer = []
+        for (n, read), r in zip(chunks, readbacks):
+            ansBytes = processReadback(r)['I2Cbytes'][-n:] # readout data wrapped around to end
+            answer += [b for b, r in zip(ansBytes, read) if r]
         returnValue(answer)
 
     @inlineCallbacks
     def _runSerial(self, op, data):
-        """Run a command or list of commands through the serial interface."""
-        answer = []
-        for d in data:
-            regs = regSerial(op, d)
-            r = yield self._sendRegisters(regs)
-            answer += [int(processReadback(r)['serDAC'])] # turn these into python ints, instead of numpy ints
-        returnValue(answer)
+        """Run a command or list of commands through the serial interface.
+        
+        All commands are sent in one transaction.
+        """
+        txn = self.transaction()
+        txn.addSerial(op, data)
+        readbacks = yield txn.send()
+        returnValue(serialReadbacks(readbacks))
     
     @inlineCallbacks
     def _setPolarity(self, chan, invert):
@@ -390,8 +515,8 @@ class DacDevice(DeviceWrapper):
         returnValue(invert)
     
     def testMode(self, func, *a, **kw):
-        """Run a func in test mode on our board group."""
-        return self.boardGroup.testMode(func, *a, **kw)
+        """Run a func in test mode on this board, see BoardGroup.boardTestMode."""
+        return self.boardGroup.boardTestMode([self.devName], func, *a, **kw)
     
     
     # externally-accessible functions that put the board into test mode
@@ -404,13 +529,46 @@ class DacDevice(DeviceWrapper):
             returnValue(str(processReadback(r)['build']))
         return self.testMode(func)
 
+    def checkHealth(self):
+        """Check PLL lock, build number and FIFO counters in one transaction.
+        
+        Returns a dict with 'build', 'pllLocked', 'fifo' (the FIFO counter
+        of each DAC) and 'problems', a list of messages describing anything
+        that is not as expected, which is empty if the board is healthy.
+        The expected FIFO counter is the one found by the last bringup, or
+        the registry value if there has been none.
+        """
+        return self.testMode(self._checkHealth)
+
+    @inlineCallbacks
+    def _checkHealth(self):
+        txn = self.transaction()
+        txn.add(regPing())
+        for op in [2, 3]:
+            txn.addSerial(op, [0x8700])
+        readbacks = yield txn.send()
+        info = processReadback(readbacks[0])
+        fifo = [(r >> 4) & 0xF for r in serialReadbacks(readbacks[1:])]
+        problems = []
+        if info['noPllLatch']:
+            problems.append('PLL unlocked')
+        if int(info['build']) != self.build:
+            problems.append('build %d, expected %d' % (info['build'], self.build))
+        for dac, counter in zip(['A', 'B'], fifo):
+            target = self.bringupCache.get(dac, {}).get('fifoCounter', int(self.boardParams['fifoCounter']))
+            if counter != target:
+                problems.append('DAC %s FIFO counter %d, expected %d' % (dac, counter, target))
+        returnValue({'build': int(info['build']), 'pllLocked': not info['noPllLatch'],
+                     'fifo': fifo, 'problems': problems})
+
     def initPLL(self):
-        @inlineCallbacks
-        def func():
-            yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
-            regs = regRunSram(self, 0, 0, loop=False) #Run sram with startAddress=endAddress=0. Run once, no loop.
-            yield self._sendRegisters(regs, readback=False)
-        return self.testMode(func)
+        return self.testMode(self._initPLL)
+
+    @inlineCallbacks
+    def _initPLL(self):
+        yield self._runSerial(1, [0x1FC093, 0x1FC092, 0x100004, 0x000C11])
+        regs = regRunSram(self, 0, 0, loop=False) #Run sram with startAddress=endAddress=0. Run once, no loop.
+        yield self._sendRegisters(regs, readback=False)
         
     def queryPLL(self):
         @inlineCallbacks
@@ -421,11 +579,12 @@ class DacDevice(DeviceWrapper):
         return self.testMode(func)
     
     def resetPLL(self):
-        @inlineCallbacks
-        def func():
-            regs = regPllReset()
-            yield self._sendRegisters(regs)
-        return self.testMode(func)
+        return self.testMode(self._resetPLL)
+
+    @inlineCallbacks
+    def _resetPLL(self):
+        regs = regPllReset()
+        yield self._sendRegisters(regs)
     
     def debugOutput(self, word1, word2, word3, word4):
         @inlineCallbacks
@@ -461,104 +620,129 @@ class DacDevice(DeviceWrapper):
         return self.testMode(self._setPolarity, chan, invert)
     
     def setLVDS(self, cmd, sd, optimizeSD):
-        @inlineCallbacks
+        return self.testMode(self._setLVDS, cmd, sd, optimizeSD)
+
+    @inlineCallbacks
+    def _setLVDS(self, cmd, sd, optimizeSD):
         # See U:\John\ProtelDesigns\GHzDAC_R3_1\Documentation\HardRegProgram.txt
         # for how this function works.
-        def func():
-            #TODO: repeat LVDS measurement five times and average results.
-            pkt = [[0x0400 + (i<<4), 0x8500, 0x0400 + i, 0x8500][j]
-                   for i in range(16) for j in range(4)]
-    
-            if optimizeSD is True:
-                # Find the leading/trailing edges of the DATACLK_IN clock. First
-                # set SD to 0. Then, for bits from 0 to 15, set MSD to this bit
-                # and MHD to 0, read the check bit, set MHD to this bit and MSD
-                # to 0, read the check bit.
-                answer = yield self._runSerial(cmd, [0x0500] + pkt)
-                answer = [answer[i*2+2] & 1 for i in range(32)]
-    
-                # Locate where the check bit changes from 1 to 0 for both MSD and MHD.
-                MSD = -2
-                MHD = -2
-                for i in range(16):
-                    if MSD == -2 and answer[i*2] == 1: MSD = -1
-                    if MSD == -1 and answer[i*2] == 0: MSD = i
-                    if MHD == -2 and answer[i*2+1] == 1: MHD = -1
-                    if MHD == -1 and answer[i*2+1] == 0: MHD = i
-                MSD = max(MSD, 0)
-                MHD = max(MHD, 0)
-                # Find the optimal SD based on MSD and MHD.
-                t = (MHD-MSD)/2 & 0xF
-                setMSDMHD = False
-            elif sd is None:
-                # Get the SD value from the registry.
-                t = int(self.boardParams['lvdsSD']) & 0xF
-                MSD, MHD = -1, -1
-                setMSDMHD = True
-            else:
-                # This occurs if the SD is not specified (by optimization or in
-                # the registry).
-                t = sd & 0xF
-                MSD, MHD = -1, -1
-                setMSDMHD = True
-    
-            # Set the SD and check that the resulting difference between MSD and
-            # MHD is no more than one bit. Any more indicates noise on the line.
-            answer = yield self._runSerial(cmd, [0x0500 + (t<<4)] + pkt)
-            MSDbits = [bool(answer[i*4+2] & 1) for i in range(16)]
-            MHDbits = [bool(answer[i*4+4] & 1) for i in range(16)]
-            MSDswitch = [(MSDbits[i+1] != MSDbits[i]) for i in range(15)]
-            MHDswitch = [(MHDbits[i+1] != MHDbits[i]) for i in range(15)]
-            leadingEdge = MSDswitch.index(True)
-            trailingEdge = MHDswitch.index(True)
-            if setMSDMHD:
-                if sum(MSDswitch)==1: MSD = leadingEdge
-                if sum(MHDswitch)==1: MHD = trailingEdge
-            if abs(trailingEdge-leadingEdge)<=1 and sum(MSDswitch)==1 and sum(MHDswitch)==1:
-                success = True
-            else:
-                success = False
-            checkResp = yield self._runSerial(cmd, [0x8500])
-            checkHex = checkResp[0] & 0x7
-            returnValue((success, MSD, MHD, t, (range(16), MSDbits, MHDbits), checkHex))
-        return self.testMode(func)
+        #TODO: repeat LVDS measurement five times and average results.
+        pkt = [[0x0400 + (i<<4), 0x8500, 0x0400 + i, 0x8500][j]
+               for i in range(16) for j in range(4)]
+
+        if optimizeSD is True:
+            # Find the leading/trailing edges of the DATACLK_IN clock. First
+            # set SD to 0. Then, for bits from 0 to 15, set MSD to this bit
+            # and MHD to 0, read the check bit, set MHD to this bit and MSD
+            # to 0, read the check bit.
+            answer = yield self._runSerial(cmd, [0x0500] + pkt)
+            answer = [answer[i*2+2] & 1 for i in range(32)]
+
+            # Locate where the check bit changes from 1 to 0 for both MSD and MHD.
+            MSD = -2
+            MHD = -2
+            for i in range(16):
+                if MSD == -2 and answer[i*2] == 1: MSD = -1
+                if MSD == -1 and answer[i*2] == 0: MSD = i
+                if MHD == -2 and answer[i*2+1] == 1: MHD = -1
+                if MHD == -1 and answer[i*2+1] == 0: MHD = i
+            MSD = max(MSD, 0)
+            MHD = max(MHD, 0)
+            # Find the optimal SD based on MSD and MHD.
+            t = (MHD-MSD)/2 & 0xF
+            setMSDMHD = False
+        elif sd is None:
+            # Get the SD value from the registry.
+            t = int(self.boardParams['lvdsSD']) & 0xF
+            MSD, MHD = -1, -1
+            setMSDMHD = True
+        else:
+            # This occurs if the SD is not specified (by optimization or in
+            # the registry).
+            t = sd & 0xF
+            MSD, MHD = -1, -1
+            setMSDMHD = True
+
+        # Set the SD and check that the resulting difference between MSD and
+        # MHD is no more than one bit. Any more indicates noise on the line.
+        # The final check is read back in the same transaction.
+        answer = yield self._runSerial(cmd, [0x0500 + (t<<4)] + pkt + [0x8500])
+        answer, checkResp = answer[:-1], answer[-1:]
+        MSDbits = [bool(answer[i*4+2] & 1) for i in range(16)]
+        MHDbits = [bool(answer[i*4+4] & 1) for i in range(16)]
+        MSDswitch = [(MSDbits[i+1] != MSDbits[i]) for i in range(15)]
+        MHDswitch = [(MHDbits[i+1] != MHDbits[i]) for i in range(15)]
+        leadingEdge = MSDswitch.index(True)
+        trailingEdge = MHDswitch.index(True)
+        if setMSDMHD:
+            if sum(MSDswitch)==1: MSD = leadingEdge
+            if sum(MHDswitch)==1: MHD = trailingEdge
+        if abs(trailingEdge-leadingEdge)<=1 and sum(MSDswitch)==1 and sum(MHDswitch)==1:
+            success = True
+        else:
+            success = False
+        checkHex = checkResp[0] & 0x7
+        returnValue((success, MSD, MHD, t, (range(16), MSDbits, MHDbits), checkHex))
     
     
     
     def setFIFO(self, chan, op, targetFifo):
+        return self.testMode(self._setFIFO, chan, op, targetFifo)
+
+    @inlineCallbacks
+    def _setFIFO(self, chan, op, targetFifo, start=None):
+        """Find the clock polarity and PHOF that give the target FIFO counter.
+        
+        If start is given, as (clock polarity, PHOF), e.g. from an earlier
+        bringup, that setting is checked first and the search is only run
+        if it no longer gives the target FIFO counter.
+        """
         if targetFifo is None:
             # Grab targetFifo from registry if not specified.
             targetFifo = int(self.boardParams['fifoCounter'])
-        @inlineCallbacks
-        def func():
-            # set clock polarity to positive
-            clkinv = False
+        
+        if start is not None:
+            clkinv, PHOF = start
+            txn = self.transaction()
+            txn.add(regClockPolarity(chan, clkinv))
+            idx = txn.addSerial(op, [0x0700 + PHOF, 0x8700])
+            readbacks = yield txn.send()
+            reading = serialReadbacks(readbacks[idx[0]:])
+            if (reading[1] >> 4) & 0xF == targetFifo:
+                returnValue((True, clkinv, PHOF, 1, targetFifo))
+        
+        # start with the clock polarity positive
+        clkinv = False
+
+        tries = 1
+        found = False
+
+        while tries <= MAX_FIFO_TRIES and not found:
+            # Set the clock polarity, then send all four PHOFs & measure
+            # resulting FIFO counters, in one transaction. If one of these
+            # equals targetFifo, set the PHOF and check that the FIFO
+            # counter is indeed targetFifo. If so, break out.
+            txn = self.transaction()
+            txn.add(regClockPolarity(chan, clkinv))
+            idx = txn.addSerial(op, [0x0700, 0x8700, 0x0701, 0x8700, 0x0702, 0x8700, 0x0703, 0x8700])
+            readbacks = yield txn.send()
+            reading = serialReadbacks(readbacks[idx[0]:])
+            fifoCounters = np.array([(reading[i]>>4) & 0xF for i in [1, 3, 5, 7]])
+            PHOF, found = yield self._checkPHOF(op, fifoCounters, targetFifo)
+            if found:
+                break
+            else:
+                # If none of PHOFs gives FIFO counter of targetFifo
+                # initially or after verification, flip clock polarity and
+                # try again.
+                clkinv = not clkinv
+                tries += 1
+        if not found:
+            # leave the board with the clock polarity of the last try
             yield self._setPolarity(chan, clkinv)
-    
-            tries = 1
-            found = False
-    
-            while tries <= MAX_FIFO_TRIES and not found:
-                # Send all four PHOFs & measure resulting FIFO counters. If one
-                # of these equals targetFifo, set the PHOF and check that the
-                # FIFO counter is indeed targetFifo. If so, break out.
-                pkt =  [0x0700, 0x8700, 0x0701, 0x8700, 0x0702, 0x8700, 0x0703, 0x8700]
-                reading = yield self._runSerial(op, pkt)
-                fifoCounters = np.array([(reading[i]>>4) & 0xF for i in [1, 3, 5, 7]])
-                PHOF, found = yield self._checkPHOF(op, fifoCounters, targetFifo)
-                if found:
-                    break
-                else:
-                    # If none of PHOFs gives FIFO counter of targetFifo
-                    # initially or after verification, flip clock polarity and
-                    # try again.
-                    clkinv = not clkinv
-                    yield self._setPolarity(chan, clkinv)
-                    tries += 1
-    
-            ans = found, clkinv, PHOF, tries, targetFifo
-            returnValue(ans)
-        return self.testMode(func)
+
+        ans = found, clkinv, PHOF, tries, targetFifo
+        returnValue(ans)
         
         
         
@@ -574,13 +758,21 @@ class DacDevice(DeviceWrapper):
         # For each PHOF for which the FIFO counter equals counterValue, resend the PHOF
         # and check that the FIFO counter indeed equals counterValue. If so, return the
         # PHOF and a flag that the FIFO calibration has been successful.
+        # All candidates are checked in one transaction, so the board is left with
+        # the last one set, and the successful PHOF must be set again if it differs.
         success = False
-        for PHOF in PHOFS:
-            pkt = [0x0700 + PHOF, 0x8700]
-            reading = long(((yield self._runSerial(op, pkt))[1] >> 4) & 0xF)
-            if reading == counterValue:
-                success = True
-                break
+        if len(PHOFS):
+            pkt = []
+            for PHOF in PHOFS:
+                pkt += [0x0700 + PHOF, 0x8700]
+            readings = yield self._runSerial(op, pkt)
+            for i, PHOF in enumerate(PHOFS):
+                reading = long((readings[2*i+1] >> 4) & 0xF)
+                if reading == counterValue:
+                    success = True
+                    break
+            if success and PHOF != PHOFS[-1]:
+                yield self._runSerial(op, [0x0700 + PHOF])
         ans = int(PHOF), success
         returnValue(ans)
     
@@ -588,41 +780,107 @@ class DacDevice(DeviceWrapper):
     
     def runBIST(self, cmd, shift, dataIn):
         """Run a BIST on the given SRAM sequence. (DAC only)"""
-        @inlineCallbacks
-        def func():
-            pkt = regRunSram(self, 0, 0, loop=False)
-            yield self._sendRegisters(pkt, readback=False)
-    
-            dat = [d & 0x3FFF for d in dataIn]
-            data = [0, 0, 0, 0] + [d << shift for d in dat]
-            # make sure data is at least 20 words long by appending 0's
-            data += [0] * (20-len(data))
-            data = np.array(data, dtype='<u4').tostring()
-            yield self._sendSRAM(data)
-            startAddr, endAddr = 0, len(data) / 4
-            yield self._runSerial(cmd, [0x0004, 0x1107, 0x1106])
-    
-            pkt = regRunSram(self, startAddr, endAddr, loop=False)
-            yield self._sendRegisters(pkt, readback=False)
+        return self.testMode(self._runBIST, cmd, shift, dataIn)
     
-            seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
-                   0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
-            theory = tuple(bistChecksum(dat))
-            bist = yield self._runSerial(cmd, seq)
-            reading = [(bist[i+4] <<  0) + (bist[i+3] <<  8) +
-                       (bist[i+2] << 16) + (bist[i+1] << 24)
-                       for i in [0, 5, 10, 15]]
-            lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
-    
-            # lvds and fifo may be reversed.  This is okay
-            lvds = lvds[::-1] if lvds[::-1] == theory else lvds
-            fifo = fifo[::-1] if fifo[::-1] == theory else fifo
-            returnValue((lvds == theory and fifo == theory, theory, lvds, fifo))
-        return self.testMode(func)
+    def bringup(self, lvdsOptimize=False, lvdsSD=None, signed=True, targetFifo=None, useCache=False):
+        """Run the bringup procedure, see _bringup."""
+        return self.testMode(self._bringup, lvdsOptimize, lvdsSD, signed, targetFifo, useCache)
     
+    @inlineCallbacks
+    def _bringup(self, lvdsOptimize=False, lvdsSD=None, signed=True, targetFifo=None, useCache=False):
+        """Initialize the PLL, then for each DAC set LVDS SD, set FIFO and run BIST.
+        
+        Returns a list with one entry for each DAC, each a tuple of (key, value)
+        pairs with the calibration results.  The SD, FIFO counter, clock
+        polarity and PHOF of DACs that were brought up successfully are kept
+        in bringupCache, which is saved in the registry.  If useCache is True,
+        bringup starts from the cached values, which usually work again, and
+        only searches if they do not.
+        """
+        ans = []
+        yield self._resetPLL()
+        yield task.deferLater(reactor, 0.100, lambda: None)
+        yield self._initPLL()
+        for dac in ['A','B']:
+            ansDAC = [('dac',dac)]
+            cmd, shift = {'A': (2, 0), 'B': (3, 14)}[dac]
+            cached = self.bringupCache.get(dac) if useCache else None
+            pkt = [0x0024, 0x0004, 0x1603, 0x0500] if signed else \
+                  [0x0026, 0x0006, 0x1603, 0x0500]
+            yield self._runSerial(cmd, pkt)
+            if cached is not None and lvdsSD is None and not lvdsOptimize:
+                lvdsAns = yield self._setLVDS(cmd, cached['lvdsSD'], False)
+                if not lvdsAns[0]:
+                    lvdsAns = yield self._setLVDS(cmd, None, True)
+            else:
+                lvdsAns = yield self._setLVDS(cmd, lvdsSD, lvdsOptimize)
+            lvdsKeys = ['lvdsSuccess','lvdsMSD','lvdsMHD','lvdsSD','lvdsTiming','lvdsCheck']
+            for key,val in zip(lvdsKeys,lvdsAns):
+                ansDAC.append((key,val))
+            if cached is not None:
+                target = cached['fifoCounter'] if targetFifo is None else targetFifo
+                start = (cached['fifoClockPolarity'], cached['fifoPHOF'])
+                fifoAns = yield self._setFIFO(dac, cmd, target, start)
+            else:
+                fifoAns = yield self._setFIFO(dac, cmd, targetFifo)
+            fifoKeys = ['fifoSuccess','fifoClockPolarity','fifoPHOF','fifoTries','fifoCounter']
+            for key,val in zip(fifoKeys,fifoAns):
+                ansDAC.append((key,val))
+            bistData = [random.randint(0, 0x3FFF) for i in range(1000)]
+            bistAns = yield self._runBIST(cmd, shift, bistData)
+            bistKeys = ['bistSuccess','bistTheory','bistLVDS','bistFIFO']
+            for key,val in zip(bistKeys,bistAns):
+                ansDAC.append((key,val))
+            results = dict(ansDAC)
+            if results['lvdsSuccess'] and results['fifoSuccess'] and results['bistSuccess']:
+                self.bringupCache[dac] = dict((key, results[key]) for key in
+                    ['lvdsSD', 'fifoCounter', 'fifoClockPolarity', 'fifoPHOF'])
+            else:
+                self.bringupCache.pop(dac, None)
+            ans.append(tuple(ansDAC))
+        yield self.saveBringupCache()
+        returnValue(ans)
 
+    @inlineCallbacks
+    def _runBIST(self, cmd, shift, dataIn):
+        pkt = regRunSram(self, 0, 0, loop=False)
+        yield self._sendRegisters(pkt, readback=False)
+
+        dat = [d & 0x3FFF for d in dataIn]
+        data = [0, 0, 0, 0] + [d << shift for d in dat]
+        # make sure data is at least 20 words long by appending 0's
+        data += [0] * (20-len(data))
+        data = np.array(data, dtype='<u4').tostring()
+        yield self._sendSRAM(data)
+        startAddr, endAddr = 0, len(data) / 4
+
+        # reset the BIST, run SRAM and read the BIST results in one transaction
+        seq = [0x1126, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x1166, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11A6, 0x9200, 0x9300, 0x9400, 0x9500,
+               0x11E6, 0x9200, 0x9300, 0x9400, 0x9500]
+        txn = self.transaction()
+        txn.addSerial(cmd, [0x0004, 0x1107, 0x1106])
+        txn.add(regRunSram(self, startAddr, endAddr, loop=False), readback=False)
+        idx = txn.addSerial(cmd, seq)
+        readbacks = yield txn.send()
+        theory = tuple(bistChecksum(dat))
+        bist = serialReadbacks(readbacks[idx[0]:])
+        reading = [(bist[i+4] <<  0) + (bist[i+3] <<  8) +
+                   (bist[i+2] << 16) + (bist[i+1] << 24)
+                   for i in [0, 5, 10, 15]]
+        lvds, fifo = tuple(reading[0:2]), tuple(reading[2:4])
+
+        # lvds and fifo may be reversed.  This is okay
+        lvds = lvds[::-1] if lvds[::-1] == theory else lvds
+        fifo = fifo[::-1] if fifo[::-1] == theory else fifo
+        returnValue((lvds == theory and fifo == theory, theory, lvds, fifo))
+    
+
+
+def serialReadbacks(readbacks):
+    """Get the serial DAC readback from each of a list of readback packets."""
+    return [int(processReadback(r)['serDAC']) for r in readbacks] # python ints, instead of numpy ints
 
 def shiftSRAM(device, cmds, page):
     """Shift the addresses of SRAM calls for different pages.
@@ -660,3 +918,16 @@ def parseBuildParameters(parametersFromRegistry, device):
     
 def parseBoardParameters(parametersFromRegistry, device):
     device.boardParams = dict(parametersFromRegistry)
+
+def parseBringupCache(parametersFromRegistry, device):
+    device.bringupCache = dict((dac, dict(params)) for dac, params in parametersFromRegistry)
+    for params in device.bringupCache.values():
+        params['fifoClockPolarity'] = bool(params['fifoClockPolarity'])
+
+def bringupCacheForRegistry(bringupCache):
+    """Convert bringupCache for the registry, the inverse of parseBringupCache.
+
+    All values are stored as integers, since registry lists must have one type.
+    """
+    return [(dac, [(key, int(val)) for key, val in sorted(params.items())])
+            for dac, params in sorted(bringupCache.items())]
@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import random
 import time
 
@@ -23,111 +24,507 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from labrad.server import LabradServer, setting
 
 
+# dispatch key patterns, as (source MAC, destination MAC, length) given
+DISPATCH_PATTERNS = [(s, d, n) for s in (True, False) for d in (True, False) for n in (True, False)]
+
+# lower edges (in seconds) of the bins of the collect wait time histogram
+WAIT_BINS = [0, 1e-3, 1e-2, 1e-1, 1, 10]
+
+
 class EthernetAdapter(object):
-    """Proxy for an ethernet adapter."""
+    """Proxy for an ethernet adapter.
+    
+    Listeners are indexed by the source MAC, destination MAC and length
+    they require (their dispatchKey, with None for any), so a packet is
+    only passed to the listeners that can accept it.  Plain functions
+    without a dispatchKey get every packet.
+    
+    If a fault profile is set, packets sent on the adapter may be
+    dropped, delayed, reordered or duplicated as the profile says.
+    """
     def __init__(self, name, mac):
         self.name = name
         self.mac = mac
         self.listeners = []
+        self.index = {}
+        self.patterns = []
+        self.faults = None
+        self.held = []
     
     def send(self, pkt):
         """Send a packet on this adapter."""
+        if self.faults is None:
+            self.deliver(pkt)
+            return
+        rule = self.faults.choose(pkt)
+        if rule is None:
+            self.deliver(pkt)
+            self._passHeld()
+        elif rule.action == 'drop':
+            pass
+        elif rule.action == 'delay':
+            reactor.callLater(rule.delay, self.deliver, pkt)
+        elif rule.action == 'duplicate':
+            for i in range(rule.n + 1):
+                self.deliver(pkt)
+        elif rule.action == 'reorder':
+            # hold the packet until n later packets have gone past it
+            entry = [rule.n, pkt, None]
+            entry[2] = reactor.callLater(rule.delay, self._release, entry)
+            self.held.append(entry)
+    
+    def deliver(self, pkt):
+        """Pass a packet to the listeners whose dispatch key matches it."""
+        src, dest, typ, data = pkt
+        n = len(data)
+        index = self.index
+        for hasSrc, hasDest, hasLen in self.patterns:
+            key = (src if hasSrc else None, dest if hasDest else None, n if hasLen else None)
+            for listener in index.get(key, ()):
+                listener(pkt)
+    
+    def reindex(self):
+        """Rebuild the dispatch index, after listeners or their filters change."""
+        index = {}
         for listener in self.listeners:
-            listener(pkt)
+            key = getattr(listener, 'dispatchKey', (None, None, None))
+            index.setdefault(key, []).append(listener)
+        self.index = index
+        self.patterns = [p for p in DISPATCH_PATTERNS
+                         if any((k[0] is not None, k[1] is not None, k[2] is not None) == p
+                                for k in index)]
+    
+    def _passHeld(self):
+        for entry in list(self.held):
+            entry[0] -= 1
+            if entry[0] <= 0:
+                entry[2].cancel()
+                self._release(entry)
+    
+    def _release(self, entry):
+        if entry in self.held:
+            self.held.remove(entry)
+            self.deliver(entry[1])
     
     def addListener(self, listener):
         """Add a listener to be called for each sent packet."""
         self.listeners.append(listener)
+        if isinstance(listener, EthernetListener):
+            listener.adapter = self
+        self.reindex()
 
     def removeListener(self, listener):
         """Remove a listener from this adapter."""
         self.listeners.remove(listener)
+        if isinstance(listener, EthernetListener):
+            listener.adapter = None
+        self.reindex()
 
 
 class LossyEthernetAdapter(EthernetAdapter):
-    """Proxy for a lossy ethernet adapter that can drop packets."""
-    def __init__(self, name, mac, pLoss=0.01):
+    """Proxy for a lossy ethernet adapter that drops a random fraction of packets."""
+    def __init__(self, name, mac, pLoss=0.01, seed=0):
         EthernetAdapter.__init__(self, name, mac)
         self.pLoss = pLoss
+        self.faults = FaultProfile([FaultRule('drop', p=pLoss)], seed)
+
+
+class FaultRule(object):
+    """One rule of a fault profile.
     
-    def send(self, pkt):
-        """Send a packet on this adapter."""
-        for listener in listeners:
-            if random.random() < self.pLoss:
-                continue # simulate dropped packet
-            listener(pkt)
+    A rule matches packets by source MAC (src), destination MAC (dest),
+    either MAC (mac) and data length.  Matching packets are counted from 0,
+    and the rule fires for the listed ordinals, for every Nth matching
+    packet and/or with probability p, at most count times.  When it fires:
+        drop      - the packet is lost
+        delay     - the packet is delivered after delay seconds
+        reorder   - the packet is held back until n more packets have
+                    been delivered, or delay seconds have passed
+        duplicate - the packet is delivered n extra times
+    """
+    ACTIONS = ['drop', 'delay', 'reorder', 'duplicate']
+    
+    def __init__(self, action, src=None, dest=None, mac=None, length=None,
+                 ordinals=None, every=None, p=None, count=None, delay=0.01, n=1, text=None):
+        if action not in self.ACTIONS:
+            raise Exception('Unknown fault action: %s' % action)
+        self.action = action
+        self.src = src
+        self.dest = dest
+        self.mac = mac
+        self.length = length
+        self.ordinals = ordinals
+        self.every = every
+        self.p = p
+        self.count = count
+        self.delay = delay
+        self.n = n
+        self.text = text or action
+        self.matched = 0
+        self.fired = 0
+    
+    def matches(self, pkt):
+        src, dest, typ, data = pkt
+        if self.src is not None and src != self.src:
+            return False
+        if self.dest is not None and dest != self.dest:
+            return False
+        if self.mac is not None and self.mac not in (src, dest):
+            return False
+        if self.length is not None and len(data) != self.length:
+            return False
+        return True
+    
+    def fires(self, ordinal, rand):
+        """Decide whether the rule fires for the matching packet with this ordinal."""
+        if self.count is not None and self.fired >= self.count:
+            return False
+        if self.ordinals is not None and ordinal not in self.ordinals:
+            return False
+        if self.every is not None and (ordinal + 1) % self.every:
+            return False
+        if self.p is not None and rand.random() >= self.p:
+            return False
+        self.fired += 1
+        return True
+    
+    @classmethod
+    def parse(cls, line):
+        """Parse a rule like 'drop dest=00:01:CA:AA:00:01 length=70 every=100'.
+        
+        ordinal takes a comma separated list of numbers and ranges, e.g. 3,10-20.
+        """
+        words = line.split()
+        kw = {}
+        for word in words[1:]:
+            key, value = word.split('=', 1)
+            if key in ['src', 'dest', 'mac']:
+                kw[key] = parseMac(value)
+            elif key in ['length', 'every', 'count', 'n']:
+                kw[key] = int(value)
+            elif key in ['p', 'delay']:
+                kw[key] = float(value)
+            elif key == 'ordinal':
+                ordinals = set()
+                for part in value.split(','):
+                    lo, _, hi = part.partition('-')
+                    ordinals.update(range(int(lo), int(hi or lo) + 1))
+                kw['ordinals'] = ordinals
+            else:
+                raise Exception('Unknown fault rule parameter: %s' % key)
+        return cls(words[0], text=' '.join(words), **kw)
+
+
+class FaultProfile(object):
+    """A list of fault rules with a seeded random number generator.
+    
+    Every rule counts the packets it matches, whatever happens to them.
+    The first rule that fires for a packet decides what happens to it,
+    so a profile replayed against the same packet sequence with the same
+    seed injects exactly the same faults.
+    """
+    def __init__(self, rules=[], seed=0):
+        self.rules = list(rules)
+        self.seed = seed
+        self.random = random.Random(seed)
+    
+    def choose(self, pkt):
+        """Get the rule that fires for this packet, or None."""
+        chosen = None
+        for rule in self.rules:
+            if rule.matches(pkt):
+                ordinal = rule.matched
+                rule.matched += 1
+                if chosen is None and rule.fires(ordinal, self.random):
+                    chosen = rule
+        return chosen
+    
+    @property
+    def text(self):
+        return '\n'.join(['seed %d' % self.seed] + [rule.text for rule in self.rules])
+    
+    @classmethod
+    def parse(cls, text):
+        """Parse a profile script, with one rule or 'seed <n>' per line.
+        
+        Blank lines and anything after a # are ignored.
+        """
+        rules = []
+        seed = 0
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('seed'):
+                seed = int(line.split()[1])
+            else:
+                rules.append(FaultRule.parse(line))
+        return cls(rules, seed)
 
 
 class EthernetListener(object):
     """Listens for packets on an adapter.
     
-    Filters can be added which examine incoming packets and
-    return a boolean result.  Only if all filters match will
-    a given packet be passed on.
+    Required source MAC, destination MAC and length go into the dispatch
+    key used by the adapter, so packets that don't match them never reach
+    the listener.  Rejected MACs, lengths and ether types are checked with
+    set lookups, and other filters, which examine incoming packets and
+    return a boolean result, can be added too.  These are compiled into a
+    single check whenever they change.  Only if all filters match will a
+    given packet be passed on.
+    
+    The listener counts the packets it gets and the packets that it
+    filters out (or gets before listening), in total and for each source
+    MAC as sources[mac] = [received, filtered].
     """
     def __init__(self, packetFunc):
         self.packetFunc = packetFunc
         self.listening = False
+        self.adapter = None
+        self.required = {}
+        self.rejected = {'src': set(), 'dest': set(), 'length': set(), 'typ': set()}
         self.filters = []
+        self.dispatchKey = (None, None, None)
+        self.check = None
+        self.resetCounts()
     
     def __call__(self, packet):
-        if self.listening and all(filter(packet) for filter in self.filters):
+        self.received += 1
+        counts = self.sources.get(packet[0])
+        if counts is None:
+            counts = self.sources[packet[0]] = [0, 0]
+        counts[0] += 1
+        if self.listening and (self.check is None or self.check(packet)):
             self.packetFunc(packet)
+        else:
+            self.filtered += 1
+            counts[1] += 1
+    
+    def resetCounts(self):
+        self.received = 0
+        self.filtered = 0
+        self.sources = {}
+    
+    def require(self, field, value):
+        """Require packets to have the given src, dest, length or typ."""
+        if self.required.get(field, value) != value:
+            self.filters.append(lambda pkt: False) # conflicting requirements
+        self.required[field] = value
+        self._compile()
+    
+    def reject(self, field, value):
+        """Reject packets with the given src, dest, length or typ."""
+        self.rejected[field].add(value)
+        self._compile()
     
     def addFilter(self, filter):
         self.filters.append(filter)
+        self._compile()
+    
+    def _compile(self):
+        req, rej = self.required, self.rejected
+        tests = []
+        if 'typ' in req:
+            typ = req['typ']
+            tests.append(lambda pkt: pkt[2] == typ)
+        for field, get in [('src', lambda pkt: pkt[0]), ('dest', lambda pkt: pkt[1]),
+                           ('length', lambda pkt: len(pkt[3])), ('typ', lambda pkt: pkt[2])]:
+            values = frozenset(rej[field])
+            if values:
+                tests.append(lambda pkt, get=get, values=values: get(pkt) not in values)
+        tests += self.filters
+        if not tests:
+            self.check = None
+        elif len(tests) == 1:
+            self.check = tests[0]
+        else:
+            self.check = lambda pkt: all(test(pkt) for test in tests)
+        self.dispatchKey = (req.get('src'), req.get('dest'), req.get('length'))
+        if self.adapter is not None:
+            self.adapter.reindex()
 
 
 class DeferredBuffer(object):
-    """Buffer for packets/triggers received in a given context."""
-    def __init__(self):
-        self.buf = []
-        self.waiter = None
-        self.waitCount = 0
-    
-    def put(self, packet):
-        self.buf.append(packet)
-        if self.waiter and len(self.buf) >= self.waitCount:
-            d = self.waiter
-            self.waiter = None
+    """Ring buffer for packets/triggers received in a given context.
+    
+    Items are kept in a preallocated ring of slots, so put is O(1) and
+    get/discard of n items costs O(n) however many items are buffered.
+    The ring doubles in size when it fills up.  If packets is True, items
+    are packets (src, dest, typ, data) and the data of each packet is
+    copied into a fixed-size slot of one numpy block, which is widened if
+    a longer packet arrives.
+    
+    Any number of callers can wait on the buffer, each with its own
+    timeout.  Waiters are served in the order they started waiting.
+    
+    The buffer counts the items collected (read), discarded (including
+    by clear) and the waits that timed out, keeps the highest number of
+    items it has held, and keeps a histogram of the time spent waiting
+    in collect, with bins starting at WAIT_BINS.
+    """
+    def __init__(self, packets=False, capacity=256, slotSize=128):
+        self.packets = packets
+        self.capacity = capacity
+        self.items = [None] * capacity
+        if packets:
+            self.data = np.zeros((capacity, slotSize), dtype='uint8')
+            self.lengths = np.zeros(capacity, dtype='int32')
+        self.head = 0
+        self.count = 0
+        self.waiters = []
+        self.resetCounts()
+    
+    def resetCounts(self):
+        self.collected = 0
+        self.discarded = 0
+        self.timedOut = 0
+        self.highWater = self.count
+        self.waitCounts = [0] * len(WAIT_BINS)
+    
+    def __len__(self):
+        return self.count
+    
+    def put(self, item):
+        if self.count == self.capacity:
+            self._resize(2 * self.capacity, self.data.shape[1] if self.packets else 0)
+        i = (self.head + self.count) % self.capacity
+        if self.packets:
+            src, dest, typ, data = item
+            n = len(data)
+            if n > self.data.shape[1]:
+                width = self.data.shape[1]
+                while width < n:
+                    width *= 2
+                self._resize(self.capacity, width)
+                i = self.count
+            self.data[i, :n] = data
+            self.lengths[i] = n
+            item = (src, dest, typ)
+        self.items[i] = item
+        self.count += 1
+        if self.count > self.highWater:
+            self.highWater = self.count
+        if self.waiters and self.count >= self.waiters[0][0]:
+            self._wake()
+    
+    def _indices(self, n):
+        """Slot indices of the n oldest items."""
+        return (self.head + np.arange(n)) % self.capacity
+    
+    def _resize(self, capacity, width):
+        """Move the buffered items to the start of a new ring."""
+        idx = self._indices(self.count)
+        self.items = [self.items[i] for i in idx] + [None] * (capacity - self.count)
+        if self.packets:
+            data = np.zeros((capacity, width), dtype='uint8')
+            w = min(width, self.data.shape[1])
+            data[:self.count, :w] = self.data[idx, :w]
+            lengths = np.zeros(capacity, dtype='int32')
+            lengths[:self.count] = self.lengths[idx]
+            self.data, self.lengths = data, lengths
+        self.capacity = capacity
+        self.head = 0
+    
+    def _pop(self, n):
+        """Remove and return the n oldest items."""
+        idx = self._indices(n)
+        items = [self.items[i] for i in idx]
+        if self.packets:
+            lengths = self.lengths[idx]
+            block = self.data[idx] # fancy indexing copies the slots
+            items = [(src, dest, typ, block[k, :lengths[k]])
+                     for k, (src, dest, typ) in enumerate(items)]
+        self._drop(n)
+        self.collected += n
+        return items
+    
+    def _popBlock(self, n, start, end):
+        """Remove the n oldest packets and return their data as one byte string.
+        
+        Each payload is cut to bytes [start:end] and padded with zeros to
+        the full stride, so that payload k is data[k*stride:(k+1)*stride].
+        If end is None, the stride runs to the end of the longest packet.
+        Returns (stride, data).
+        """
+        idx = self._indices(n)
+        lengths = self.lengths[idx]
+        if end is None:
+            end = int(lengths.max()) if n else start
+        stride = max(end - start, 0)
+        block = np.zeros((n, stride), dtype='uint8')
+        width = max(min(end, self.data.shape[1]) - start, 0)
+        if width:
+            block[:, :width] = self.data[idx, start:start+width]
+            if n and lengths.min() < start + width:
+                # zero whatever is left in the slots past the end of short packets
+                block[start + np.arange(stride) >= lengths[:, np.newaxis]] = 0
+        self._drop(n)
+        self.collected += n
+        return stride, block.tostring()
+    
+    def _drop(self, n):
+        self.head = (self.head + n) % self.capacity
+        self.count -= n
+    
+    def _discard(self, n):
+        self._drop(n)
+        self.discarded += n
+    
+    def _wait(self, n, timeout, timed=False):
+        """Get a Deferred that fires when n items are buffered.
+        
+        If timed is True, the wait time goes into the histogram.
+        """
+        if self.count >= n and not self.waiters:
+            if timed:
+                self.waitCounts[0] += 1
+            return defer.succeed(None)
+        d = defer.Deferred()
+        waiter = [n, d, None, time.time() if timed else None]
+        if timeout is not None:
+            waiter[2] = reactor.callLater(timeout, self._timeout, waiter)
+        self.waiters.append(waiter)
+        return d
+    
+    def _wake(self):
+        while self.waiters and self.count >= self.waiters[0][0]:
+            n, d, timeoutCall, start = self.waiters.pop(0)
+            if timeoutCall is not None and timeoutCall.active():
+                timeoutCall.cancel()
+            if start is not None:
+                self.waitCounts[bisect.bisect_right(WAIT_BINS, time.time() - start) - 1] += 1
             d.callback(None)
     
+    def _timeout(self, waiter):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+            self.timedOut += 1
+            waiter[1].errback(Exception('timeout'))
+            self._wake()
+    
     def collect(self, n=1, timeout=None):
-        assert (self.waiter is None), 'already waiting'
-        if len(self.buf) >= n:
-            return defer.succeed()
-        else:
-            d = defer.Deferred()
-            if timeout is not None:
-                timeoutCall = reactor.callLater(timeout, d.errback, Exception('timeout'))
-                d.addCallback(self._cancelTimeout, timeoutCall)
-            self.waiter = d
-            self.waitCount = n
-            return d
-
-    def _cancelTimeout(self, result, timeoutCall):
-        if timeoutCall.active():
-            timeoutCall.cancel()
-        return result
+        return self._wait(n, timeout, timed=True)
     
     def get(self, n=1, timeout=None):
-        def _get(result):
-            pkts = self.buf[:n]
-            self.buf = self.buf[n:]
-            return pkts
-        d = self.collect(n)
-        d.addCallback(_get)
+        d = self._wait(n, timeout)
+        d.addCallback(lambda result: self._pop(n))
+        return d
+    
+    def getBlock(self, n=1, start=0, end=None, timeout=None):
+        d = self._wait(n, timeout)
+        d.addCallback(lambda result: self._popBlock(n, start, end))
         return d
     
     def discard(self, n=1, timeout=None):
-        def _discard(result):
-            self.buf = self.buf[n:]
-        d = self.collect(n)
-        d.addCallback(_discard)
+        d = self._wait(n, timeout)
+        d.addCallback(lambda result: self._discard(n))
         return d
     
     def clear(self):
-        self.buf = []
+        self.discarded += self.count
+        self.items = [None] * self.capacity
+        self.head = 0
+        self.count = 0
 
 
 def parseMac(mac):
@@ -154,7 +551,7 @@ class DirectEthernetProxy(LabradServer):
 
     def initContext(self, c):
         c['triggers'] = DeferredBuffer()
-        c['buf'] = DeferredBuffer()
+        c['buf'] = DeferredBuffer(packets=True)
         c['timeout'] = None
         c['listener'] = EthernetListener(c['buf'].put)
         c['listening'] = False
@@ -163,7 +560,7 @@ class DirectEthernetProxy(LabradServer):
         c['typ'] = -1
 
     def expireContext(self, c):
-        if c['listening']:
+        if 'adapter' in c:
             c['adapter'].removeListener(c['listener'])
 
     def getAdapter(self, c):
@@ -179,7 +576,7 @@ class DirectEthernetProxy(LabradServer):
     @setting(1, 'Adapters', returns='*(ws)')
     def adapters(self, c):
         """Retrieves a list of network adapters"""
-        adapterList = sorted((id, a.name) for id, a in self.adapters)
+        adapterList = sorted((id, a.name) for id, a in self.adapters.items() if isinstance(id, int))
         return adapterList
 
     @setting(2, 'Connect', key=['s', 'w'], returns='s')
@@ -189,7 +586,7 @@ class DirectEthernetProxy(LabradServer):
         except KeyError:
             raise Exception('Adapter not found: %s' % key)
         if 'adapter' in c:
-            c['adapter'].removeListener(listener)
+            c['adapter'].removeListener(c['listener'])
         adapter.addListener(c['listener'])
         c['adapter'] = adapter
         return adapter.name
@@ -215,15 +612,15 @@ class DirectEthernetProxy(LabradServer):
         yield c['buf'].discard(num, timeout=c['timeout'])
 
     @setting(13, 'Read', num=['w'], returns=['(ssis)', '*(ssis)'])
-    def read(self, c, num=1):
+    def read(self, c, num=None):
         def toStr(pkt):
             src, dest, typ, data = pkt
-            data = np.tostring(data)
+            data = data.tostring()
             return (src, dest, typ, data)
         return self._read(c, num, toStr)
 
     @setting(14, 'Read as Words', num=['w'], returns=['(ssi*w)', '*(ssi*w)'])
-    def read_as_words(self, c, num):
+    def read_as_words(self, c, num=None):
         def toWords(pkt):
             src, dest, typ, data = pkt
             data = np.fromstring(data, dtype='uint8').astype('uint32')
@@ -232,10 +629,14 @@ class DirectEthernetProxy(LabradServer):
 
     @inlineCallbacks
     def _read(self, c, num, func=None):
-        pkts = yield c['buf'].read(num, timeout=c['timeout'])
-        if func is None:
+        """Read packets from the buffer.
+        
+        If num is None, a single packet is returned, otherwise a list.
+        """
+        pkts = yield c['buf'].get(1 if num is None else num, timeout=c['timeout'])
+        if func is not None:
             pkts = [func(pkt) for pkt in pkts]
-        if num == 1:
+        if num is None:
             returnValue(pkts[0])
         else:
             returnValue(pkts)
@@ -243,6 +644,73 @@ class DirectEthernetProxy(LabradServer):
     @setting(15, 'Clear', returns='')
     def clear(self, c):
         c['buf'].clear()
+
+    @setting(16, 'Read Bulk', num='w', start='w', end='w', returns='(ws)')
+    def read_bulk(self, c, num, start=0, end=None):
+        """Read num packets as a single byte string of payloads.
+        
+        Each payload is trimmed to bytes [start:end] and zero padded to a
+        fixed stride, so payload k is data[k*stride:(k+1)*stride].  If end
+        is not given, the stride is the length of the longest packet.
+        Returns (stride, data).
+        """
+        if end is not None and end < start:
+            raise Exception('end (%d) must not be less than start (%d)' % (end, start))
+        return c['buf'].getBlock(num, start, end, timeout=c['timeout'])
+
+
+    # statistics
+
+    def _statContexts(self, c, all):
+        """Get the context data for statistics, this context or all of them."""
+        if not all:
+            return [c]
+        return [ctx.data for ctx in self.contexts.values() if 'buf' in getattr(ctx, 'data', {})]
+
+    @setting(17, 'Statistics', all='b', reset='b', returns='*(swwwwwww)')
+    def statistics(self, c, all=False, reset=False):
+        """Get packet counters for this context, or for all contexts.
+        
+        Returns rows of (name, received, filtered, buffered, collected,
+        discarded, timed out, buffer high-water mark), first one for each
+        context, named by its ID, and then one for each source MAC that
+        packets were received from, totalled over the contexts.  Only the
+        first three counters apply to MACs.  If reset is True, the
+        counters and wait histograms are set to zero after they are read.
+        """
+        rows = []
+        sources = {}
+        for ctx in self._statContexts(c, all):
+            listener, buf = ctx['listener'], ctx['buf']
+            rows.append(('%d,%d' % tuple(ctx.ID), listener.received, listener.filtered,
+                         listener.received - listener.filtered, buf.collected,
+                         buf.discarded, buf.timedOut, buf.highWater))
+            for mac, (received, filtered) in listener.sources.items():
+                counts = sources.setdefault(mac, [0, 0])
+                counts[0] += received
+                counts[1] += filtered
+            if reset:
+                listener.resetCounts()
+                buf.resetCounts()
+        for mac, (received, filtered) in sorted(sources.items()):
+            rows.append((mac, received, filtered, received - filtered, 0, 0, 0, 0))
+        return rows
+
+    @setting(18, 'Wait Histogram', all='b', reset='b', returns='*(v[s]w)')
+    def wait_histogram(self, c, all=False, reset=False):
+        """Get the histogram of time spent waiting in Collect.
+        
+        Returns (lower bin edge, count) for this context or, if all is
+        True, summed over all contexts.  If reset is True, the counts are
+        set to zero after they are read.
+        """
+        counts = [0] * len(WAIT_BINS)
+        for ctx in self._statContexts(c, all):
+            buf = ctx['buf']
+            counts = [a + b for a, b in zip(counts, buf.waitCounts)]
+            if reset:
+                buf.waitCounts = [0] * len(WAIT_BINS)
+        return zip(WAIT_BINS, counts)
     
 
     # writing packets
@@ -286,42 +754,42 @@ class DirectEthernetProxy(LabradServer):
     @setting(100, 'Require Source MAC', mac=['s', 'wwwwww'], returns='s')
     def require_source_mac(self, c, mac):
         mac = parseMac(mac)
-        c['listener'].addFilter(lambda pkt: pkt[0] == mac)
+        c['listener'].require('src', mac)
         return mac
     
     @setting(101, 'Reject Source MAC', mac=['s', 'wwwwww'], returns='s')
     def reject_source_mac(self, c, mac):
         mac = parseMac(mac)
-        c['listener'].addFilter(lambda pkt: pkt[0] != mac)
+        c['listener'].reject('src', mac)
         return mac
     
     @setting(110, 'Require Destination MAC', mac=['s', 'wwwwww'], returns='s')
     def require_destination_mac(self, c, mac):
         mac = parseMac(mac)
-        c['listener'].addFilter(lambda pkt: pkt[1] == mac)
+        c['listener'].require('dest', mac)
         return mac
     
     @setting(111, 'Reject Destination MAC', mac=['s', 'wwwwww'], returns='s')
     def reject_destination_mac(self, c, mac):
         mac = parseMac(mac)
-        c['listener'].addFilter(lambda pkt: pkt[1] != mac)
+        c['listener'].reject('dest', mac)
         return mac
 
     @setting(120, 'Require Length', length='w', returns='')
     def require_length(self, c, length):
-        c['listener'].addFilter(lambda pkt: len(pkt[3]) == length)
+        c['listener'].require('length', length)
         
     @setting(121, 'Reject Length', length='w', returns='')
     def reject_length(self, c, length):
-        c['listener'].addFilter(lambda pkt: len(pkt[3]) != length)
+        c['listener'].reject('length', length)
 
     @setting(130, 'Require Ether Type', typ='i', returns='')
     def require_ether_type(self, c, typ):
-        c['listener'].addFilter(lambda pkt: pkt[2] == typ)
+        c['listener'].require('typ', typ)
         
     @setting(131, 'Reject Ether Type', typ='i', returns='')
     def reject_ether_type(self, c, typ):
-        c['listener'].addFilter(lambda pkt: pkt[2] != typ)
+        c['listener'].reject('typ', typ)
     
     @setting(140, 'Require Content', offset='w', data=['s', '*w'], returns='')
     def require_content(self, c, offset, data):
@@ -332,6 +800,42 @@ class DirectEthernetProxy(LabradServer):
         raise Exception('not implemented')
 
 
+    # fault injection
+
+    @setting(300, 'Fault Profile', key=['s', 'w'], profile='s', returns='s')
+    def fault_profile(self, c, key, profile=None):
+        """Get or set the fault profile of an adapter.
+        
+        The profile is a script with one rule per line, for example
+            seed 1234
+            drop dest=00:01:CA:AA:00:01 length=70 p=0.01
+            delay src=00:01:CA:AA:01:01 every=10 delay=0.05
+            reorder length=70 ordinal=100-200 n=2
+            duplicate ordinal=5
+        See FaultRule for the rule parameters.  Setting a profile resets
+        its counters and random number generator; an empty profile turns
+        fault injection off.
+        """
+        try:
+            adapter = self.adapters[key]
+        except KeyError:
+            raise Exception('Adapter not found: %s' % key)
+        if profile is not None:
+            adapter.faults = FaultProfile.parse(profile) if profile.strip() else None
+        return adapter.faults.text if adapter.faults is not None else ''
+
+    @setting(301, 'Fault Statistics', key=['s', 'w'], returns='*(sww)')
+    def fault_statistics(self, c, key):
+        """Get (rule, packets matched, faults injected) for each fault rule of an adapter."""
+        try:
+            adapter = self.adapters[key]
+        except KeyError:
+            raise Exception('Adapter not found: %s' % key)
+        if adapter.faults is None:
+            return []
+        return [(rule.text, rule.matched, rule.fired) for rule in adapter.faults.rules]
+
+
     # triggers
 
     @setting(200, 'Send Trigger', context='ww', returns='')
@@ -351,22 +855,37 @@ class DirectEthernetProxy(LabradServer):
     
 
 if __name__ == '__main__':
+    import sys
     from labrad import util
-    import adc
-    import dac
+    
+    if len(sys.argv) > 1 and not sys.argv[1].startswith('-'):
+        # python direct_ethernet_proxy.py LINK [LINK...]
+        # each adapter is linked to boards in another process, see ethernet_transport
+        from ethernet_transport import DatagramTransport, TransportAdapter
+        links = [a for a in sys.argv[1:] if not a.startswith('-')]
+        sys.argv[1:] = [a for a in sys.argv[1:] if a.startswith('-')]
+        adapters = [TransportAdapter('proxy%d' % i, '01:23:45:67:89:%02X' % i,
+                                     DatagramTransport.fromLink(link))
+                    for i, link in enumerate(links)]
+        util.runServer(DirectEthernetProxy(adapters))
+        sys.exit(0)
+    
+    from FPGA_simulation import DACWrapper, ADCWrapper, DaisyChain
     
     # create ethernet
     adapter0 = EthernetAdapter('proxy0', '01:23:45:67:89:00')
     adapter1 = EthernetAdapter('proxy1', '01:23:45:67:89:01')
+    chain0 = DaisyChain()
+    chain1 = DaisyChain()
     
     # create devices
-    dev00 = dac.DACProxy(0, adapter0)
-    dev01 = dac.ADCProxy(1, adapter0)
-    dev02 = dac.DACProxy(2, adapter0)
+    dev00 = DACWrapper(0, adapter0, chain0)
+    dev01 = ADCWrapper(1, adapter0, chain0)
+    dev02 = DACWrapper(2, adapter0, chain0)
     
-    dev10 = dac.DACProxy(0, adapter1)
-    dev11 = dac.DACProxy(1, adapter1)
-    dev12 = dac.ADCProxy(2, adapter1)
+    dev10 = DACWrapper(0, adapter1, chain1)
+    dev11 = DACWrapper(1, adapter1, chain1)
+    dev12 = ADCWrapper(2, adapter1, chain1)
     
     server = DirectEthernetProxy([adapter0, adapter1])
     util.runServer(server)
@@ -0,0 +1,231 @@
+"""Local datagram transport for direct ethernet proxy adapters.
+
+An EthernetAdapter (see direct_ethernet_proxy) only passes packets between
+listeners in one process.  A TransportAdapter also forwards every packet
+delivered on it to peer adapters in other processes, and delivers the
+packets it receives from them to its own listeners.  This lets the proxy
+and the emulated boards of FPGA_simulation run as separate processes, as
+they would with a real ethernet server and real boards.
+
+Peers are reached through datagram sockets on the local machine, either
+UDP on loopback or UNIX datagram sockets.  Addresses are written as
+    udp:127.0.0.1:7100
+    unix:/tmp/ghz_proxy0.sock
+and a link, as given on the command line, is the local address followed
+by the peer addresses, separated by commas:
+    udp:127.0.0.1:7100,udp:127.0.0.1:7101
+
+Packets delivered in one pass of the reactor are sent together, packed
+into as few datagrams as possible, so that a burst of timing packets costs
+a handful of system calls rather than one per packet.  Each datagram is
+BATCH_MAGIC followed by frames, each a FRAME header (source MAC, destination
+MAC, ether type, data length) and the packet data.  When the socket queue
+of a peer is full (UNIX sockets only queue a few datagrams), sending is
+retried until it drains.  UDP gives no such warning, so as on real ethernet
+datagrams that do not fit in the receive buffer of a peer are lost.
+"""
+
+import errno
+import os
+import socket
+import struct
+
+import numpy as np
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+
+from direct_ethernet_proxy import EthernetAdapter
+
+
+BATCH_MAGIC = 'GHZE'
+FRAME = struct.Struct('<17s17siH')
+MAX_DATAGRAM = 65000 # fits in a UDP datagram on loopback
+SOCKET_BUFFER = 4 * 1024 * 1024
+RETRY_DELAY = 0.0005 # seconds to wait when a peer's socket queue is full
+
+
+def parseAddress(spec):
+    """Parse an address into (kind, address) for a udp or unix socket."""
+    kind, _, rest = spec.partition(':')
+    if kind == 'udp':
+        host, _, port = rest.rpartition(':')
+        return kind, (host or '127.0.0.1', int(port))
+    elif kind == 'unix':
+        return kind, rest
+    raise Exception("Unknown transport address '%s', expected udp:host:port or unix:path" % spec)
+
+def parseLink(spec):
+    """Parse a link 'local,peer[,peer...]' into (local, [peers])."""
+    addresses = [s.strip() for s in spec.split(',') if s.strip()]
+    if len(addresses) < 2:
+        raise Exception("Link '%s' needs a local address and at least one peer" % spec)
+    return addresses[0], addresses[1:]
+
+
+def encodeFrames(pkts, maxSize=MAX_DATAGRAM):
+    """Pack packets (src, dest, typ, data) into a list of datagrams."""
+    datagrams = []
+    parts, size = [BATCH_MAGIC], len(BATCH_MAGIC)
+    for src, dest, typ, data in pkts:
+        if not isinstance(data, str):
+            data = data.tostring()
+        n = FRAME.size + len(data)
+        if size + n > maxSize and len(parts) > 1:
+            datagrams.append(''.join(parts))
+            parts, size = [BATCH_MAGIC], len(BATCH_MAGIC)
+        parts.append(FRAME.pack(src, dest, typ, len(data)))
+        parts.append(data)
+        size += n
+    if len(parts) > 1:
+        datagrams.append(''.join(parts))
+    return datagrams
+
+def decodeFrames(datagram):
+    """Unpack a datagram into a list of packets (src, dest, typ, data).
+
+    The data of all packets are views into one array copied from the
+    datagram.
+    """
+    if datagram[:len(BATCH_MAGIC)] != BATCH_MAGIC:
+        return []
+    buf = np.fromstring(datagram, dtype='uint8')
+    pkts = []
+    i, end = len(BATCH_MAGIC), len(datagram)
+    while i + FRAME.size <= end:
+        src, dest, typ, n = FRAME.unpack_from(datagram, i)
+        i += FRAME.size
+        pkts.append((src, dest, typ, buf[i:i+n]))
+        i += n
+    return pkts
+
+
+class _DatagramProtocol(DatagramProtocol):
+    def __init__(self, transport):
+        self.owner = transport
+
+    def datagramReceived(self, datagram, addr=None):
+        self.owner.received(datagram)
+
+
+class DatagramTransport(object):
+    """Sends and receives batches of packets on a local datagram socket."""
+
+    def __init__(self, local, peers, maxSize=MAX_DATAGRAM):
+        self.kind, self.address = parseAddress(local)
+        self.peers = []
+        for peer in peers:
+            kind, address = parseAddress(peer)
+            if kind != self.kind:
+                raise Exception("Cannot link %s address '%s' to %s peer '%s'" % (self.kind, local, kind, peer))
+            self.peers.append(address)
+        self.maxSize = maxSize
+        self.port = None
+        self.callback = None
+        self.pending = []
+        self.retryCall = None
+        self.datagramsSent = 0
+        self.datagramsReceived = 0
+        self.sendErrors = 0
+
+    @classmethod
+    def fromLink(cls, spec):
+        local, peers = parseLink(spec)
+        return cls(local, peers)
+
+    def start(self, callback):
+        """Start listening, calling callback with each list of received packets."""
+        self.callback = callback
+        protocol = _DatagramProtocol(self)
+        if self.kind == 'udp':
+            host, port = self.address
+            self.port = reactor.listenUDP(port, protocol, interface=host, maxPacketSize=self.maxSize)
+        else:
+            if os.path.exists(self.address):
+                os.remove(self.address) # left over from an earlier run
+            self.port = reactor.listenUNIXDatagram(self.address, protocol, maxPacketSize=self.maxSize)
+        sock = self.port.socket
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER)
+            except socket.error:
+                pass # keep the system default
+
+    def stop(self):
+        if self.retryCall is not None:
+            self.retryCall.cancel()
+            self.retryCall = None
+        if self.port is not None:
+            self.port.stopListening()
+            self.port = None
+            if self.kind == 'unix' and os.path.exists(self.address):
+                os.remove(self.address)
+
+    def write(self, pkts):
+        """Send packets to all peers."""
+        for datagram in encodeFrames(pkts, self.maxSize):
+            self.pending.extend((datagram, peer) for peer in self.peers)
+        if self.retryCall is None:
+            self._send()
+
+    def _send(self):
+        """Send pending datagrams until done or a peer's queue is full."""
+        self.retryCall = None
+        sock = self.port.socket
+        sent = 0
+        for datagram, peer in self.pending:
+            try:
+                sock.sendto(datagram, peer)
+                self.datagramsSent += 1
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    self.retryCall = reactor.callLater(RETRY_DELAY, self._send)
+                    break
+                # peer not listening (yet)
+                self.sendErrors += 1
+            sent += 1
+        del self.pending[:sent]
+
+    def received(self, datagram):
+        self.datagramsReceived += 1
+        pkts = decodeFrames(datagram)
+        if pkts:
+            self.callback(pkts)
+
+
+class TransportAdapter(EthernetAdapter):
+    """Ethernet adapter that is shared with adapters in other processes.
+
+    Packets delivered on this adapter go to its local listeners and are
+    queued to be sent to the peers at the end of the current pass of the
+    reactor.  Packets received from the peers go to the local listeners
+    only, so they are never sent back out.
+    """
+    def __init__(self, name, mac, transport):
+        EthernetAdapter.__init__(self, name, mac)
+        self.transport = transport
+        self.outgoing = []
+        self.flushCall = None
+        transport.start(self.receive)
+
+    def deliver(self, pkt):
+        EthernetAdapter.deliver(self, pkt)
+        self.outgoing.append(pkt)
+        if self.flushCall is None:
+            self.flushCall = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        """Send the queued packets to the peers."""
+        self.flushCall = None
+        pkts, self.outgoing = self.outgoing, []
+        if pkts:
+            self.transport.write(pkts)
+
+    def receive(self, pkts):
+        for pkt in pkts:
+            EthernetAdapter.deliver(self, pkt)
+
+    def close(self):
+        if self.flushCall is not None:
+            self.flushCall.cancel()
+            self.flush()
+        self.transport.stop()
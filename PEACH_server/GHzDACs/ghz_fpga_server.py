@@ -173,23 +173,25 @@ timeout = 20
 from __future__ import with_statement
 import sys
 import os
-import itertools
+import copy
 import struct
 import time
-import random
 
 import numpy as np
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from labrad import types as T
 from labrad.devices import DeviceServer
-from labrad.server import setting
+from labrad.server import setting, Signal
 
 import adc
 import dac
-from util import TimedLock
+import memory
+from capture import Capture, RecordingServer
+from monitor import HealthMonitor
+from util import TimedLock, FairScheduler, BoardLocks, TicketBuffer
 
 from matplotlib import pyplot as plt
 
@@ -199,6 +201,8 @@ MASTER_SRAM_DELAY = 2 # microseconds for master to delay before SRAM to ensure s
 
 TIMEOUT_FACTOR = 10 # timing estimates are multiplied by this factor to determine sequence timeout
 
+MAX_TICKETS = 16 # maximum number of submitted sequences per context whose results have not been fetched
+
 I2C_RB = 0x100
 I2C_ACK = 0x200
 I2C_RB_ACK = I2C_RB | I2C_ACK
@@ -237,8 +241,9 @@ class BoardGroup(object):
         self.cxn = server._cxn
         self.ctx = server.context()
         #self.sourceMac = getLocalMac(port)
-        self.pipeSemaphore = defer.DeferredSemaphore(NUM_PAGES)
-        self.pageNums = itertools.cycle(range(NUM_PAGES))
+        self.pipeSemaphore = FairScheduler(NUM_PAGES)
+        self.boardLocks = BoardLocks() # per-board test mode, see boardTestMode
+        self.pageCount = 0 # number of paged sequences run, used to alternate pages
         self.pageLocks = [TimedLock() for _ in range(NUM_PAGES)]
         self.runLock = TimedLock()
         self.readLock = TimedLock()
@@ -276,8 +281,8 @@ class BoardGroup(object):
         try:
             # acquire all locks so we can ping boards without
             # interfering with board group operations
-            for i in xrange(NUM_PAGES):
-                yield self.pipeSemaphore.acquire()
+            yield self.boardLocks.acquire(None, exclusive=True)
+            yield self.pipeSemaphore.acquireAll()
             for pageLock in self.pageLocks:
                 yield pageLock.acquire()
             yield self.runLock.acquire()
@@ -304,8 +309,8 @@ class BoardGroup(object):
             returnValue(found)
         finally:
             # release all locks once we're done with autodetection
-            for i in xrange(NUM_PAGES):
-                self.pipeSemaphore.release()
+            self.boardLocks.release(None, exclusive=True)
+            self.pipeSemaphore.releaseAll()
             for pageLock in self.pageLocks:
                 pageLock.release()
             self.runLock.release()
@@ -380,24 +385,86 @@ class BoardGroup(object):
         return [dev for dev in self.fpgaServer.devices.values()
                     if dev.boardGroup == self]
         
-    @inlineCallbacks
     def testMode(self, func, *a, **kw):
-        """Call a function in test mode.
-        
-        This makes sure that all currently-executing pipeline stages
-        are finished by acquiring the pipe semaphore for all pages,
-        then runs the function, and finally releases the semaphore
-        to allow the pipeline to continue.
+        """Call a function in test mode on all boards in this group."""
+        return self.boardTestMode(None, func, *a, **kw)
+
+    @inlineCallbacks
+    def boardTestMode(self, boards, func, *a, **kw):
+        """Call a function in test mode on some boards (by name), or all if boards is None.
+        
+        This waits until all sequences using these boards have finished,
+        by locking the boards exclusively, then runs the function, and
+        finally releases the boards.  Sequences that do not use any of the
+        boards carry on through the pipeline in the meantime, while new
+        sequences that do use them wait until the test is done.
         """
-        for i in xrange(NUM_PAGES):
-            yield self.pipeSemaphore.acquire()
+        yield self.boardLocks.acquire(boards, exclusive=True)
         try:
             ans = yield func(*a, **kw)
             returnValue(ans)
         finally:
-            for i in xrange(NUM_PAGES):
-                self.pipeSemaphore.release()
+            self.boardLocks.release(boards, exclusive=True)
 
+    def idle(self):
+        """Check whether no sequences or tests are waiting for or using any board."""
+        return self.boardLocks.idle()
+
+    def boardsUsed(self, runners):
+        """Names of the boards used by a sequence.
+        
+        As well as the boards being run, this includes the DAC boards after
+        the master in daisy chain order, which are put in idle mode by the
+        run packet (see makePackets).
+        """
+        names = set(runner.dev.devName for runner in runners)
+        used = set(names)
+        started = False
+        for board in self.boardOrder:
+            if board in names:
+                started = True
+            elif started and isinstance(self.fpgaServer.devices[board], dac.DacDevice):
+                used.add(board)
+        return used
+
+
+    def preparePackets(self, runners):
+        """Do the CPU-heavy part of building packets for a sequence.
+        
+        This builds the memory, SRAM, filter and trig lookup data for each
+        runner (mostly numpy work) and is called in a worker thread while
+        the sequence waits for its turn in the pipe, so that it overlaps
+        with the run and read stages of the sequences ahead of it.  It must
+        not touch the reactor or any LabRAD packets; those are built from
+        the prepared data by makePackets.  Runners that have already been
+        prepared (e.g. when running the same sequence several times, see
+        Accumulate) are skipped.
+        """
+        runnerInfo = dict((runner.dev.devName, runner) for runner in runners)
+        ordered = [runnerInfo[board] for board in self.boardOrder if board in runnerInfo]
+        for i, runner in enumerate(ordered):
+            if not runner.isPrepared(isMaster=(i == 0)):
+                runner.prepare(isMaster=(i == 0))
+
+    def estimate(self, runners, priority=0):
+        """Estimate what running a sequence will cost, without touching the hardware.
+        
+        The runners must already have been prepared with preparePackets.
+        Returns a tuple of:
+            list of (board name, bytes uploaded to that board)
+            whether paging will be disabled
+            predicted run time in seconds, from the memory commands
+            list of (board name, number of timing packets expected)
+            the page the sequence would run on
+            number of sequences currently queued ahead of it in the pipe
+        """
+        pagingOff = not all(runner.pageable() for runner in runners)
+        ahead = self.pipeSemaphore.queuedAhead(priority)
+        page = 0 if pagingOff else (self.pageCount + ahead) % NUM_PAGES
+        uploads = [(runner.dev.devName, runner.uploadBytes(page)) for runner in runners]
+        runTime = max(runner.runTime() for runner in runners)
+        packets = [(runner.dev.devName, runner.nPackets) for runner in runners]
+        return uploads, pagingOff, runTime, packets, page, ahead
 
     def makePackets(self, runners, page, reps, timingOrder, sync=249):
         """Make packets to run a sequence on this board group.
@@ -441,13 +508,15 @@ class BoardGroup(object):
                     loadPkts.append(p)
         
         # setup board state (not pipelined)
-        setupPkts = []
+        # the setup packets themselves are made just before they are sent,
+        # since they only write what is not already on the boards
+        setups = []
         for board in self.boardOrder:
             if board in runnerInfo:
                 runner = runnerInfo[board]
-                p = runner.setupPacket()
-                if p is not None:
-                    setupPkts.append(p)
+                state = runner.setupState()
+                if state is not None:
+                    setups.append((runner, state))
         
         # run all boards (master last)
         boards = []
@@ -475,7 +544,7 @@ class BoardGroup(object):
         collectPkts = [runner.collectPacket(seqTime, self.ctx) for runner in runners]
         readPkts = [runner.readPacket(timingOrder) for runner in runners]
             
-        return loadPkts, setupPkts, runPkts, collectPkts, readPkts
+        return loadPkts, setups, runPkts, collectPkts, readPkts
 
     def makeRunPackets(self, data):
         """Create packets to run a set of boards.
@@ -506,30 +575,49 @@ class BoardGroup(object):
         return wait, run, both
 
     @inlineCallbacks
-    def run(self, runners, reps, setupPkts, setupState, sync, getTimingData, timingOrder):
-        """Run a sequence on this board group."""
-        
-        # check whether this sequence will fit in just one page
-        if all(dev.pageable() for dev in runners):
-            # lock just one page
-            page = self.pageNums.next()
-            pageLocks = [self.pageLocks[page]]
-        else:
-            # start on page 0 and set pageLocks to all pages.
-            print 'Paging off: SRAM too long.'
-            page = 0
-            pageLocks = self.pageLocks
-        
-        # prepare packets
-        pkts = self.makePackets(runners, page, reps, timingOrder, sync)
-        loadPkts, boardSetupPkts, runPkts, collectPkts, readPkts = pkts
-        
-        # add setup packets from boards (ADCs) to that provided in the args
-        setupPkts.extend(pkt for pkt, state in boardSetupPkts) # this is a list
-        setupState.update(state for pkt, state in boardSetupPkts) # this is a set
-        
+    def run(self, runners, reps, setupPkts, setupState, sync, getTimingData, timingOrder,
+            client=None, priority=0, weight=1.0):
+        """Run a sequence on this board group.
+        
+        Sequences wait for a slot in the pipe, which is granted first by
+        priority and then by weighted fair share between clients (usually
+        contexts), with the cost of each sequence given by its estimated
+        run time.  The page is only chosen once we have a slot, so that
+        sequences which jump the queue still alternate pages in the order
+        in which they enter the pipe.
+        
+        Packet data is prepared in a worker thread while we wait for the
+        pipe (see preparePackets).  Before entering the queue for the pipe,
+        we wait for any of our boards that are in test mode (see
+        boardTestMode), so that waiting for them does not take up a slot.
+        """
+        prepared = threads.deferToThread(self.preparePackets, runners)
+        cost = max(runner.seqTime for runner in runners)
+        boards = self.boardsUsed(runners)
+        yield self.boardLocks.acquire(boards)
+        yield self.pipeSemaphore.acquire(client, priority, weight, cost)
         try:
-            yield self.pipeSemaphore.acquire()
+            yield prepared
+            
+            # check whether this sequence will fit in just one page
+            if all(dev.pageable() for dev in runners):
+                # lock just one page
+                page = self.pageCount % NUM_PAGES
+                self.pageCount += 1
+                pageLocks = [self.pageLocks[page]]
+            else:
+                # start on page 0 and set pageLocks to all pages.
+                print 'Paging off: SRAM too long.'
+                page = 0
+                pageLocks = self.pageLocks
+            
+            # prepare packets
+            pkts = self.makePackets(runners, page, reps, timingOrder, sync)
+            loadPkts, boardSetups, runPkts, collectPkts, readPkts = pkts
+            
+            # add setup states from boards (ADCs) to that provided in the args
+            setupState.update(state for runner, state in boardSetups) # this is a set
+            
             try:
                 # stage 1: load
                 for pageLock in pageLocks: # lock pages to be written
@@ -553,12 +641,19 @@ class BoardGroup(object):
                         # we require changes to the setup state
                         r = yield waitPkt.send() # if this fails, something BAD happened!
                         try:
-                            yield self.sendAll(setupPkts, 'Setup')
+                            # add setup packets from boards (ADCs), which only
+                            # write the SRAM pages that have changed
+                            boardPkts = [runner.setupPacket() for runner, state in boardSetups]
+                            yield self.sendAll(setupPkts + [p for p in boardPkts if p is not None], 'Setup')
+                            for runner, state in boardSetups:
+                                runner.setupDone()
                             time.sleep(0.2)# waiting for the anritsu microwavesource change the freq
                             self.setupState = setupState
                         except Exception:
                             # if there was an error, clear setup state
                             self.setupState = set()
+                            for runner, state in boardSetups:
+                                runner.dev.forgetPages()
                             raise
 
                         yield runPkt.send()
@@ -629,14 +724,13 @@ class BoardGroup(object):
                         idx = boardOrder.index(board)
                         runner = runners[idx]
                         allDacs &= isinstance(runner, DacRunner)
-                        result = [data for src, dest, eth, data in results[idx]['read']]
-                        answer = runner.extract(result) #Array of all timing results (DAC)
+                        answer = runner.extract(results[idx]['read']) #Array of all timing results (DAC)
                         boardResults[board] = answer
                         runner.ranges = answer[1]
                     # Add extracted data to the list of timing results
                     # If this is an ADC demod channel, grab that channel's data only
                     if channel is not None: #channel is None for DAC boards
-                        answer = answer[0][channel]
+                        answer = tuple(answer[0][channel])
                     answers.append(answer)
                 
                 if allDacs and len(set(len(answer) for answer in answers)) == 1:
@@ -652,7 +746,8 @@ class BoardGroup(object):
                     answers = tuple(answers)
                 returnValue(answers)
         finally:
-            self.pipeSemaphore.release()
+            self.pipeSemaphore.release(client)
+            self.boardLocks.release(boards)
 
     @inlineCallbacks
     def sendAll(self, packets, info, infoList=None):
@@ -704,10 +799,24 @@ class FPGAServer(DeviceServer):
     name = 'GHz FPGAs'
     retries = 5
     
+    onBoardHealth = Signal(543700, 'signal: board health', '(sbs)')
+    
     @inlineCallbacks
     def initServer(self):
         self.boardGroups = {}
+        self.capture = Capture()
+        self.monitor = HealthMonitor(self.allDevices, self.onBoardHealth)
         yield DeviceServer.initServer(self)
+        self.monitor.start()
+    
+    def stopServer(self):
+        self.monitor.stop()
+        return DeviceServer.stopServer(self)
+    
+    def allDevices(self):
+        """Get the device wrappers of all boards, in the order of List Devices."""
+        IDs, names = self.deviceLists()
+        return [self.devices[ID] for ID in IDs]
     
     @inlineCallbacks
     def loadBoardGroupConfig(self):
@@ -800,7 +909,8 @@ class FPGAServer(DeviceServer):
         for server, port in additions:
             name, boards = config[server, port]
             print "Creating board group '%s': server='%s', port=%d" % (name, server, port)
-            de = cxn.servers[server]
+            # wrap the direct ethernet server so its packets can be captured
+            de = RecordingServer(cxn.servers[server], self.capture, port)
             boardGroup = BoardGroup(self, de, port) #Sets attributes
             yield boardGroup.init()                 #Gets context with direct ethernet
             self.boardGroups[server, port] = boardGroup
@@ -875,6 +985,16 @@ class FPGAServer(DeviceServer):
         c['daisy_chain'] = []
         c['timing_order'] = None
         c['master_sync'] = 249
+        c['priority'] = 0
+        c['weight'] = 1.0
+        c['accumulate'] = (1, False)
+        c['tickets'] = TicketBuffer(MAX_TICKETS)
+
+    def expireContext(self, c):
+        """Forget scheduling statistics for an expired context."""
+        for boardGroup in self.boardGroups.values():
+            boardGroup.pipeSemaphore.forget(c.ID)
+        DeviceServer.expireContext(self, c)
 
     ## remote settings
 
@@ -985,6 +1105,44 @@ class FPGAServer(DeviceServer):
         d = c.setdefault(dev, {})
         d['mem'] = data
 
+    @setting(31, 'Memory Compile', program='*(s*v): (op, args) for each operation', sramLen='w',
+             returns='w{commands}, w{timers}, v[s]{run time}, w{reps factor}')
+    def dac_memory_compile(self, c, program, sramLen=None):
+        """Compiles a structured program into memory commands for the selected DAC.
+
+        The program is a list of (op, args), where op is one of
+            delay [us]          wait for the given time in microseconds
+            sram []             call the whole SRAM
+            sram [start, end]   call SRAM from start to end (word addresses)
+            start []            start the timer
+            stop []             stop the timer
+            repeat [n]          repeat up to the matching end n times
+            end []
+        For example [('repeat', [1000]), ('start', []), ('sram', []), ('delay', [2.5]),
+        ('stop', []), ('end', [])] runs the SRAM 1000 times, 2.5 us apart.  The
+        shortest memory sequence for the program is set as with Memory.  SRAM
+        calls without addresses use sramLen words, by default the length of the
+        SRAM set in this context.
+
+        Returns the number of memory commands, the number of timer results and
+        the run time of one run of the program, and the reps factor.  If the
+        program is a single repeat block that is too long for memory, only part
+        of the repeats are compiled and the reps factor tells how many reps of
+        the sequence make one run of the program; multiply reps by it when
+        running the sequence.
+        """
+        dev = self.selectedDAC(c)
+        d = c.setdefault(dev, {})
+        if sramLen is None:
+            sram = d.get('sram', None)
+            if isinstance(sram, tuple):
+                sramLen = 1 # the addresses of dual-block calls are set when running
+            elif sram:
+                sramLen = len(sram) / 4
+        seq = memory.compileSequence(program, sramLen)
+        d['mem'] = seq.mem
+        return (len(seq.mem), seq.timers, T.Value(seq.duration, 's'), seq.repsFactor)
+
 
     # ADC configuration
 
@@ -1001,6 +1159,7 @@ class FPGAServer(DeviceServer):
         bytes = np.fromstring(bytes, dtype='<u1')
         d = c.setdefault(dev, {})
         d['filterFunc'] = bytes
+        d['filterHash'] = adc.filterKey(bytes)
         d['filterStretchLen'] = stretchLen
         d['filterStretchAt'] = stretchAt
     
@@ -1026,6 +1185,7 @@ class FPGAServer(DeviceServer):
         phi = np.pi/2 * (np.arange(N) + 0.5) / N
         ch['sine'] = np.floor(sineAmp * np.sin(phi) + 0.5).astype('uint8')      #Sine waveform for this channel
         ch['cosine'] = np.floor(cosineAmp * np.sin(phi) + 0.5).astype('uint8')  #Cosine waveform for this channel, note that the function is still a SINE function!
+        ch['hash'] = adc.trigKey(ch) #Fingerprint of the lookup tables for the setup state
 
         
     @setting(42, 'ADC Demod Phase', channel='w', dPhi='i', phi0='i', returns='')
@@ -1089,6 +1249,27 @@ class FPGAServer(DeviceServer):
         d = c.setdefault(dev, {})
         d['startDelay'] = delay
 
+    @setting(47, 'ADC Software Demod', freqs='*v[MHz]', returns='*v[MHz]')
+    def adc_software_demod(self, c, freqs=None):
+        """Set or get the tones demodulated in software for the selected ADC. (ADC only)
+        
+        In average mode, the I and Q traces from the board can be demodulated
+        by the server at any number of tones, rather than the limited number
+        of hardware demodulation channels.  When tones are set, sequences run
+        in average mode return (*v{I}, *v{Q}) for this board, with one value
+        per tone, the mean of (I + iQ) exp(-2 pi i f t) over the trace.  Set
+        an empty list to get the raw traces again.
+        """
+        dev = self.selectedADC(c)
+        d = c.setdefault(dev, {})
+        if freqs is not None:
+            nyquist = 500.0 / dev.buildParams['DEMOD_TIME_STEP'] # MHz
+            freqs = [float(f['MHz']) for f in freqs]
+            for f in freqs:
+                assert abs(f) <= nyquist, 'tone frequency out of range: %g MHz' % f
+            d['toneFreqs'] = freqs
+        return [T.Value(f, 'MHz') for f in d.get('toneFreqs', [])]
+
     @setting(46, 'ADC Demod Range', returns='i{Imax}, i{Imin}, i{Qmax}, i{Qmin}')
     def adc_demod_range(self, c):
         """Get the demodulation ranges for the last sequence run in this context. (ADC only)
@@ -1134,9 +1315,71 @@ class FPGAServer(DeviceServer):
         timing order.  Individual DAC boards always return *w; ADC boards in
         average mode return (*i,{I} *i{Q}); and ADC boards in demodulate
         mode also return (*i,{I} *i{Q}) for each channel.
+        
+        If Accumulate has been set to more than one run in this context, the
+        sequence is run that many times and the results are combined, see
+        Accumulate.
         """
         # TODO: also handle ADC boards here
+        seq = self._prepareSequence(c, reps, getTimingData, setupPkts, setupState)
+        return self._startSequence(c, seq)
+
+    @setting(51, 'Submit Sequence', reps='w', getTimingData='b',
+                                    setupPkts='?{(((ww), s, ((s?)(s?)(s?)...))...)}',
+                                    setupState='*s',
+                                    returns='w')
+    def sequence_submit(self, c, reps=30, getTimingData=True, setupPkts=[], setupState=[]):
+        """Submits a sequence to run later and returns a ticket number.
+        
+        The arguments are the same as for Run Sequence.  The sequence is built
+        from the state of this context at the time of the call, so the context
+        may be set up for the next sequence straight away, e.g. to overlap
+        waveform generation with hardware time.  Use Fetch Results or Wait
+        Results with the ticket number to get the data, which is returned in
+        the same form as for Run Sequence.
+        
+        Results are kept until they are fetched.  If there are already too
+        many unfetched tickets in this context, this call waits until some
+        results have been fetched before submitting the sequence.
+        """
+        seq = self._prepareSequence(c, reps, getTimingData, setupPkts, setupState)
+        tickets = c['tickets']
+        ticket = yield tickets.reserve()
+        tickets.submit(ticket, self._startSequence(c, seq))
+        returnValue(ticket)
+
+    @setting(53, 'Fetch Results', ticket='w', returns=['*2w', '?', ''])
+    def sequence_fetch(self, c, ticket):
+        """Gets the results of a submitted sequence without waiting.
+        
+        Raises an error if the sequence has not finished yet, or the error
+        that was raised while running it.  Results can only be fetched once.
+        """
+        return c['tickets'].fetch(ticket)
+
+    @setting(58, 'Wait Results', ticket='w', timeout='v[s]', returns=['*2w', '?', ''])
+    def sequence_wait(self, c, ticket, timeout=None):
+        """Waits for and gets the results of a submitted sequence.
         
+        If a timeout is given and the sequence does not finish in time an
+        error is raised, but the results can still be fetched later.
+        Results can only be fetched once.
+        """
+        if timeout is not None:
+            timeout = timeout['s']
+        return c['tickets'].wait(ticket, timeout)
+
+    @setting(60, 'Finished Tickets', returns='*w')
+    def sequence_finished_tickets(self, c):
+        """Get the tickets of submitted sequences whose results are ready."""
+        return c['tickets'].done()
+
+    def _prepareSequence(self, c, reps, getTimingData, setupPkts, setupState):
+        """Build everything needed to run a sequence from the current context state.
+        
+        The runners copy whatever they need from the context, so the
+        context can be changed while the sequence waits to be run.
+        """
         # Round stats up to multiple of the timing packet length
         reps += dac.TIMING_PACKET_LEN - 1
         reps -= reps % dac.TIMING_PACKET_LEN
@@ -1176,10 +1419,11 @@ class FPGAServer(DeviceServer):
                     filter = (info['filterFunc'], info['filterStretchLen'], info['filterStretchAt'])
                 except KeyError:
                     raise Exception("No filter function specified for ADC board '%s'" % dev.devName)
-                channels = dict((i, info[i]) for i in range(dev.buildParams['DEMOD_CHANNELS']) if i in info)
+                channels = dict((i, dict(info[i])) for i in range(dev.buildParams['DEMOD_CHANNELS']) if i in info)
                 #for key,value in channels.items():
                 #    print key,value
-                runner = AdcRunner(dev, reps, runMode, startDelay, filter, channels)
+                runner = AdcRunner(dev, reps, runMode, startDelay, filter, channels, info.get('filterHash'),
+                                   info.get('toneFreqs'))
             else:
                 raise Exception("Unknown device type: %s" % dev) 
             runners.append(runner)       
@@ -1201,12 +1445,27 @@ class FPGAServer(DeviceServer):
         # build setup requests
         setupReqs = processSetupPackets(self.client, setupPkts)
 
+        return (bg, runners, reps, setupReqs, list(setupState), c['master_sync'],
+                getTimingData, timingOrder, c['priority'], c['weight'])
+
+    def _startSequence(self, c, seq):
+        """Run a prepared sequence once, or accumulate several runs if so set up."""
+        runs, variance = c['accumulate']
+        if runs > 1:
+            return self._runAccumulated(c, runs, variance, *seq)
+        return self._runSequence(c, *seq)
+
+    @inlineCallbacks
+    def _runSequence(self, c, bg, runners, reps, setupReqs, setupState, sync,
+                     getTimingData, timingOrder, priority, weight):
+        """Run a prepared sequence on its board group, retrying on timeouts."""
         # run the sequence, with possible retries if it fails
         retries = self.retries
         attempt = 1
         while True:
             try:
-                ans = yield bg.run(runners, reps, setupReqs, set(setupState), c['master_sync'], getTimingData, timingOrder)
+                ans = yield bg.run(runners, reps, setupReqs, set(setupState), sync, getTimingData, timingOrder,
+                                   client=c.ID, priority=priority, weight=weight)
                 # for ADCs in demodulate mode, store their I and Q ranges to check for possible clipping
                 for runner in runners:
                     if getTimingData and isinstance(runner, AdcRunner) and runner.runMode == 'demodulate' and runner.dev.devName in timingOrder:
@@ -1228,8 +1487,99 @@ class FPGAServer(DeviceServer):
                         print 'retrying...'
                         print >>logfile, 'retrying...'
                         attempt += 1
+
+    @inlineCallbacks
+    def _runAccumulated(self, c, runs, variance, bg, runners, reps, setupReqs, setupState, sync,
+                        getTimingData, timingOrder, priority, weight):
+        """Run a prepared sequence several times and combine the results.
+        
+        The packets are prepared once and shared by all runs.  Up to
+        NUM_PAGES runs are kept in the pipe at once, so that the board
+        group alternates pages just as for sequences submitted one after
+        another, and each result is added to an Accumulator as it comes in.
+        """
+        yield threads.deferToThread(bg.preparePackets, runners)
+        for runner in runners:
+            runner.rawAverage = True # sum the int16 traces directly, see Accumulator
+        acc = Accumulator(runners, timingOrder, variance)
+        ranges = {}
+        
+        def runOnce():
+            # each run gets its own runners, since read state is kept on them
+            copies = [copy.copy(runner) for runner in runners]
+            d = self._runSequence(c, bg, copies, reps, setupReqs, setupState, sync,
+                                  getTimingData, timingOrder, priority, weight)
+            return d, copies
+        
+        pending = []
+        started = 0
+        try:
+            while started < runs or pending:
+                while started < runs and len(pending) < NUM_PAGES:
+                    pending.append(runOnce())
+                    started += 1
+                d, copies = pending.pop(0)
+                ans = yield d
+                if getTimingData:
+                    acc.add(ans)
+                    for runner in copies:
+                        if isinstance(runner, AdcRunner) and runner.runMode == 'demodulate' and hasattr(runner, 'ranges'):
+                            ranges[runner.dev] = combineRanges(ranges.get(runner.dev), runner.ranges)
+        except Exception:
+            # wait for runs still in the pipe, so their errors are not left unhandled
+            yield defer.DeferredList([d for d, copies in pending], consumeErrors=True)
+            raise
+        for dev, rng in ranges.items():
+            c[dev]['ranges'] = rng
+        if getTimingData:
+            returnValue(acc.result())
+
+    @setting(62, 'Accumulate', runs='w', variance='b', returns='wb')
+    def sequence_accumulate(self, c, runs=None, variance=None):
+        """Set or get the number of runs to accumulate for each sequence.
+        
+        When runs is more than 1, Run Sequence and Submit Sequence run the
+        sequence that many times, pipelined like separate sequences, and
+        return the combined results in one go, rather than having the client
+        run the sequence repeatedly and add up the results itself.  ADC boards
+        in average mode return the mean I and Q traces over all runs, as
+        (*v{I}, *v{Q}), and if variance is True also the variance of each
+        point, as (*v{I}, *v{Q}, *v{var I}, *v{var Q}).  The sums are kept as
+        64-bit integers.  DAC timing data and ADC demodulation data are
+        returned for all runs, one after another, as if more reps had been
+        run, and the demodulation ranges cover all runs.  The default is 1
+        run, without variance, which runs each sequence once as usual.
+        """
+        if runs is not None:
+            if runs < 1:
+                raise Exception('Must accumulate at least one run.')
+            if variance is None:
+                variance = c['accumulate'][1]
+            c['accumulate'] = (int(runs), bool(variance))
+        return c['accumulate']
     
     
+    @setting(61, 'Estimate Sequence', reps='w', getTimingData='b',
+             returns='*(sw){upload bytes}, b{paging off}, v[s]{run time}, *(sw){timing packets}, w{page}, w{queued ahead}')
+    def sequence_estimate(self, c, reps=30, getTimingData=True):
+        """Estimates the cost of running the sequence set up in this context.
+        
+        Nothing is sent to the boards.  The arguments are the same as for Run
+        Sequence, and the sequence is analyzed exactly as it would be run.
+        Returns:
+            bytes uploaded to each board (memory, SRAM, filter and trig
+                lookup tables and run registers)
+            whether paging will be disabled because SRAM is too long
+            predicted run time from the memory commands for all reps
+            number of timing packets expected from each board
+            the page the sequence would run on if submitted now
+            number of sequences which would be run first
+        """
+        bg, runners = self._prepareSequence(c, reps, getTimingData, [], [])[:2]
+        yield threads.deferToThread(bg.preparePackets, runners)
+        uploads, pagingOff, runTime, packets, page, ahead = bg.estimate(runners, c['priority'])
+        returnValue((uploads, pagingOff, T.Value(runTime, 's'), packets, page, ahead))
+
     @setting(52, 'Daisy Chain', boards='*s', returns='*s')
     def sequence_boards(self, c, boards=None):
         """Set or get the boards to run.
@@ -1263,7 +1613,9 @@ class FPGAServer(DeviceServer):
         To get DAC timing data or ADC data in average mode, specify the
         device name as a string.  To get ADC data in demodulation mode,
         specify a string in the form "<device name>::<channel>" where
-        channel is the demodulation channel number.
+        channel is the demodulation channel number.  ADC boards in average
+        mode with tones set by ADC Software Demod return the demodulated
+        tones instead of the traces.
         
         Note that you can get data from more than one demodulation channel,
         so that a given ADC board can appear multiple times in the timing
@@ -1299,6 +1651,41 @@ class FPGAServer(DeviceServer):
             c['master_sync'] = sync
         return sync
 
+    @setting(56, 'Priority', priority='i', weight='v', returns='iv')
+    def sequence_priority(self, c, priority=None, weight=None):
+        """Set or get the scheduling priority and fair-share weight.
+        
+        When several contexts are running sequences on the same board group,
+        waiting sequences from contexts with a higher priority are always
+        started first, so that e.g. interactive checks and calibrations can
+        jump ahead of a long background sweep.  Contexts with equal priority
+        share the pipe in proportion to their weights, measured by estimated
+        sequence run time.  The defaults are priority 0 and weight 1.
+        """
+        if priority is not None:
+            c['priority'] = priority
+        if weight is not None:
+            if weight <= 0:
+                raise Exception('Weight must be positive.')
+            c['weight'] = float(weight)
+        return c['priority'], c['weight']
+
+    @setting(57, 'Queue Statistics', returns='*(s*((ww)ivwwwwv))')
+    def sequence_queue_statistics(self, c):
+        """Get pipe scheduler statistics for each board group.
+        
+        For each board group this returns a list with one entry per context
+        that has run sequences on it:
+            context, priority, weight,
+            sequences waiting for the pipe, sequences in the pipe,
+            maximum number waiting, total sequences run,
+            mean wait time for a pipe slot (in seconds)
+        """
+        ans = []
+        for (server, port), group in sorted(self.boardGroups.items()):
+            ans.append((group.name, group.pipeSemaphore.stats()))
+        return ans
+
     @setting(59, 'Performance Data', returns='*((sw)(*v, *v, *v, *v, *v))')
     def sequence_performance_data(self, c):
         """Get data about the pipeline performance.
@@ -1326,6 +1713,67 @@ class FPGAServer(DeviceServer):
         return ans
 
 
+    @setting(90, 'Capture Start', filename='s', returns='')
+    def capture_start(self, c, filename):
+        """Start recording all packets to and from the direct ethernet servers.
+        
+        Every ethernet packet sent to or read from the boards by any board
+        group or device is written to the given capture file, together with
+        a timestamp, the direct ethernet context and the pipeline stage.
+        Collect, discard, clear and trigger requests are recorded as well.
+        See GHzDACs/capture.py for the file format and for tools to summarize
+        and replay captures.  Any capture already running is stopped.
+        """
+        self.capture.start(filename)
+
+    @setting(91, 'Capture Stop', returns='w')
+    def capture_stop(self, c):
+        """Stop recording packets and return the number of records written."""
+        return self.capture.stop()
+
+
+    # board health monitor
+
+    @setting(70, 'Health Monitor', enable='b', returns='b')
+    def health_monitor(self, c, enable=None):
+        """Turn the background board health monitor on or off, or get its state.
+        
+        The monitor checks PLL lock, build number and (for DACs) the FIFO
+        counters of every board, but only while no sequence is waiting for
+        or running on the board group, so it does not slow down sequences.
+        Healthy boards are checked less and less often, down to once every
+        10 minutes; boards that fail a check are checked every 5 seconds.
+        Failures, and recovery from them, are sent out with the
+        'signal: board health' signal as (board, ok, message).
+        """
+        if enable is not None:
+            if enable:
+                self.monitor.start()
+            else:
+                self.monitor.stop()
+        return self.monitor.running
+
+    @setting(71, 'Health Status', returns='*(sbvs)')
+    def health_status(self, c):
+        """Get the result of the last health check of each board.
+        
+        Returns a list of (board, ok, time of check, message), where the
+        time is in seconds since the epoch and the message lists the
+        problems found, if any.
+        """
+        return [(name, ok, t, message) for name, (ok, t, message) in sorted(self.monitor.status.items())]
+
+    @setting(72, 'Health History', board='s', returns='*(vbbw*w)')
+    def health_history(self, c, board=None):
+        """Get the health checks of a board, by default the selected one.
+        
+        Returns a list of (time, ok, PLL locked, build, FIFO counters),
+        oldest first, for up to the last 1000 checks.
+        """
+        if board is None:
+            board = self.selectedDevice(c).devName
+        return self.monitor.history.get(board, [])
+
     @setting(200, 'PLL Init', returns='')
     def pll_init(self, c, data):
         """Sends the initialization sequence to the PLL. (DAC and ADC)
@@ -1617,30 +2065,44 @@ class FPGAServer(DeviceServer):
         the calibration parameters.
         """
         dev = self.selectedDAC(c)
+        return dev.bringup(lvdsOptimize, lvdsSD, signed, targetFifo)
+
+
+    @setting(1301, 'Bringup All', boardGroup='s', lvdsOptimize='b', signed='b',
+             returns='*(sbs*((ss)(sb)(sw)(sw)(sw)(s(*w*b*b))(sw)(sb)(sb)(si)(sw)(sw)(sb)(s(ww))(s(ww))(s(ww))))')
+    def bringup_all(self, c, boardGroup, lvdsOptimize=False, signed=True):
+        """Runs the bringup procedure on all boards in a board group at once.
+        
+        DAC boards are brought up as with DAC Bringup and ADC boards as with
+        ADC Bringup, all concurrently, while the board group is in test mode.
+        Each DAC starts from the LVDS SD, FIFO counter, clock polarity and PHOF
+        it converged to in its last successful bringup, so that bringup
+        usually takes one pass, unless lvdsOptimize is True, in which case the
+        SD is optimized again.  Returns a list of (board name, success, error
+        message, results), where the results for DAC boards are as for DAC
+        Bringup and empty for ADC boards.  A board whose bringup raised an
+        error has success False, the error message and empty results, so the
+        boards that did come up are still reported.
+        """
+        bg = self.getBoardGroup(boardGroup)
+        devs = [dev for dev in self.allDevices() if dev.boardGroup is bg]
+        
+        def bringupAll():
+            ds = []
+            for dev in devs:
+                if isinstance(dev, dac.DacDevice):
+                    ds.append(dev._bringup(lvdsOptimize, None, signed, None, useCache=True))
+                else:
+                    ds.append(dev._initPLL().addCallback(lambda result: []))
+            return defer.DeferredList(ds, consumeErrors=True)
+        results = yield bg.testMode(bringupAll)
+        
         ans = []
-        yield dev.resetPLL()
-        time.sleep(0.100)
-        yield dev.initPLL()
-        for dac in ['A','B']:
-            ansDAC = [('dac',dac)]
-            cmd, shift = {'A': (2, 0), 'B': (3, 14)}[dac]
-            pkt = [0x0024, 0x0004, 0x1603, 0x0500] if signed else \
-                  [0x0026, 0x0006, 0x1603, 0x0500]
-            yield dev.runSerial(cmd, pkt)
-            lvdsAns = yield dev.setLVDS(cmd, lvdsSD, lvdsOptimize)
-            lvdsKeys = ['lvdsSuccess','lvdsMSD','lvdsMHD','lvdsSD','lvdsTiming','lvdsCheck']
-            for key,val in zip(lvdsKeys,lvdsAns):
-                ansDAC.append((key,val))
-            fifoAns = yield dev.setFIFO(dac, cmd, targetFifo)
-            fifoKeys = ['fifoSuccess','fifoClockPolarity','fifoPHOF','fifoTries','fifoCounter']
-            for key,val in zip(fifoKeys,fifoAns):
-                ansDAC.append((key,val))
-            bistData = [random.randint(0, 0x3FFF) for i in range(1000)]
-            bistAns = yield dev.runBIST(cmd, shift, bistData)
-            bistKeys = ['bistSuccess','bistTheory','bistLVDS','bistFIFO']
-            for key,val in zip(bistKeys,bistAns):
-                ansDAC.append((key,val))
-            ans.append(tuple(ansDAC))
+        for dev, (success, result) in zip(devs, results):
+            if success:
+                ans.append((dev.devName, True, '', result))
+            else:
+                ans.append((dev.devName, False, result.getErrorMessage(), []))
         returnValue(ans)
             
 
@@ -1731,6 +2193,11 @@ class DacRunner(object):
         self.mem = mem
         self.sram = sram
         self.blockDelay = None
+        self.memPkts = None
+        self.sramPayloads = None
+        self.isMaster = None
+        self.bulk = False
+        self.rawAverage = False
         self._fixDualBlockSram()
         
         if self.pageable():
@@ -1763,18 +2230,52 @@ class DacRunner(object):
             self.sram = data
             self.blockDelay = delay
     
-    def loadPacket(self, page, isMaster):
-        """Create pipelined load packet.  For DAC, upload mem and SRAM."""
+    def prepare(self, isMaster):
+        """Build memory packets for every page we may run on and the SRAM payloads.
+        
+        This is called from a worker thread, see BoardGroup.preparePackets.
+        """
+        mem = self.mem
         if isMaster:
             # this will be the master, so add delays before SRAM
-            self.mem = addMasterDelay(self.mem)
-            self.memTime = sequenceTime(self.mem) # recalculate sequence time
-        return self.dev.load(self.mem, self.sram, page)
+            mem = addMasterDelay(mem)
+        self.memTime = sequenceTime(mem) # recalculate sequence time
+        pages = range(NUM_PAGES) if self.pageable() else [0]
+        self.memPkts = dict((page, self.dev.memoryPacket(mem, page)) for page in pages)
+        self.sramPayloads = self.dev.sramPayloads(self.sram)
+        self.isMaster = isMaster
+    
+    def isPrepared(self, isMaster):
+        """Check whether prepare has already been called for this role."""
+        return self.memPkts is not None and self.isMaster == isMaster
+    
+    def loadPacket(self, page, isMaster):
+        """Create pipelined load packet.  For DAC, upload mem and SRAM."""
+        if self.memPkts is None or self.isMaster != isMaster:
+            self.prepare(isMaster)
+        return self.dev.load(self.mem, self.sram, page, memPkt=self.memPkts[page], sramPayloads=self.sramPayloads)
+    
+    def setupState(self):
+        """Setup state string for this board.  For DAC, there is none."""
+        return None
     
     def setupPacket(self):
         """Create non-pipelined setup packet.  For DAC, does nothing."""
         return None
     
+    def setupDone(self):
+        """Called when the setup packets have been sent.  For DAC, does nothing."""
+        pass
+    
+    def uploadBytes(self, page):
+        """Number of bytes sent to the board to run on the given page, once prepared."""
+        sram = sum(len(payload) + 2 for payload in self.sramPayloads)
+        return len(self.memPkts[page]) + sram + dac.REG_PACKET_LEN
+    
+    def runTime(self):
+        """Predicted run time in seconds for all reps, once prepared."""
+        return self.memTime * self.reps
+    
     def runPacket(self, page, slave, delay, sync):
         """Create run packet."""
         startDelay = self.startDelay + delay
@@ -1786,23 +2287,40 @@ class DacRunner(object):
         return self.dev.collect(self.nPackets, seqTime, ctx)
     
     def readPacket(self, timingOrder):
-        """Read (or discard) appropriate number of ethernet packets, depending on whether timing results are wanted."""
+        """Read (or discard) appropriate number of ethernet packets, depending on whether timing results are wanted.
+        
+        If the ethernet server supports it, only the timing data in each
+        packet is read back, as a single byte string.
+        """
         keep = any(s.startswith(self.dev.devName) for s in timingOrder)
-        return self.dev.read(self.nPackets) if keep else self.dev.discard(self.nPackets)
+        if not keep:
+            return self.dev.discard(self.nPackets)
+        self.bulk = self.dev.canReadBulk()
+        if self.bulk:
+            return self.dev.readBulk(self.nPackets, 3, 63)
+        return self.dev.read(self.nPackets)
     
-    def extract(self, packets):
+    def extract(self, result):
         """Extract timing data coming back from a readPacket."""
-        data = ''.join(data[3:63] for data in packets)
-        return np.fromstring(data, dtype='<u2').astype('u4')
+        if self.bulk:
+            stride, data = result
+        else:
+            data = ''.join(data[3:63] for src, dest, eth, data in result)
+        return np.frombuffer(data, dtype='<u2').astype('u4')
 
 class AdcRunner(object):
-    def __init__(self, dev, reps, runMode, startDelay, filter, channels):
+    def __init__(self, dev, reps, runMode, startDelay, filter, channels, filterHash=None, tones=None):
         self.dev = dev
         self.reps = reps
         self.runMode = runMode
         self.startDelay = startDelay
         self.filter = filter
         self.channels = channels
+        self.filterHash = filterHash
+        self.tones = tones
+        self.setupData = None
+        self.bulk = False
+        self.rawAverage = False
         
         if self.runMode == 'average':
             self.mode = adc.RUN_MODE_AVERAGE_DAISY
@@ -1818,15 +2336,55 @@ class AdcRunner(object):
         """ADC sequence alone will never disable paging"""
         return True
     
+    def prepare(self, isMaster):
+        """Build the filter and trig lookup SRAM packets.
+        
+        This is called from a worker thread, see BoardGroup.preparePackets.
+        """
+        self.setupData = self.dev.setupData(self.filter, self.channels, self.filterHash)
+    
+    def isPrepared(self, isMaster):
+        """Check whether prepare has already been called."""
+        return self.setupData is not None
+    
     def loadPacket(self, page, isMaster):
         """Create pipelined load packet.  For ADC, nothing to do."""
         if isMaster:
             raise Exception("Cannot use ADC board '%s' as master." % self.dev.devName)
         return None
 
+    def setupState(self):
+        """Setup state string for this board, once prepared."""
+        pages, setupState = self.setupData
+        return setupState
+    
     def setupPacket(self):
-        """Create non-pipelined setup packet.  For ADC, upload filter func and trig lookup tables."""
-        return self.dev.setup(self.filter, self.channels)
+        """Create non-pipelined setup packet.  For ADC, upload filter func and trig lookup tables.
+        
+        Only the SRAM pages that differ from those on the board are
+        written, so this is None if there are none.
+        """
+        p, setupState = self.dev.setup(self.filter, self.channels, prepared=self.setupData)
+        return p
+    
+    def setupDone(self):
+        """Called when the setup packets have been sent."""
+        pages, setupState = self.setupData
+        self.dev.pagesWritten(pages)
+    
+    def uploadBytes(self, page):
+        """Number of bytes sent to the board, once prepared.
+        
+        This includes the SRAM pages that differ from those on the board,
+        although these are only sent when the setup state changes.
+        """
+        pages, setupState = self.setupData
+        changed = self.dev.changedPages(pages)
+        return sum(len(pkt) for page, digest, pkt in changed) + adc.REG_PACKET_LEN
+    
+    def runTime(self):
+        """ADC boards are timed by the DACs, so we have no estimate of our own."""
+        return 0
     
     def runPacket(self, page, slave, delay, sync):
         """Create run packet.
@@ -1846,19 +2404,104 @@ class AdcRunner(object):
         return self.dev.collect(self.nPackets, seqTime, ctx)
             
     def readPacket(self, timingOrder):
-        """Read (or discard) appropriate number of ethernet packets, depending on whether timing results are wanted."""
+        """Read (or discard) appropriate number of ethernet packets, depending on whether timing results are wanted.
+        
+        If the ethernet server supports it, the packets are read back as
+        a single byte string.
+        """
         keep = any(s.startswith(self.dev.devName) for s in timingOrder)
-        return self.dev.read(self.nPackets) if keep else self.dev.discard(self.nPackets)
-
-    def extract(self, packets):
+        if not keep:
+            return self.dev.discard(self.nPackets)
+        self.bulk = self.dev.canReadBulk()
+        if self.bulk:
+            return self.dev.readBulk(self.nPackets)
+        return self.dev.read(self.nPackets)
+
+    def extract(self, result):
         """Extract timing data coming back from a readPacket."""
-        if self.runMode == 'average':
-            return adc.extractAverage(packets)
+        if self.bulk:
+            stride, data = result
+            packets = np.frombuffer(data, dtype='uint8').reshape(-1, stride)
+        else:
+            packets = [data for src, dest, eth, data in result]
+        if self.runMode == 'average' and self.tones:
+            Is, Qs = adc.extractAverage(packets, raw=True)
+            return adc.demodulateTraces(Is, Qs, self.tones, self.dev.buildParams['DEMOD_TIME_STEP'])
+        elif self.runMode == 'average':
+            return adc.extractAverage(packets, raw=self.rawAverage)
         elif self.runMode == 'demodulate':
             return adc.extractDemod(packets, self.dev.buildParams['DEMOD_CHANNELS_PER_PACKET'])
 
+class Accumulator(object):
+    """Combines the timing data of several runs of one sequence, see Accumulate.
+    
+    I and Q traces from ADC boards in average mode are summed into int64
+    arrays, along with their squares if the variance is wanted.  All other
+    timing data (from DACs, demodulating ADCs and tones demodulated in
+    software) is kept and joined at the end, as if the sequence had been
+    run with more reps.
+    """
+    def __init__(self, runners, timingOrder, variance=False):
+        runnerInfo = dict((runner.dev.devName, runner) for runner in runners)
+        self.averages = []
+        for board in timingOrder:
+            runner = runnerInfo.get(board) # demod channels are 'board::channel'
+            self.averages.append(isinstance(runner, AdcRunner) and runner.runMode == 'average'
+                                 and not runner.tones)
+        self.variance = variance
+        self.runs = 0
+        self.sums = [None] * len(timingOrder)
+        self.squares = [None] * len(timingOrder)
+        self.parts = [[] for board in timingOrder]
+        self.stacked = False
+    
+    def add(self, answers):
+        """Add the timing data returned by one run (see BoardGroup.run)."""
+        self.stacked = isinstance(answers, np.ndarray)
+        for i, answer in enumerate(answers):
+            if not self.averages[i]:
+                self.parts[i].append(answer)
+                continue
+            if self.sums[i] is None:
+                self.sums[i] = [np.zeros(len(trace), dtype='int64') for trace in answer]
+                if self.variance:
+                    self.squares[i] = [np.zeros(len(trace), dtype='int64') for trace in answer]
+            for total, trace in zip(self.sums[i], answer):
+                total += trace
+            if self.variance:
+                for total, trace in zip(self.squares[i], answer):
+                    total += np.square(trace, dtype='int64')
+        self.runs += 1
+    
+    def result(self):
+        """Get the combined timing data, in the same form as for a single run."""
+        answers = []
+        for i, average in enumerate(self.averages):
+            if average:
+                means = [total / float(self.runs) for total in self.sums[i]]
+                answer = means
+                if self.variance:
+                    answer = means + [total / float(self.runs) - mean**2
+                                      for total, mean in zip(self.squares[i], means)]
+                answers.append(tuple(answer))
+            elif isinstance(self.parts[i][0], tuple):
+                # demod channel (I, Q)
+                answers.append(tuple(np.concatenate(part) for part in zip(*self.parts[i])))
+            else:
+                answers.append(np.concatenate(self.parts[i]))
+        if self.stacked:
+            return np.vstack(answers)
+        return tuple(answers)
+
 # some helper methods
     
+def combineRanges(a, b):
+    """Combine demodulation ranges (Imax, Imin, Qmax, Qmin) from two runs."""
+    if a is None:
+        return b
+    Imax, Imin, Qmax, Qmin = zip(a, b)
+    return (max(Imax), min(Imin), max(Qmax), min(Qmin))
+
 def getCommand(cmds, chan):
     """Get a command from a dictionary of commands.
 
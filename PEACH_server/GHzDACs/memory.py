@@ -0,0 +1,250 @@
+"""Compiler for memory sequences.
+
+The memory of a DAC board holds a flat list of 24-bit commands, at most
+MEM_PAGE_LEN of them, which the board runs once per rep.  The commands used
+here are
+    0x3xxxxx  delay for xxxxx+1 cycles
+    0x400000  start timer
+    0x400001  stop timer
+    0x8xxxxx  set SRAM start address
+    0xAxxxxx  set SRAM end address
+    0xC00000  call SRAM
+    0xF00000  end of sequence (branch back to start)
+where a cycle is 40 ns (25 MHz).  There is no loop command, so writing a
+sequence with repeated blocks by hand quickly runs out of memory.
+
+compileSequence takes a structured program instead, a list of (op, args) with op one of
+    ('delay', [us])          wait for the given time in microseconds
+    ('sram', [])             call the whole SRAM
+    ('sram', [start, end])   call SRAM from start to end (word addresses)
+    ('start', [])            start the timer
+    ('stop', [])             stop the timer
+    ('repeat', [n])          repeat what follows, up to the matching end, n times
+    ('end', [])
+and makes the shortest command stream it can: repeats are unrolled, with
+repeats of nothing but delays folded into one delay, neighbouring delays are
+merged, and the SRAM start and end addresses are only set when they differ
+from the last call.  When the program is a single repeat block that does not
+fit in memory when unrolled, only as many iterations as fit (and evenly
+divide the repeat count) are compiled, and the caller has to run that many
+times more reps.
+"""
+
+from dac import MEM_PAGE_LEN, getOpcode, getAddress
+
+
+CYCLE_TIME = 40e-9 # seconds per memory cycle
+CYCLES_PER_US = 25
+SRAM_WORDS_PER_CYCLE = 40 # SRAM runs at 1 GHz
+MAX_DELAY = 0x100000 # cycles in one delay command
+
+TIMER_START = 0x400000
+TIMER_STOP = 0x400001
+CALL_SRAM = 0xC00000
+END = 0xF00000
+
+
+class CompiledSequence(object):
+    """Result of compiling a memory program."""
+    def __init__(self, mem, repsFactor, cycles):
+        self.mem = mem # list of memory commands
+        self.repsFactor = repsFactor # board reps per run of the program
+        self.cycles = cycles # memory cycles for one run of the program
+
+    @property
+    def timers(self):
+        """Timer results for one run of the program."""
+        return self.mem.count(TIMER_STOP) * self.repsFactor
+
+    @property
+    def duration(self):
+        """Run time in seconds of one run of the program."""
+        return self.cycles * CYCLE_TIME
+
+    @property
+    def sramCalls(self):
+        return self.mem.count(CALL_SRAM)
+
+
+def parse(program, sramLen=None):
+    """Parse a program into a tree of primitive operations.
+
+    Each node is ('delay', cycles), ('sram', (start, end)), ('timer', 0 or 1)
+    or ('repeat', n, nodes).  sramLen, in words, is needed for SRAM calls
+    without addresses.
+    """
+    stack = [[]]
+    counts = []
+    for op, args in program:
+        op = op.lower()
+        args = list(args)
+        if op == 'delay':
+            cycles = int(round(_arg(op, args, 1)[0] * CYCLES_PER_US))
+            if cycles < 0:
+                raise Exception('Delay must not be negative.')
+            stack[-1].append(('delay', cycles))
+        elif op == 'sram':
+            if not args:
+                if not sramLen:
+                    raise Exception('No SRAM to call; give start and end addresses.')
+                start, end = 0, sramLen - 1
+            else:
+                start, end = [int(a) for a in _arg(op, args, 2)]
+            if start < 0 or end < start or end > 0xFFFFF:
+                raise Exception('Bad SRAM range %d to %d.' % (start, end))
+            stack[-1].append(('sram', (start, end)))
+        elif op in ('start', 'stop'):
+            _arg(op, args, 0)
+            stack[-1].append(('timer', int(op == 'stop')))
+        elif op == 'repeat':
+            n = int(_arg(op, args, 1)[0])
+            if n < 0:
+                raise Exception('Repeat count must not be negative.')
+            counts.append(n)
+            stack.append([])
+        elif op == 'end':
+            _arg(op, args, 0)
+            if not counts:
+                raise Exception('End without repeat.')
+            body = stack.pop()
+            stack[-1].append(('repeat', counts.pop(), body))
+        else:
+            raise Exception("Unknown memory op '%s'." % op)
+    if counts:
+        raise Exception('Repeat without end.')
+    return stack[0]
+
+def _arg(op, args, n):
+    if len(args) != n:
+        raise Exception("'%s' takes %d arguments, got %d." % (op, n, len(args)))
+    return args
+
+def expand(nodes, limit=MEM_PAGE_LEN):
+    """Unroll a tree into a flat list of ('delay', cycles), ('sram', range)
+    and ('timer', stop) operations, merging neighbouring delays.
+
+    Returns None if there are more than limit operations, since each becomes
+    at least one memory command.
+    """
+    ops = []
+    for node in nodes:
+        if node[0] == 'repeat':
+            _, n, body = node
+            body = expand(body, limit)
+            if body is None:
+                return None
+            if not body or n == 0:
+                continue
+            if len(body) == 1 and body[0][0] == 'delay':
+                body, n = [('delay', body[0][1] * n)], 1
+            elif (len(body) - 1) * n + 1 > limit:
+                return None # too long, even if delays merge across iterations
+        else:
+            body, n = [node], 1
+        for _ in xrange(n):
+            for op in body:
+                _append(ops, op)
+        if len(ops) > limit:
+            return None
+    return ops
+
+def _append(ops, op):
+    if op[0] == 'delay':
+        if op[1] == 0:
+            return
+        if ops and ops[-1][0] == 'delay':
+            ops[-1] = ('delay', ops[-1][1] + op[1])
+            return
+    ops.append(op)
+
+def encode(ops):
+    """Turn flat operations into memory commands, ending the sequence.
+
+    SRAM addresses are set only when they change.  At the start of a rep the
+    addresses left over from the last rep are not relied on.
+    """
+    mem = []
+    start = end = None
+    running = False
+    for op, arg in ops:
+        if op == 'delay':
+            while arg > 0:
+                n = min(arg, MAX_DELAY)
+                mem.append(0x300000 + n - 1)
+                arg -= n
+        elif op == 'sram':
+            if arg[0] != start:
+                start = arg[0]
+                mem.append(0x800000 + start)
+            if arg[1] != end:
+                end = arg[1]
+                mem.append(0xA00000 + end)
+            mem.append(CALL_SRAM)
+        elif op == 'timer':
+            if arg and not running:
+                raise Exception('Timer stopped without being started.')
+            if not arg and running:
+                raise Exception('Timer started twice without a stop.')
+            running = not running
+            mem.append(TIMER_STOP if arg else TIMER_START)
+    if running:
+        raise Exception('Timer started but never stopped.')
+    mem.append(END)
+    return mem
+
+def cycles(mem):
+    """Number of memory cycles to run a sequence once.
+
+    Unlike sequenceTime in the FPGA server, which has to assume the longest
+    possible SRAM call, this follows the SRAM addresses.
+    """
+    total = 0
+    start = end = 0
+    for cmd in mem:
+        opcode, address = getOpcode(cmd), getAddress(cmd)
+        if opcode == 0x3:
+            total += address + 1
+        elif opcode == 0xC:
+            words = end - start + 1
+            total += max((words + SRAM_WORDS_PER_CYCLE - 1) // SRAM_WORDS_PER_CYCLE, 1)
+        elif opcode == 0xF:
+            total += 2
+        else:
+            if opcode == 0x8:
+                start = address
+            elif opcode == 0xA:
+                end = address
+            total += 1
+    return total
+
+def fits(mem):
+    """Whether a sequence fits in a memory page, leaving room for the delay
+    the master board adds before each SRAM call.
+    """
+    return len(mem) + mem.count(CALL_SRAM) <= MEM_PAGE_LEN
+
+def _compileNodes(nodes):
+    """Memory commands for a tree, or None if they do not fit."""
+    ops = expand(nodes)
+    if ops is None:
+        return None
+    mem = encode(ops)
+    return mem if fits(mem) else None
+
+def compileSequence(program, sramLen=None):
+    """Compile a program (see the module docstring) into a CompiledSequence."""
+    nodes = parse(program, sramLen)
+    mem = _compileNodes(nodes)
+    if mem is not None:
+        return CompiledSequence(mem, 1, cycles(mem))
+    if len(nodes) == 1 and nodes[0][0] == 'repeat':
+        # a single repeat block: run only some of the iterations per rep
+        _, n, body = nodes[0]
+        ops = expand(body)
+        most = MEM_PAGE_LEN // max(len(ops), 1) if ops is not None else 0
+        for m in xrange(min(n - 1, most), 0, -1):
+            if n % m == 0:
+                mem = _compileNodes([('repeat', m, body)])
+                if mem is not None:
+                    return CompiledSequence(mem, n // m, cycles(mem) * (n // m))
+    raise Exception('Sequence does not fit in memory (%d commands).' % MEM_PAGE_LEN)
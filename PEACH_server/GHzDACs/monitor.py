@@ -0,0 +1,119 @@
+"""Background health monitor for GHz DAC and ADC boards.
+
+Boards can lose PLL lock, or come back from a power glitch with the wrong
+FIFO counter, without anyone noticing until the data looks wrong.  The
+HealthMonitor checks every board from time to time (see checkHealth in
+dac.py and adc.py), keeps a time series of the results for each board and
+calls a callback, usually a LabRAD signal, with (board, ok, message) when a
+check fails or a failed board is healthy again.
+
+Checks only run while the board group of a board is idle, that is when no
+sequence is waiting for or running on any of its boards, so they never hold
+up the pipeline.  The interval between checks of a board adapts: it doubles
+after each healthy check, up to MAX_INTERVAL, and drops to MIN_INTERVAL as
+soon as a check fails.
+"""
+
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+
+
+TICK = 1.0 # seconds between looks for boards that are due and idle
+MIN_INTERVAL = 5.0 # seconds between checks of a board, after a failure
+MAX_INTERVAL = 600.0 # seconds between checks of a healthy board
+HISTORY_LEN = 1000 # checks kept per board
+
+
+class HealthMonitor(object):
+    """Checks board health in the idle gaps of the pipeline."""
+
+    def __init__(self, devices, notify=None):
+        """Create a monitor.
+
+        devices is called to get the list of boards (device wrappers) to
+        check, and notify, if given, with (board name, ok, message) when a
+        check fails or a failed board is healthy again.
+        """
+        self.devices = devices
+        self.notify = notify
+        self.running = False
+        self.call = None
+        self.history = {} # board -> list of (time, ok, pllLocked, build, fifo)
+        self.status = {} # board -> (ok, time, message) of the last check
+        self.intervals = {} # board -> seconds until the next check
+        self.due = {} # board -> time of the next check
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._schedule(0)
+
+    def stop(self):
+        self.running = False
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def _schedule(self, delay):
+        self.call = reactor.callLater(delay, self._tick)
+
+    @inlineCallbacks
+    def _tick(self):
+        """Check the boards that are due, if their board group is idle."""
+        self.call = None
+        try:
+            devs = self.devices()
+            self.forget(set(self.status) - set(dev.devName for dev in devs))
+            for dev in devs:
+                if not self.running:
+                    break
+                if self.due.get(dev.devName, 0) > time.time():
+                    continue
+                if not dev.boardGroup.idle():
+                    continue # try again on the next tick
+                yield self.check(dev)
+        except Exception, e:
+            print 'health monitor error:', e
+        finally:
+            if self.running and self.call is None:
+                self._schedule(TICK)
+
+    @inlineCallbacks
+    def check(self, dev):
+        """Check one board now and record the result."""
+        name = dev.devName
+        now = time.time()
+        try:
+            health = yield dev.checkHealth()
+            problems = health['problems']
+            record = (now, not problems, health['pllLocked'], health['build'], health['fifo'])
+        except Exception, e:
+            problems = ['check failed: %s' % e]
+            record = (now, False, False, 0, [])
+        ok = not problems
+        message = '; '.join(problems)
+
+        history = self.history.setdefault(name, [])
+        history.append(record)
+        if len(history) > HISTORY_LEN:
+            del history[:len(history) - HISTORY_LEN]
+
+        wasOk = self.status.get(name, (True,))[0]
+        self.status[name] = (ok, now, message)
+        if ok:
+            interval = min(self.intervals.get(name, MIN_INTERVAL / 2) * 2, MAX_INTERVAL)
+        else:
+            interval = MIN_INTERVAL
+        self.intervals[name] = interval
+        self.due[name] = time.time() + interval
+
+        if self.notify is not None and (not ok or not wasOk):
+            self.notify((name, ok, message))
+
+    def forget(self, names):
+        """Drop all records for boards that are no longer present."""
+        for name in names:
+            for d in (self.history, self.status, self.intervals, self.due):
+                d.pop(name, None)
@@ -0,0 +1,38 @@
+import collections
+
+from capture import Capture, CaptureReader, replayScripts
+
+
+Record = collections.namedtuple('Record', 'name data key')
+
+BOARD = '00:01:CA:AA:00:01'
+OTHER = '00:01:CA:AA:00:02'
+DEST = '00:00:00:00:00:00'
+
+
+def record(capture, ctx, port, source, rec, resp):
+    stage = capture.recordRequest([rec], ctx, port, source)
+    capture.recordResponse([rec], resp, ctx, stage, port, source)
+
+def test_replay_scripts(tmpdir):
+    filename = str(tmpdir.join('test.cap'))
+    capture = Capture()
+    capture.start(filename)
+    ctx, port = (1, 5), 2
+    reads = [(BOARD, DEST, 48, 'a' * 48), (BOARD, DEST, 48, 'b' * 48)]
+    record(capture, ctx, port, BOARD, Record('Read', 2, None), {'Read': reads})
+    record(capture, ctx, port, BOARD, Record('Discard', 3, None), {})
+    record(capture, ctx, port, BOARD, Record('Read Bulk', (2, 4), 'bulk'),
+           {'bulk': (6, 'cccccc' + 'dddddd')})
+    # another board, in another context, is replayed on its own
+    reads = [(OTHER, DEST, 48, 'e' * 48)]
+    record(capture, (1, 6), port, OTHER, Record('Read', None, 'r'), {'r': reads})
+    assert capture.stop() == 9
+
+    scripts, ports = replayScripts(CaptureReader(filename))
+    assert ports == set([port])
+    assert sorted(scripts) == [(port, BOARD), (port, OTHER)]
+    assert list(scripts[port, BOARD]) == [
+        (BOARD, 'a' * 48), (BOARD, 'b' * 48), None, None, None,
+        (BOARD, '\x00' * 4 + 'cccccc'), (BOARD, '\x00' * 4 + 'dddddd')]
+    assert list(scripts[port, OTHER]) == [(OTHER, 'e' * 48)]
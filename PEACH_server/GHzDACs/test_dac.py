@@ -0,0 +1,23 @@
+from labrad import types as T
+
+from dac import parseBringupCache, bringupCacheForRegistry
+
+
+class Device(object):
+    pass
+
+
+def test_bringup_cache_round_trip():
+    cache = {
+        'A': {'lvdsSD': 3, 'fifoCounter': 3, 'fifoClockPolarity': True, 'fifoPHOF': 0},
+        'B': {'lvdsSD': 5, 'fifoCounter': 3, 'fifoClockPolarity': False, 'fifoPHOF': 1},
+    }
+    stored = bringupCacheForRegistry(cache)
+    T.flatten(stored, '*(s*(si))')
+    # the registry gives back the values as integers
+    device = Device()
+    parseBringupCache(T.unflatten(*T.flatten(stored, '*(s*(si))')), device)
+    assert device.bringupCache == cache
+    for params in device.bringupCache.values():
+        # returned in the (sb) fifoClockPolarity field of bringup results
+        T.flatten(params['fifoClockPolarity'], 'b')
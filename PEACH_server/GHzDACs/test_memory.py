@@ -0,0 +1,40 @@
+import pytest
+
+from memory import compileSequence, cycles, fits, CALL_SRAM, END
+
+
+LOOP = [('start', []), ('sram', [0, 39]), ('stop', []), ('delay', [1])]
+
+
+def test_single_call():
+    seq = compileSequence([('sram', [0, 39]), ('delay', [1])])
+    assert seq.mem == [0x800000, 0xA00027, CALL_SRAM, 0x300018, END]
+    assert seq.cycles == 30
+    assert seq.duration == pytest.approx(1.2e-6)
+
+def test_repeated_delay_folds():
+    seq = compileSequence([('repeat', [1000]), ('delay', [2]), ('end', [])])
+    assert seq.mem == [0x300000 + 49999, END]
+    assert seq.cycles == 50002
+
+def test_repeat_sets_addresses_once():
+    seq = compileSequence([('repeat', [3])] + LOOP + [('end', [])])
+    assert len(seq.mem) == 15
+    assert seq.sramCalls == 3
+    assert seq.timers == 3
+    assert seq.repsFactor == 1
+    assert seq.cycles == 30 + 2*28 + 2
+
+def test_reps_factor():
+    # too many iterations to unroll: run some of them per rep
+    n = 1000
+    seq = compileSequence([('repeat', [n])] + LOOP + [('end', [])])
+    assert seq.repsFactor > 1
+    assert n % seq.repsFactor == 0
+    assert fits(seq.mem)
+    assert seq.timers == n
+    assert seq.cycles == cycles(seq.mem) * seq.repsFactor
+
+def test_unbalanced_repeat():
+    with pytest.raises(Exception):
+        compileSequence([('repeat', [2]), ('delay', [1])])
@@ -1,5 +1,8 @@
+import heapq
+import itertools
 import time
-from twisted.internet import defer
+
+from twisted.internet import defer, reactor
 
 
 def littleEndian(data, bytes=4):
@@ -66,3 +69,355 @@ class TimedLock(object):
             self.addTime(dt)
             d.callback(dt)
 
+
+
+class FairScheduler(object):
+    """
+    A counting semaphore that grants slots by priority and weighted fair share.
+
+    Each request is made on behalf of a client (usually a LabRAD context ID)
+    with a priority and a weight.  Waiting requests with the highest priority
+    are always granted first.  Among requests with equal priority, slots are
+    shared between clients in proportion to their weights using weighted fair
+    queuing: requests are granted in order of their virtual finish time,
+    where the cost of each request is the estimated time for which it will
+    hold a slot, and virtual time advances to the start time of each granted
+    request.  This way a client queueing many long requests cannot starve
+    other clients at the same priority.
+
+    acquireAll reserves every slot for exclusive use, e.g. for test mode.
+    Once an exclusive request is pending no further slots are granted until
+    it has been served.
+    """
+
+    TIMES_TO_KEEP = 100
+
+    def __init__(self, tokens):
+        self.limit = self.tokens = tokens
+        self.waiting = []
+        self.exclusive = []
+        self.virtualTime = 0.0
+        self.counter = itertools.count()
+        self.clients = {}
+
+    def _client(self, client):
+        """Get the bookkeeping record for a client, creating it if needed."""
+        if client not in self.clients:
+            self.clients[client] = {
+                'priority': 0,
+                'weight': 1.0,
+                'finish': 0.0,
+                'queued': 0,
+                'running': 0,
+                'maxQueued': 0,
+                'served': 0,
+                'waitTimes': [],
+                'expired': False,
+            }
+        return self.clients[client]
+
+    def acquire(self, client=None, priority=0, weight=1.0, cost=1.0):
+        """Request one slot.
+
+        @return: a Deferred which fires with the time spent waiting
+            once the slot has been granted.
+        """
+        info = self._client(client)
+        info['priority'] = priority
+        info['weight'] = weight
+        start = max(self.virtualTime, info['finish'])
+        info['finish'] = start + float(cost) / max(weight, 1e-9)
+        info['queued'] += 1
+        info['maxQueued'] = max(info['maxQueued'], info['queued'])
+        d = defer.Deferred()
+        # sort key: highest priority first, then earliest finish tag, then FIFO
+        key = (-priority, info['finish'], self.counter.next())
+        heapq.heappush(self.waiting, (key, start, client, time.time(), d))
+        self._schedule()
+        return d
+
+    def release(self, client=None):
+        """Release a slot previously granted to the given client."""
+        assert self.tokens < self.limit, "Tried to release an unacquired slot"
+        self.tokens += 1
+        info = self.clients.get(client)
+        if info is not None:
+            info['running'] -= 1
+            if info['expired']:
+                self.forget(client)
+        self._schedule()
+
+    def acquireAll(self):
+        """Reserve all slots.
+
+        @return: a Deferred which fires once all slots are held.
+        """
+        d = defer.Deferred()
+        self.exclusive.append(d)
+        self._schedule()
+        return d
+
+    def releaseAll(self):
+        """Release all slots reserved with acquireAll."""
+        assert self.tokens == 0, "Tried to release slots that are not all held"
+        self.tokens = self.limit
+        self._schedule()
+
+    def _schedule(self):
+        """Grant slots to waiting requests while slots are available."""
+        while self.exclusive:
+            if self.tokens < self.limit:
+                return
+            self.tokens = 0
+            self.exclusive.pop(0).callback(None)
+        while self.tokens > 0 and self.waiting:
+            key, start, client, t, d = heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.virtualTime = max(self.virtualTime, start)
+            info = self._client(client)
+            info['queued'] -= 1
+            info['running'] += 1
+            info['served'] += 1
+            dt = time.time() - t
+            times = info['waitTimes']
+            times.append(dt)
+            if len(times) > self.TIMES_TO_KEEP:
+                times.pop(0)
+            d.callback(dt)
+
+    def forget(self, client):
+        """Drop statistics for a client which has gone away.
+
+        If the client still has requests queued or running, it is marked
+        as expired and dropped when the last of them is released.
+        """
+        info = self.clients.get(client)
+        if info is None:
+            return
+        if info['queued'] or info['running']:
+            info['expired'] = True
+        else:
+            del self.clients[client]
+
+    def queueDepth(self):
+        """Total number of requests waiting for a slot."""
+        return len(self.waiting)
+
+    def queuedAhead(self, priority=0):
+        """Number of waiting requests that would be served before a new one with this priority."""
+        return sum(1 for key, start, client, t, d in self.waiting if -key[0] >= priority)
+
+    def stats(self):
+        """Get per-client queue statistics.
+
+        Returns a list of (client, priority, weight, queued, running,
+        maxQueued, served, meanWait) tuples sorted by client.
+        """
+        ans = []
+        for client, info in sorted(self.clients.items()):
+            times = info['waitTimes']
+            meanWait = sum(times) / len(times) if times else 0.0
+            ans.append((client, info['priority'], info['weight'],
+                        info['queued'], info['running'], info['maxQueued'],
+                        info['served'], meanWait))
+        return ans
+
+
+class BoardLocks(object):
+    """
+    Locks on individual boards of a board group, for test mode.
+
+    Sequences hold the boards they use shared, so any number of sequences
+    can be in the pipe at once, while test mode holds boards exclusively,
+    so that a diagnostic on one board only waits for, and holds up, the
+    sequences that use that board.  Requests are granted in order for each
+    board: once a request is waiting for a board, later requests for that
+    board wait behind it, so test mode cannot be starved by a stream of
+    sequences.  Passing boards=None to an exclusive request requests every
+    board in the group.
+    """
+
+    ALL = None
+
+    def __init__(self):
+        self.shared = {} # board -> number of shared holders
+        self.exclusive = set() # boards held exclusively
+        self.exclusiveAll = False
+        self.waiting = [] # (boards, exclusive, deferred) in request order
+
+    def acquire(self, boards=ALL, exclusive=False):
+        """Acquire the given boards (shared or exclusive).
+
+        @return: a Deferred which fires once the boards are held.
+        """
+        if boards is not self.ALL:
+            boards = frozenset(boards)
+        elif not exclusive:
+            raise ValueError("Shared requests must name their boards")
+        d = defer.Deferred()
+        self.waiting.append((boards, exclusive, d))
+        self._schedule()
+        return d
+
+    def release(self, boards=ALL, exclusive=False):
+        """Release boards acquired with the same arguments."""
+        if exclusive:
+            if boards is self.ALL:
+                self.exclusiveAll = False
+            else:
+                self.exclusive.difference_update(boards)
+        else:
+            for board in boards:
+                self.shared[board] -= 1
+                if not self.shared[board]:
+                    del self.shared[board]
+        self._schedule()
+
+    def idle(self):
+        """Check whether no boards are held or waited for."""
+        return not (self.shared or self.exclusive or self.exclusiveAll or self.waiting)
+
+    def locked(self, board):
+        """Check whether a board is held exclusively, i.e. in test mode."""
+        return self.exclusiveAll or board in self.exclusive
+
+    def _overlaps(self, a, b):
+        return a is self.ALL or b is self.ALL or bool(a & b)
+
+    def _available(self, boards, exclusive):
+        if self.exclusiveAll:
+            return False
+        if boards is self.ALL:
+            return not (self.exclusive or (exclusive and self.shared))
+        if self.exclusive & boards:
+            return False
+        return not (exclusive and any(board in self.shared for board in boards))
+
+    def _schedule(self):
+        """Grant waiting requests whose boards are free, in order per board."""
+        blocked = []
+        remaining = []
+        granted = []
+        for boards, exclusive, d in self.waiting:
+            ahead = any(self._overlaps(boards, b) for b in blocked)
+            if not ahead and self._available(boards, exclusive):
+                if exclusive and boards is self.ALL:
+                    self.exclusiveAll = True
+                elif exclusive:
+                    self.exclusive.update(boards)
+                else:
+                    for board in boards:
+                        self.shared[board] = self.shared.get(board, 0) + 1
+                granted.append(d)
+            else:
+                blocked.append(boards)
+                remaining.append((boards, exclusive, d))
+        self.waiting = remaining
+        for d in granted:
+            d.callback(None)
+
+
+class TicketBuffer(object):
+    """
+    Bounded buffer for the results of asynchronously submitted requests.
+
+    Each submitted request gets a ticket number, and its result is kept
+    until it is fetched.  At most maxOutstanding tickets (running or
+    finished but not yet fetched) can exist at once; further calls to
+    reserve wait until a ticket is fetched, which applies backpressure to
+    clients that submit faster than they collect their results.
+    """
+
+    def __init__(self, maxOutstanding):
+        self.maxOutstanding = maxOutstanding
+        self.nextTicket = 1
+        self.pending = {} # ticket -> list of waiting deferreds
+        self.results = {} # ticket -> (success, result or failure)
+        self.slotWaiters = []
+
+    def outstanding(self):
+        """Number of tickets which have not yet been fetched."""
+        return len(self.pending) + len(self.results)
+
+    def reserve(self):
+        """Reserve a new ticket.
+
+        @return: a Deferred which fires with the ticket number once
+            there is room for another outstanding ticket.
+        """
+        d = defer.Deferred()
+        self.slotWaiters.append(d)
+        self._grant()
+        return d
+
+    def _grant(self):
+        while self.slotWaiters and self.outstanding() < self.maxOutstanding:
+            ticket = self.nextTicket
+            self.nextTicket += 1
+            self.pending[ticket] = []
+            self.slotWaiters.pop(0).callback(ticket)
+
+    def submit(self, ticket, d):
+        """Store the result of deferred d under the given reserved ticket."""
+        def done(result, success):
+            waiters = self.pending.pop(ticket)
+            if waiters:
+                # result is handed directly to whoever is waiting for it
+                for w in waiters:
+                    if success:
+                        w.callback(result)
+                    else:
+                        w.errback(result)
+                self._grant()
+            else:
+                self.results[ticket] = (success, result)
+        d.addCallbacks(done, done, callbackArgs=(True,), errbackArgs=(False,))
+
+    def _check(self, ticket):
+        if ticket not in self.pending and ticket not in self.results:
+            raise Exception('Unknown ticket %d.' % ticket)
+
+    def done(self):
+        """Get a sorted list of finished tickets whose results are waiting."""
+        return sorted(self.results.keys())
+
+    def fetch(self, ticket):
+        """Get the result for a finished ticket without waiting.
+
+        Raises an exception if the ticket is not finished, or the
+        exception raised while processing the request, if any.
+        """
+        self._check(ticket)
+        if ticket not in self.results:
+            raise Exception('Ticket %d is not finished.' % ticket)
+        success, result = self.results.pop(ticket)
+        self._grant()
+        if not success:
+            result.raiseException()
+        return result
+
+    def wait(self, ticket, timeout=None):
+        """Wait for the result of a ticket.
+
+        @return: a Deferred which fires with the result once the
+            request is finished.  If a timeout in seconds is given
+            and the ticket does not finish in time, the Deferred
+            fails, but the ticket is kept so it can be waited on again.
+        """
+        self._check(ticket)
+        if ticket in self.results:
+            return defer.maybeDeferred(self.fetch, ticket)
+        d = defer.Deferred()
+        waiters = self.pending[ticket]
+        waiters.append(d)
+        if timeout is not None:
+            def expire():
+                waiters.remove(d)
+                d.errback(Exception('Timeout waiting for ticket %d.' % ticket))
+            timeoutCall = reactor.callLater(timeout, expire)
+            def cancel(result):
+                if timeoutCall.active():
+                    timeoutCall.cancel()
+                return result
+            d.addBoth(cancel)
+        return d
@@ -0,0 +1,49 @@
+import imp
+import os
+
+import numpy
+import pytest
+
+dv = imp.load_source('data_vault', os.path.join(os.path.dirname(__file__), '0_data_vault.py'))
+
+
+ROWS = numpy.array([[0.0, 1.5], [1e-9, -2.25e6], [2.0, numpy.pi]])
+
+
+class Session(object):
+    parent = None
+
+    def __init__(self, dir):
+        self.dir = dir
+
+
+@pytest.fixture
+def session(tmpdir):
+    return Session(str(tmpdir))
+
+def makeDataset(session):
+    ds = dv.BinaryDataset(session, 'test', 'binary test', create=True)
+    ds.addIndependent('x [s]')
+    ds.addDependent('y (z) [V]')
+    ds._saveData(ROWS)
+    return ds
+
+def test_round_trip(session):
+    makeDataset(session).file.close()
+    ds = dv.BinaryDataset(session, 'test')
+    assert (ds._loadData() == ROWS).all()
+
+def test_partial_last_row(session):
+    ds = makeDataset(session)
+    # half a row, as left by a crash in the middle of a write
+    ds.file.write(numpy.array([3.0], dtype='<f8').tostring())
+    ds.file.close()
+    ds = dv.BinaryDataset(session, 'test')
+    assert (ds._loadData() == ROWS).all()
+
+def test_column_mismatch(session):
+    makeDataset(session).file.close()
+    ds = dv.BinaryDataset(session, 'test')
+    ds.dependents.append(ds.dependents[0])
+    with pytest.raises(dv.BadDatafileError):
+        ds._loadData()